@@ -1,23 +1,49 @@
+import os
 import json
 import numpy as np
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import Any, List
 
-from utils.rag import retrieval
-from utils.data import data_store
+from utils.rag import retrieval, cached_retrieval, generate_queries, batch_retrieval, retrieval_cache
+from utils.data import data_store, _PYRAMID_RESOLUTIONS
+from utils.export import export_response, cached_response
 from datetime import datetime
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 
-import nltk
-nltk.download('punkt')
-import asyncio
-from utils.client_setup import client
+from utils.client_setup import async_client
+from utils.executor import run_blocking, shutdown
+from utils.memory import SessionMemory, DEFAULT_SESSION
+from starlette.background import BackgroundTask
+from utils.models import registry, ensure_nltk_data, warm_up, encode_query
+from utils.semantic_cache import SemanticCache
+from utils.streaming import sse_event, coalesce, StreamTimer
+from utils.metrics import MetricsMiddleware, Counter, Gauge, span, record, register_cache, render_metrics, CONTENT_TYPE
+import re
 
+_WARMUP = os.environ.get('SCHOLET_WARMUP', '1') == '1'
 
-app = FastAPI()
+startup = {"ready": False, "nltk": {}, "warm_up_seconds": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # corpus, indexes and models are loaded once per worker here rather than on import
+    startup["nltk"] = await run_blocking(ensure_nltk_data, timeout=None)
+    await run_blocking(data_store.load_data, timeout=None)
+    if _WARMUP:
+        startup["warm_up_seconds"] = await run_blocking(warm_up, timeout=None)
+        # every /update resolution, so changing the bin count is a cache hit
+        await run_blocking(data_store.warm_levels, timeout=None)
+    startup["ready"] = True
+    yield
+    shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -30,9 +56,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Data-Version", "X-Total-Count", "Server-Timing"],
 )
-
-messages_history = []
+# outermost, so the time spent in the other middlewares counts too
+app.add_middleware(MetricsMiddleware)
+
+memory = SessionMemory()
+# /rag answers of stand-alone questions, per cited context ids and query similarity
+answer_cache = SemanticCache()
+data_store.on_change(answer_cache.clear)
+register_cache('answers', answer_cache)
+# words per chunk when a cached answer is replayed through the stream
+_REPLAY_CHUNK_WORDS = 8
+
+Gauge('scholet_papers', 'Papers in the published corpus.', lambda: len(data_store.snapshot().df))
+Gauge('scholet_data_version', 'Version of the published corpus.', lambda: data_store.version)
+rag_streams = Counter('scholet_rag_streams_total', 'Answers streamed by /rag, per outcome.', ('outcome',))
+rag_tokens = Counter('scholet_rag_tokens_total', 'Deltas streamed from the LLM by /rag.')
 
 _rag_query_text = """
 You are an AI assistant helps answering users' questions about scholars and their papers. 
@@ -74,84 +114,252 @@ New lines of conversation:
 New summary:"""
 
 
+@app.get("/health")
+async def health():
+    ready = startup["ready"] and data_store.loaded and any(startup["nltk"].values())
+    snapshot = data_store.snapshot()
+    status = {
+        "status": "ok" if ready else "unavailable",
+        "papers": len(snapshot.df),
+        "version": snapshot.version,
+        "nltk": startup["nltk"],
+        "models": registry.status(),
+        "warm_up_seconds": startup["warm_up_seconds"],
+        "caches": {"retrieval": retrieval_cache.stats(), "answers": answer_cache.stats()},
+    }
+    return JSONResponse(status, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+
 class DataResponse(BaseModel):
     df: list[dict[str, Any]]
     date: str
 
 @app.get("/data")
-async def data():
-    global messages_history
-    messages_history = []
+async def data(request: Request, columns: str = None, format: str = "json", offset: int = 0, limit: int = None):
+    memory.clear(session_id_of(request))
     
-    embeddings_df = data_store.get_data()
-    print(embeddings_df.shape)
-    embeddings_df.replace([np.inf, -np.inf], np.nan, inplace=True)
-    embeddings_df.fillna("", inplace=True)  # replace NaN values with an arbitrary number
-    embeddings_df = embeddings_df.to_dict(orient="records")
-    return {"df": embeddings_df, "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    # one snapshot for the whole request: the body and its ETag always match
+    snapshot = data_store.snapshot()
+    embeddings_df = await run_blocking(data_store.get_view, snapshot)
+    return await run_blocking(
+        export_response,
+        request, embeddings_df, snapshot.view_key(), datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        columns=columns, format=format, offset=offset, limit=limit,
+    )
+
+
+_DENSITY_GRID_RANGE = (16, 1024)
+
+
+@app.get("/density")
+async def density(request: Request, grid: int = 256, bandwidth: float = None):
+    """
+    Density heatmap of the map: grid x grid values scaled to [0, 1] (multiply by max
+    for the density), row-major from the bottom-left corner (rows follow umap_y,
+    columns umap_x), over extent [x0, x1, y0, y1].
+    """
+    if not _DENSITY_GRID_RANGE[0] <= grid <= _DENSITY_GRID_RANGE[1]:
+        raise HTTPException(status_code=400, detail=f"grid must be between {_DENSITY_GRID_RANGE[0]} and {_DENSITY_GRID_RANGE[1]}.")
+    if bandwidth is not None and bandwidth <= 0:
+        raise HTTPException(status_code=400, detail="bandwidth must be positive.")
+    
+    snapshot = data_store.snapshot()
+    heatmap = await run_blocking(data_store.get_density, grid, bandwidth, snapshot)
+    
+    def build():
+        values = heatmap["density"]
+        return json.dumps({
+            "width": values.shape[1],
+            "height": values.shape[0],
+            "extent": heatmap["extent"],
+            "bandwidth": heatmap["bandwidth"],
+            "max": float(values.max()),
+            "values": np.round(values.ravel() / max(float(values.max()), 1e-30), 4).tolist(),
+        }).encode()
+    
+    return await run_blocking(cached_response, request, snapshot.version, ["density", snapshot.version, grid, bandwidth], build)
+
+
+_MAX_VIEWPORT_TILES = 16
+
+
+@app.get("/tiles")
+async def tiles_info(request: Request):
+    snapshot = data_store.snapshot()
+    index = await run_blocking(data_store.get_tile_index, snapshot)
+    return {"extent": index.extent, "max_zoom": index.max_zoom, "count": len(index), "version": snapshot.version}
+
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def tile(request: Request, z: int, x: int, y: int):
+    """
+    Tile (z, x, y) of the map: at zoom z the map extent is split into 2^z x 2^z tiles,
+    x growing with umap_x and y with umap_y.
+    """
+    snapshot = data_store.snapshot()
+    index = await run_blocking(data_store.get_tile_index, snapshot)
+    if not 0 <= z <= index.max_zoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail="No such tile.")
+    
+    # the ETag only needs the view key, a revalidation is answered before the tile is built
+    view_key = snapshot.view_key()
+    return await run_blocking(
+        cached_response, request, view_key[0], ["tile", view_key, z, x, y],
+        lambda: json.dumps(data_store.get_tile(z, x, y, snapshot)).encode(),
+    )
+
+
+@app.get("/viewport")
+async def viewport(request: Request, x0: float, x1: float, y0: float, y1: float, zoom: int = None):
+    """
+    The tiles covering the box [x0, x1] x [y0, y1], at the given zoom or at the deepest
+    zoom that covers it with at most 4 x 4 tiles.
+    """
+    if x1 <= x0 or y1 <= y0:
+        raise HTTPException(status_code=400, detail="Expected x0 < x1 and y0 < y1.")
+    snapshot = data_store.snapshot()
+    index = await run_blocking(data_store.get_tile_index, snapshot)
+    bbox = (x0, x1, y0, y1)
+    zoom = index.zoom_for(bbox) if zoom is None else zoom
+    if not 0 <= zoom <= index.max_zoom:
+        raise HTTPException(status_code=400, detail=f"zoom must be between 0 and {index.max_zoom}.")
+    covering = index.covering(bbox, zoom)
+    if len(covering) > _MAX_VIEWPORT_TILES:
+        raise HTTPException(status_code=400, detail=f"The viewport covers more than {_MAX_VIEWPORT_TILES} tiles at zoom {zoom}.")
+    
+    view_key = snapshot.view_key()
+    return await run_blocking(
+        cached_response, request, view_key[0], ["viewport", view_key, zoom, covering],
+        lambda: json.dumps({"zoom": zoom, "extent": index.extent, "tiles": [data_store.get_tile(zoom, tx, ty, snapshot) for tx, ty in covering]}).encode(),
+    )
 
 
 class UpdateParams(BaseModel):
     binsNum: int
-    clusterNum: int
+    clusterNum: int = Field(ge=2)
+
+    @field_validator("binsNum")
+    @classmethod
+    def in_pyramid(cls, value):
+        # the bin columns of the corpus only exist for these resolutions
+        if value not in _PYRAMID_RESOLUTIONS:
+            raise ValueError(f"binsNum must be one of {list(_PYRAMID_RESOLUTIONS)}")
+        return value
     
 @app.post("/update")
-async def update(update_params: UpdateParams):
+async def update(request: Request, update_params: UpdateParams):
     bins_num = update_params.binsNum
     cluster_num = update_params.clusterNum
+    if cluster_num > len(data_store.snapshot().df):
+        raise HTTPException(status_code=400, detail="clusterNum cannot exceed the number of papers.")
     
-    print(bins_num, cluster_num)
+    with span('update_params'):
+        snapshot = await run_blocking(data_store.update_params, bins_num, cluster_num, timeout=120)
+        embeddings_df = await run_blocking(data_store.get_view, snapshot, timeout=120)
     
-    embeddings_df = data_store.update_params(bins_num, cluster_num)
+    return await run_blocking(export_response, request, embeddings_df, snapshot.view_key(), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+
+class IngestRequest(BaseModel):
+    papers: List[dict[str, Any]]
+
+
+@app.post("/ingest")
+async def ingest(ingest_request: IngestRequest):
+    if len(ingest_request.papers) == 0:
+        raise HTTPException(status_code=400, detail="No papers to ingest.")
+    if any('Abstract' not in paper and 'content' not in paper for paper in ingest_request.papers):
+        raise HTTPException(status_code=422, detail="Every paper needs an 'Abstract' or 'content' field.")
     
-    return {"df": embeddings_df.to_dict(orient="records"), "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    paper_ids = await run_blocking(data_store.ingest, ingest_request.papers, timeout=600)
+    
+    return {"paper_ids": paper_ids, "version": data_store.version, "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
 
 class RetrievalRequest(BaseModel):
     query: str
+    # also search with LLM-generated related queries and fuse the results
+    expand: bool = False
 
 
 @app.post("/retrieval")
 async def semantic_retrieval(retrieval_request: RetrievalRequest):
-    ranked_results = retrieval(retrieval_request.query)
+    query, expand = retrieval_request.query, retrieval_request.expand
+    snapshot = data_store.snapshot()
+    ranked_results = cached_retrieval(query, expand, snapshot)
+    if ranked_results is None:
+        expansions = await generate_queries(query) if expand else None
+        ranked_results = await run_blocking(retrieval, query, expansions, snapshot)
 
     return json.dumps(ranked_results, default=str)
 
 
+_BATCH_MAX_QUERIES = 10000
+_BATCH_MAX_TOP_K = 1000
+# queries scored per matrix product; each chunk is streamed as soon as it is ready
+_BATCH_CHUNK = 256
+
+
+class RetrievalBatchRequest(BaseModel):
+    queries: List[str] = []
+    paper_ids: List[int] = []
+    top_k: int = 10
+
+
+@app.post("/retrieval/batch")
+async def batch_semantic_retrieval(batch_request: RetrievalBatchRequest):
+    queries, paper_ids = batch_request.queries, batch_request.paper_ids
+    if (len(queries) == 0) == (len(paper_ids) == 0):
+        raise HTTPException(status_code=400, detail="Send either queries or paper_ids.")
+    if len(queries) + len(paper_ids) > _BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {_BATCH_MAX_QUERIES} queries per batch.")
+    if not 0 < batch_request.top_k <= _BATCH_MAX_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {_BATCH_MAX_TOP_K}.")
+
+    # one corpus version for the whole response, however long it streams
+    snapshot = data_store.snapshot()
+
+    async def records_stream():
+        items = queries or paper_ids
+        for start in range(0, len(items), _BATCH_CHUNK):
+            chunk = items[start:start + _BATCH_CHUNK]
+            records = await run_blocking(
+                batch_retrieval,
+                queries=chunk if queries else None, paper_ids=chunk if paper_ids else None, top_k=batch_request.top_k,
+                snapshot=snapshot, timeout=120,
+            )
+            yield "".join(json.dumps(record, default=str) + "\n" for record in records)
+
+    return StreamingResponse(records_stream(), media_type="application/x-ndjson")
+
+
+
+def session_id_of(request: Request):
+    return request.headers.get("x-session-id") or DEFAULT_SESSION
+
 
 @app.get("/clear_memory")
-async def clear_memory():
-    global messages_history
-    messages_history = []
+async def clear_memory(request: Request):
+    memory.clear(session_id_of(request))
 
 
-async def memory_handler():
-    global messages_history
-    
-    if len(messages_history) < 5:
-        return
+async def summarize_history(summary, new_lines):
+    system_prompt = _summarize_chat_history_prompt.format(summary=summary, new_lines=new_lines)
     
-    # 2 + 2 + 2
-    # 1 + 2 + 2
-    
-    system_prompt = _summarize_chat_history_prompt.format(
-        summary=messages_history[0]["content"] if len(messages_history) > 4 else "",
-        new_lines="\n".join([m["content"] for m in messages_history[1:3]]) if len(messages_history) > 4 else "\n".join([m["content"] for m in messages_history[:2]])
-    )
-    
-    res = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": system_prompt}],
-        max_tokens=1024,
-        temperature=0.1,
-        stream=False,
-    )
-    
-    print('Generate New Summary', len(res.choices[0].message.content))
-    
-    messages_history = [
-        {"role": "system", "content": res.choices[0].message.content},
-    ] + messages_history[-2:]
+    with span('rag.summarize'):
+        res = await async_client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": system_prompt}],
+            max_tokens=1024,
+            temperature=0.1,
+            stream=False,
+        )
+    return res.choices[0].message.content
 
 
 class MessageRequest(BaseModel):
@@ -160,24 +368,41 @@ class MessageRequest(BaseModel):
     
     
 @app.post("/rag")
-async def rag(message_request: MessageRequest): 
+async def rag(request: Request, message_request: MessageRequest): 
+    session_id = session_id_of(request)
     prompt = message_request.prompt
     context = message_request.context
     
-    # response, citations = await RAG(prompt, context)
     system_prompt = _rag_query_text.format(
         context="\n\n".join(
             [f"[[citation:{c['id']}]] Author: {c['author']}\n Title: {c['title']}\n Abstract: {c['text']}" for i, c in enumerate(context)]
         )
     )
     
-    async def response_stream():
-        global messages_history
-        
-        response = client.chat.completions.create(
+    history = memory.history(session_id)
+    context_ids = [c['id'] for c in context]
+    
+    # only answers to the first question of a conversation are shared, follow-ups depend on the history
+    cacheable = len(history) == 0
+    with span('rag.embed_prompt'):
+        prompt_embedding = await run_blocking(encode_query, prompt) if cacheable else None
+    cached_answer = answer_cache.lookup(prompt_embedding, context_ids) if cacheable else None
+    
+    timer = StreamTimer()
+    citations = [{"id": c["id"], "title": c.get("title"), "author": c.get("author")} for c in context]
+    
+    async def cached_deltas(state):
+        words = re.findall(r"\S+\s*", cached_answer)
+        for start in range(0, len(words), _REPLAY_CHUNK_WORDS):
+            timer.token()
+            yield "".join(words[start:start + _REPLAY_CHUNK_WORDS])
+        state["finish_reason"] = "stop"
+    
+    async def upstream_deltas(state):
+        response = await async_client.chat.completions.create(
             # model="gpt-3.5-turbo",
             model="gpt-4-turbo-preview",
-            messages= messages_history + [
+            messages= history + [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt},
             ],
@@ -185,25 +410,57 @@ async def rag(message_request: MessageRequest):
             temperature=1,
             stream=True,
         )
+        try:
+            async for chunk in response:
+                content = chunk.choices[0].delta.content
+                if content:
+                    timer.token()
+                    yield content
+                if chunk.choices[0].finish_reason is not None:
+                    state["finish_reason"] = chunk.choices[0].finish_reason
+        finally:
+            # also reached when the client went away: stop generating (and paying for) the answer
+            await response.close()
+    
+    async def event_stream():
+        yield sse_event("citations", citations)
         
-        assistant_message = ""
+        state = {"finish_reason": None}
+        deltas = coalesce(cached_deltas(state) if cached_answer is not None else upstream_deltas(state))
+        answer = []
         try:
-            for chunk in response:
-                current_content = chunk.choices[0].delta.content
-                assistant_message += f"{current_content if current_content else ''}"
-                
-                if chunk.choices[0].finish_reason == "stop":
-                    messages_history += [
-                        {"role": "user", "content": prompt},
-                        {"role": "assistant", "content": assistant_message}
-                    ]
-                    assistant_message = ""
-                    await memory_handler()
-                    print(len(messages_history))
-                    
-                yield f"{current_content if current_content else ''}"
-                await asyncio.sleep(0.01)
+            async for text in deltas:
+                if await request.is_disconnected():
+                    rag_streams.inc("disconnected")
+                    return
+                answer.append(text)
+                yield sse_event("delta", {"text": text})
         except Exception as e:
             print("OpenAI Response (Streaming) Error: " + str(e))
+            rag_streams.inc("error")
+            yield sse_event("error", {"message": "The answer could not be generated."})
+            return
+        finally:
+            await deltas.aclose()
+            if cached_answer is None:
+                rag_tokens.inc(amount=timer.tokens)
+        
+        timer.stop()
+        rag_streams.inc("cached" if cached_answer is not None else "completed")
+        if cached_answer is None and timer.first_token is not None:
+            record("rag.ttft", timer.first_token - timer.start)
+            record("rag.generation", timer.end - timer.first_token)
+        answer = "".join(answer)
+        if state["finish_reason"] == "stop":
+            memory.append(session_id, prompt, answer)
+            if cacheable and cached_answer is None:
+                answer_cache.store(prompt_embedding, context_ids, answer)
+        stats = {**timer.stats(), "cached": cached_answer is not None, "finish_reason": state["finish_reason"]}
+        yield sse_event("done", stats)
     
-    return StreamingResponse(response_stream(), media_type="text/event-stream")
\ No newline at end of file
+    # older turns are summarised once the answer was sent, off the response path
+    return StreamingResponse(
+        event_stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(memory.summarize, session_id, summarize_history),
+    )
\ No newline at end of file
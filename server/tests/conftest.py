@@ -0,0 +1,41 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+# the server modules are imported as `utils.x`, from server/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('SCHOLET_OFFLINE', '1')
+os.environ.setdefault('SCHOLET_WARMUP', '0')
+
+from utils.synthetic import install_stubs, write_synthetic_corpus
+
+install_stubs()
+
+_CORPUS_ROWS = 2000
+
+
+@pytest.fixture(scope='session')
+def corpus_dir(tmp_path_factory):
+    # one synthetic corpus per run; tests that write to their data dir copy it first
+    data_dir = str(tmp_path_factory.mktemp('corpus'))
+    write_synthetic_corpus(_CORPUS_ROWS, data_dir, seed=0)
+    return data_dir
+
+
+@pytest.fixture
+def data_dir(corpus_dir, tmp_path):
+    path = str(tmp_path / 'data')
+    shutil.copytree(corpus_dir, path)
+    return path
+
+
+@pytest.fixture
+def store(data_dir):
+    from utils.data import DataStore
+
+    store = DataStore()
+    store.load_data(data_dir)
+    return store
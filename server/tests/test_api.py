@@ -0,0 +1,80 @@
+import json
+import shutil
+import functools
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from utils import executor
+from utils.data import data_store
+from utils.synthetic import StubChatClient
+
+
+@pytest.fixture(scope='module')
+def client(corpus_dir, tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('api') / 'data')
+    shutil.copytree(corpus_dir, data_dir)
+    with pytest.MonkeyPatch.context() as patch:
+        # the lifespan loads the test corpus, and leaves the shared pool running for the other tests
+        patch.setattr(data_store, 'load_data', functools.partial(data_store.load_data, data_dir))
+        patch.setattr(main, 'shutdown', lambda: None)
+        patch.setattr(main, 'async_client', StubChatClient())
+        patch.setattr(executor, '_slots', None)
+        with TestClient(main.app) as client:
+            yield client
+        executor._slots = None
+
+
+def sse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        event, data = block.split('\n')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+def test_tiles_are_revalidated_with_their_etag(client):
+    response = client.get('/tiles/0/0/0')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    revalidated = client.get('/tiles/0/0/0', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b''
+    assert client.get('/tiles/1/2/0').status_code == 404
+
+
+@pytest.mark.parametrize('payload', [{'binsNum': 15, 'clusterNum': 5}, {'binsNum': 20, 'clusterNum': 1}])
+def test_update_rejects_invalid_params(client, payload):
+    assert client.post('/update', json=payload).status_code == 422
+
+
+def test_update_rejects_more_clusters_than_papers(client):
+    assert client.post('/update', json={'binsNum': 20, 'clusterNum': 10 ** 6}).status_code == 400
+
+
+def test_rag_streams_citations_deltas_and_done(client):
+    context = [{'id': '3', 'title': 'A paper', 'author': 'Alice Smith', 'text': 'An abstract.'}]
+    response = client.post('/rag', json={'prompt': 'which papers study graph layout', 'context': context})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+
+    events = sse_events(response.text)
+    assert events[0] == ('citations', [{'id': '3', 'title': 'A paper', 'author': 'Alice Smith'}])
+    assert events[-1][0] == 'done'
+    assert events[-1][1]['finish_reason'] == 'stop'
+    deltas = [data['text'] for event, data in events if event == 'delta']
+    # the stub answers with the words of the question
+    assert ''.join(deltas).split() == 'which papers study graph layout'.split()
+
+
+def test_batch_retrieval_streams_one_record_per_query(client):
+    response = client.post('/retrieval/batch', json={'queries': ['graph layout', 'neural networks'], 'top_k': 5})
+    assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [record['query'] for record in records] == ['graph layout', 'neural networks']
+    assert all(len(record['results']) == 5 for record in records)
+
+    assert client.post('/retrieval/batch', json={'queries': ['a'], 'paper_ids': [1]}).status_code == 400
+    assert client.post('/retrieval/batch', json={'queries': ['a'], 'top_k': 0}).status_code == 400
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.corpus import (
+    RowStack, append_rows, append_corpus, write_corpus, load_corpus, corpus_paths, texts_checksum,
+)
+
+
+def small_corpus(n, start=0, dim=8):
+    rng = np.random.default_rng(start)
+    df = pd.DataFrame({'Title': [f'paper {i}' for i in range(start, start + n)]})
+    return df, rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def test_row_stack_indexes_like_the_concatenation():
+    parts = [np.arange(12, dtype=np.float32).reshape(4, 3), np.arange(12, 18, dtype=np.float32).reshape(2, 3)]
+    stack = RowStack(parts)
+    full = np.concatenate(parts)
+
+    assert stack.shape == full.shape and len(stack) == 6
+    assert np.array_equal(np.asarray(stack), full)
+    assert np.array_equal(stack[4], full[4]) and np.array_equal(stack[-1], full[-1])
+    assert np.array_equal(stack[1:5], full[1:5])
+    assert np.array_equal(stack[::2], full[::2])
+    assert np.array_equal(stack[[5, 0, 3]], full[[5, 0, 3]])
+    assert np.array_equal(stack[full[:, 0] > 4], full[full[:, 0] > 4])
+    assert np.allclose(stack @ np.ones(3, dtype=np.float32), full @ np.ones(3, dtype=np.float32))
+    # a range inside one part is a view of it
+    assert np.shares_memory(stack[0:2], parts[0])
+
+
+def test_append_rows_shares_the_base():
+    base = np.zeros((100, 4), dtype=np.float32)
+    stacked = base
+    for i in range(20):
+        stacked = append_rows(stacked, np.full((2, 4), i, dtype=np.float32))
+
+    assert len(stacked) == 140
+    assert stacked.parts[0] is base
+    assert np.array_equal(stacked[138], np.full(4, 19))
+
+
+def test_delta_shards_reload(tmp_path):
+    data_dir = str(tmp_path)
+    df, embeddings = small_corpus(50)
+    write_corpus(df, embeddings, data_dir)
+    base_mtime = os.path.getmtime(corpus_paths(data_dir)['embeddings'])
+
+    new_df, new_embeddings = small_corpus(5, start=50)
+    append_corpus(new_df, new_embeddings, 50, data_dir)
+    more_df, more_embeddings = small_corpus(3, start=55)
+    append_corpus(more_df, more_embeddings, 55, data_dir)
+
+    loaded_df, loaded_embeddings = load_corpus(data_dir)
+    assert os.path.getmtime(corpus_paths(data_dir)['embeddings']) == base_mtime
+    assert isinstance(loaded_embeddings.parts[0], np.memmap)
+    assert loaded_df['Title'].tolist() == [f'paper {i}' for i in range(58)]
+    assert loaded_df['paper_id'].tolist() == list(range(58))
+    assert np.array_equal(np.asarray(loaded_embeddings), np.concatenate([embeddings, new_embeddings, more_embeddings]))
+
+    # writing the corpus folds the shards in
+    write_corpus(loaded_df, loaded_embeddings, data_dir)
+    assert not os.path.exists(corpus_paths(data_dir)['delta'])
+    assert len(load_corpus(data_dir)[0]) == 58
+
+
+def test_a_shard_with_a_gap_is_rejected(tmp_path):
+    data_dir = str(tmp_path)
+    write_corpus(*small_corpus(10), data_dir)
+    append_corpus(*small_corpus(2, start=12), 12, data_dir)
+    with pytest.raises(ValueError):
+        load_corpus(data_dir)
+
+
+def test_texts_checksum_is_additive_and_order_sensitive():
+    texts = ['a', 'b', None, 'd']
+    assert texts_checksum(texts) == texts_checksum(texts[2:], 2, texts_checksum(texts[:2]))
+    assert texts_checksum(texts) != texts_checksum(['b', 'a', None, 'd'])
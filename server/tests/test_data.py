@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.data import DataStore, _PYRAMID_RESOLUTIONS
+from utils.corpus import corpus_paths
+
+
+def new_papers(n, offset=0):
+    return [
+        {'Title': f'new paper {i}', 'Abstract': f'A study of graph layout number {i}. It has a second sentence.', 'AuthorNames': 'Alice Smith'}
+        for i in range(offset, offset + n)
+    ]
+
+
+@pytest.fixture
+def ingesting_store(store, monkeypatch):
+    # ingests here never trigger the background refit (UMAP is not installed for tests)
+    monkeypatch.setattr(store, 'schedule_refit', lambda: None)
+    return store
+
+
+def test_ingest_places_and_bins_new_papers(ingesting_store):
+    store = ingesting_store
+    start = len(store.snapshot().df)
+
+    paper_ids = store.ingest(new_papers(5))
+
+    df = store.snapshot().df
+    assert paper_ids == list(range(start, start + 5))
+    new = df.iloc[start:]
+    columns = ['umap_x', 'umap_y', 'cluster', 'bin_id', 'umap_x_bin', 'umap_y_bin', 'top_keywords']
+    columns += [f'umap_{axis}_bin_{bins_num}' for bins_num in _PYRAMID_RESOLUTIONS for axis in ('x', 'y')]
+    assert not new[columns].isna().any().any()
+    for bins_num in _PYRAMID_RESOLUTIONS:
+        assert new[f'umap_x_bin_{bins_num}'].between(0, bins_num - 1).all()
+    # the keywords of the cluster each paper was assigned to
+    for _, row in new.iterrows():
+        assert row['top_keywords'] == df.iloc[:start][df['cluster'].iloc[:start] == row['cluster']]['top_keywords'].iloc[0]
+
+
+def test_ingest_is_searchable(ingesting_store):
+    store = ingesting_store
+    [paper_id] = store.ingest(new_papers(1))
+
+    snapshot = store.snapshot()
+    ids, _ = snapshot.index.search(np.asarray(snapshot.embeddings[paper_id]), 1)
+    assert ids[0] == paper_id
+    ids, _ = snapshot.lexical_index.search('new paper 0', 1)
+    assert ids[0] == paper_id
+    assert len(snapshot.sentence_index) == len(snapshot.df)
+
+
+def test_ingest_persists_only_a_delta_shard(ingesting_store, data_dir, capsys):
+    store = ingesting_store
+    paths = corpus_paths(data_dir)
+    base_mtime = os.path.getmtime(paths['embeddings'])
+
+    store.ingest(new_papers(3))
+    store.ingest(new_papers(2, offset=3))
+
+    assert os.path.getmtime(paths['embeddings']) == base_mtime
+    assert len(os.listdir(paths['delta'])) == 4
+
+    capsys.readouterr()
+    reloaded = DataStore()
+    reloaded.load_data(data_dir)
+    # the persisted indexes catch up on the shards instead of being rebuilt
+    assert 'Building' not in capsys.readouterr().out
+    snapshot, reloaded_snapshot = store.snapshot(), reloaded.snapshot()
+    assert len(reloaded_snapshot.df) == len(snapshot.df)
+    assert reloaded_snapshot.df['Title'].tolist() == snapshot.df['Title'].tolist()
+    assert np.allclose(np.asarray(reloaded_snapshot.embeddings), np.asarray(snapshot.embeddings))
+    assert len(reloaded_snapshot.lexical_index) == len(reloaded_snapshot.df)
+
+
+def test_a_pinned_snapshot_is_not_changed_by_ingest(ingesting_store):
+    store = ingesting_store
+    pinned = store.snapshot()
+    rows, titles = len(pinned.df), pinned.df['Title'].tolist()
+    sizes = (len(pinned.embeddings), len(pinned.index), len(pinned.sentence_index), len(pinned.lexical_index))
+
+    store.ingest(new_papers(4))
+
+    current = store.snapshot()
+    assert current.version == pinned.version + 1
+    assert len(current.df) == rows + 4
+    assert len(pinned.df) == rows and pinned.df['Title'].tolist() == titles
+    assert (len(pinned.embeddings), len(pinned.index), len(pinned.sentence_index), len(pinned.lexical_index)) == sizes
+    # searches on the pinned snapshot never return the new rows
+    ids, _ = pinned.lexical_index.search('new paper', 10)
+    assert np.all(ids < rows)
+
+
+def test_update_params_publishes_a_view_of_the_same_version(store):
+    before = store.snapshot()
+    after = store.update_params(20, 6)
+
+    assert after.version == before.version
+    assert after.view_key() == (before.version, 20, 6)
+    level = store.get_level(20, 6, after)
+    assert len(level['cluster']) == len(after.df)
+    assert level['cluster'].max() < 6
+
+
+def test_a_failing_update_keeps_the_current_view(store, monkeypatch):
+    before = store.snapshot().view_key()
+
+    def fail(*args):
+        raise RuntimeError('clustering failed')
+
+    monkeypatch.setattr(store, '_compute_level', fail)
+    with pytest.raises(RuntimeError):
+        store.update_params(24, 7)
+    assert store.snapshot().view_key() == before
@@ -0,0 +1,45 @@
+import time
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from utils import executor
+
+
+@pytest.fixture(autouse=True)
+def fresh_slots(monkeypatch):
+    # the semaphore binds to the event loop of its first use, each test runs its own
+    monkeypatch.setattr(executor, '_slots', None)
+
+
+def test_run_blocking_returns_the_result():
+    assert asyncio.run(executor.run_blocking(sum, [1, 2, 3])) == 6
+
+
+def test_a_timed_out_call_keeps_its_slot_until_it_finishes():
+    async def scenario():
+        with pytest.raises(HTTPException) as error:
+            await executor.run_blocking(time.sleep, 0.3, timeout=0.05)
+        assert error.value.status_code == 504
+        slots = executor._get_slots()
+        # still running in the pool, so still counted
+        held = executor._MAX_PENDING - slots._value
+        await asyncio.sleep(0.4)
+        return held, executor._MAX_PENDING - slots._value
+
+    held, after = asyncio.run(scenario())
+    assert held == 1
+    assert after == 0
+
+
+def test_calls_beyond_the_queue_bound_are_rejected(monkeypatch):
+    monkeypatch.setattr(executor, '_QUEUE_TIMEOUT', 0.05)
+
+    async def scenario():
+        calls = [executor.run_blocking(time.sleep, 0.2, timeout=1) for _ in range(executor._MAX_PENDING + 1)]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    rejected = [result for result in results if isinstance(result, HTTPException)]
+    assert [error.status_code for error in rejected] == [503]
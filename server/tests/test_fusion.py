@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from utils.fusion import reciprocal_rank_fusion, _RRF_K
+from utils.rag import determine_top_k
+
+
+def brute_force_rrf(ranked_lists, weights, k=_RRF_K):
+    scores = {}
+    for ids, weight in zip(ranked_lists, weights):
+        for rank, row in enumerate(ids):
+            scores[row] = scores.get(row, 0.0) + weight / (rank + k)
+    return scores
+
+
+def test_rrf_matches_brute_force():
+    rng = np.random.default_rng(0)
+    ranked_lists = [rng.choice(500, 100, replace=False) for _ in range(4)]
+    weights = [1.0, 0.5, 2.0, 1.0]
+
+    ids, scores = reciprocal_rank_fusion(ranked_lists, weights)
+
+    expected = brute_force_rrf(ranked_lists, weights)
+    assert sorted(ids.tolist()) == sorted(expected)
+    assert np.allclose(scores, [expected[row] for row in ids])
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_rrf_rewards_rows_ranked_by_several_lists():
+    ids, _ = reciprocal_rank_fusion([[1, 2, 3], [3, 4, 5], [3, 1, 6]])
+    assert ids[0] == 3
+    assert ids[1] == 1
+
+
+def test_rrf_top_k_is_the_head_of_the_full_ranking():
+    rng = np.random.default_rng(1)
+    ranked_lists = [rng.choice(1000, 200, replace=False) for _ in range(3)]
+
+    all_ids, all_scores = reciprocal_rank_fusion(ranked_lists)
+    ids, scores = reciprocal_rank_fusion(ranked_lists, top_k=10)
+
+    assert np.allclose(scores, all_scores[:10])
+    assert set(ids) <= set(all_ids[:20])
+
+
+def test_rrf_depth_and_weight_validation():
+    ids, _ = reciprocal_rank_fusion([[1, 2, 3, 4]], depth=2)
+    assert sorted(ids.tolist()) == [1, 2]
+
+    with pytest.raises(ValueError):
+        reciprocal_rank_fusion([[1], [2]], weights=[1.0])
+
+    ids, scores = reciprocal_rank_fusion([[], []])
+    assert len(ids) == 0 and len(scores) == 0
+
+
+def test_determine_top_k_cuts_at_the_first_gap():
+    scores = [0.9, 0.89, 0.88, 0.87, 0.86, 0.85, 0.84, 0.6, 0.59, 0.58, 0.57, 0.56, 0.55]
+    assert determine_top_k(scores) == 7
+
+
+def test_determine_top_k_is_clipped():
+    # a gap right after the best score still keeps 5, no gap at all keeps at most 12
+    assert determine_top_k([0.9] + [0.5 - i * 0.001 for i in range(20)]) == 5
+    assert determine_top_k([0.5] * 30) == 12
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from utils.index import (
+    ExactIndex, IVFIndex, SQ8Index, FP16Index, normalize, load_or_build_index, top_k_indices,
+)
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    # clustered like real embeddings, so the inverted lists of IVF are meaningful
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((30, 64))
+    return normalize(centers[rng.integers(0, 30, 3000)] + 0.6 * rng.standard_normal((3000, 64))).astype(np.float32)
+
+
+def brute_force(vectors, queries, top_k, rows=None):
+    scores = normalize(queries) @ vectors.T
+    if rows is not None:
+        masked = np.full_like(scores, -np.inf)
+        masked[:, rows] = scores[:, rows]
+        scores = masked
+    return np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+
+
+def recall(ids, expected):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, expected)])
+
+
+def test_top_k_indices_is_sorted_best_first():
+    scores = np.random.default_rng(1).standard_normal(1000)
+    assert np.array_equal(top_k_indices(scores, 10), np.argsort(-scores)[:10])
+    assert len(top_k_indices(scores[:3], 10)) == 3
+
+
+def test_exact_index_matches_brute_force(vectors):
+    queries = vectors[:20] + 0.1
+    rows = np.arange(0, 3000, 7)
+    index = ExactIndex(64).build(vectors)
+
+    ids, scores = index.search_many(queries, 10)
+    assert np.array_equal(ids, brute_force(vectors, queries, 10))
+    assert np.all(np.diff(scores, axis=1) <= 1e-6)
+    ids, _ = index.search_many(queries, 10, rows)
+    assert np.array_equal(ids, brute_force(vectors, queries, 10, rows))
+
+
+@pytest.mark.parametrize('kind, min_recall', [(SQ8Index, 0.95), (FP16Index, 0.99), (IVFIndex, 0.8)])
+def test_approximate_indexes_recall(vectors, kind, min_recall):
+    queries = vectors[:50] + 0.05
+    index = kind(64).build(vectors)
+    ids, _ = index.search_many(queries, 10)
+    assert recall(ids, brute_force(vectors, queries, 10)) >= min_recall
+
+
+def test_quantized_index_keeps_only_codes_in_ram_once_saved(vectors, tmp_path):
+    index = SQ8Index(64).build(vectors)
+    index.save(str(tmp_path))
+    assert isinstance(index.vectors, np.memmap)
+
+    index.add(vectors[:5])
+    ids, _ = index.search(vectors[2], 2)
+    assert set(ids) == {2, 3002}
+
+
+def test_load_or_build_index_catches_up_and_rebuilds(vectors, tmp_path, capsys):
+    data_dir = str(tmp_path)
+    index = load_or_build_index(vectors[:2000], data_dir, kind='exact')
+    assert len(index) == 2000
+
+    capsys.readouterr()
+    index = load_or_build_index(vectors, data_dir, kind='exact')
+    assert len(index) == 3000
+    assert 'Building' not in capsys.readouterr().out
+
+    other = normalize(np.random.default_rng(5).standard_normal((3000, 64)).astype(np.float32))
+    index = load_or_build_index(other, data_dir, kind='exact')
+    assert 'different corpus' in capsys.readouterr().out
+    ids, _ = index.search(other[7], 1)
+    assert ids[0] == 7
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from utils.lexical import BM25Index, load_or_build_lexical_index, lexical_texts, tokenize, _K1, _B
+
+_WORDS = [f'w{i}' for i in range(300)]
+
+
+def random_texts(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # a few frequent words and a long tail, so posting lists have very different lengths
+    p = np.r_[np.full(10, 0.05), np.full(290, 0.5 / 290)]
+    return [' '.join(rng.choice(_WORDS, size=rng.integers(0, 30), p=p)) for _ in range(n)]
+
+
+def brute_force_bm25(texts, query, k1=_K1, b=_B):
+    documents = [tokenize(text) for text in texts]
+    lengths = np.array([len(document) for document in documents], dtype=np.float64)
+    avgdl = max(lengths.mean(), 1.0)
+    scores = np.zeros(len(documents))
+    for term in set(tokenize(query)):
+        tf = np.array([document.count(term) for document in documents], dtype=np.float64)
+        df = np.count_nonzero(tf)
+        if df == 0:
+            continue
+        idf = np.log1p((len(documents) - df + 0.5) / (df + 0.5))
+        scores += np.where(tf > 0, idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths / avgdl)), 0)
+    return scores
+
+
+def assert_matches_brute_force(index, texts, queries, rows=None):
+    for query in queries:
+        expected = brute_force_bm25(texts, query)
+        if rows is not None:
+            expected = expected[rows]
+        expected = np.sort(expected[expected > 0])[::-1][:10]
+        ids, scores = index.search(query, 10, rows)
+        assert np.allclose(scores, expected, rtol=1e-4), query
+        assert np.all(np.diff(scores) <= 1e-6)
+
+
+_QUERIES = ['w0 w5 w200', 'w1', 'w299 w150 w2 w3', 'w100 w101 w0', 'unknown words only']
+
+
+def test_max_score_matches_brute_force():
+    texts = random_texts(3000)
+    assert_matches_brute_force(BM25Index().build(texts), texts, _QUERIES)
+
+
+def test_filtered_search_matches_brute_force():
+    texts = random_texts(2000)
+    rows = np.random.default_rng(1).choice(len(texts), 200, replace=False)
+    assert_matches_brute_force(BM25Index().build(texts), texts, _QUERIES, rows)
+
+
+def test_incremental_add_matches_a_full_build():
+    texts = random_texts(3000)
+    index = BM25Index().build(texts[:1000])
+    copy = index.copy()
+    for start in range(1000, 3000, 100):
+        index.add(texts[start:start + 100])
+
+    assert len(index) == 3000
+    assert_matches_brute_force(index, texts, _QUERIES)
+    # the copy taken before is untouched
+    assert len(copy) == 1000
+    assert_matches_brute_force(copy, texts[:1000], _QUERIES)
+
+
+def test_save_and_load(tmp_path):
+    texts = random_texts(1500)
+    index = BM25Index().build(texts[:1000])
+    index.add(texts[1000:])
+    index.save(str(tmp_path))
+
+    loaded = BM25Index().load(str(tmp_path))
+    assert len(loaded) == 1500
+    assert loaded.checksum == BM25Index().build(texts).checksum
+    assert_matches_brute_force(loaded, texts, _QUERIES)
+
+
+def test_load_or_build_catches_up_and_rebuilds_for_another_corpus(tmp_path):
+    df = pd.DataFrame({'Title': random_texts(300, seed=1), 'Abstract': random_texts(300, seed=2)})
+    index = load_or_build_lexical_index(df.iloc[:200], str(tmp_path))
+    assert len(index) == 200
+
+    index = load_or_build_lexical_index(df, str(tmp_path))
+    assert index.checksum == BM25Index().build(lexical_texts(df)).checksum
+
+    other = df.copy()
+    other.loc[0, 'Title'] = 'a different paper'
+    index = load_or_build_lexical_index(other, str(tmp_path))
+    assert index.checksum == BM25Index().build(lexical_texts(other)).checksum
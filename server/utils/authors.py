@@ -0,0 +1,120 @@
+import re
+import bisect
+import difflib
+import unicodedata
+from threading import Lock
+
+import numpy as np
+
+_AUTHOR_COLUMNS = ['AuthorNames', 'AuthorNames-Deduped']
+_FUZZY_CUTOFF = 0.85
+_FUZZY_MATCHES = 5
+
+
+def normalize_name(name):
+    """
+    Lower-case, accent-free, punctuation-free name with single spaces, so that
+    "Jean-Daniel Fekete" and "jean daniel  fekete" index the same.
+    """
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    return ' '.join(re.sub(r'[^\w\s]', ' ', name).split())
+
+
+def split_authors(value):
+    if not isinstance(value, str):
+        return []
+    return [name for name in (normalize_name(author) for author in value.split(';')) if name]
+
+
+class AuthorIndex:
+    """
+    Normalised author name -> row ids of their papers, plus paper_id -> row id. Names
+    can be looked up exactly, by a prefix starting at any word ("smith" finds
+    "john smith"), or fuzzily when neither matches.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.id_rows = {}
+        self._suffixes = None
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.postings)
+
+    def build(self, df):
+        self.postings = {}
+        self.id_rows = {}
+        self._suffixes = None
+        return self.add(df, 0)
+
+    def add(self, df, start):
+        """
+        Index rows start..start + len(df) - 1 (the rows appended to the corpus).
+        """
+        columns = [column for column in _AUTHOR_COLUMNS if column in df.columns]
+        with self._lock:
+            for offset, values in enumerate(zip(*(df[column].values for column in columns))):
+                row = start + offset
+                for name in {name for value in values for name in split_authors(value)}:
+                    self.postings.setdefault(name, []).append(row)
+            paper_ids = df['paper_id'].values if 'paper_id' in df.columns else np.arange(start, start + len(df))
+            self.id_rows.update(zip(paper_ids.tolist(), range(start, start + len(df))))
+            self._suffixes = None
+        return self
+
+    def copy(self):
+        # add() appends to the posting lists in place, so they are copied too
+        clone = AuthorIndex()
+        with self._lock:
+            clone.postings = {name: list(rows) for name, rows in self.postings.items()}
+            clone.id_rows = dict(self.id_rows)
+        return clone
+
+    def lookup(self, name):
+        """
+        Row ids of the papers of the best matching authors, as a sorted array.
+        """
+        name = normalize_name(name)
+        if not name:
+            return np.empty(0, dtype=np.int64)
+        if name in self.postings:
+            return np.unique(self.postings[name])
+
+        names = self._prefix_matches(name)
+        if not names:
+            names = difflib.get_close_matches(name, list(self.postings), n=_FUZZY_MATCHES, cutoff=_FUZZY_CUTOFF)
+        return self._rows_of(names)
+
+    def paper_rows(self, paper_ids):
+        return np.unique(np.array([self.id_rows[paper_id] for paper_id in paper_ids if paper_id in self.id_rows], dtype=np.int64))
+
+    def filter_rows(self, researchers=(), paper_ids=()):
+        """
+        Sorted row ids matching any of the researchers or paper ids, used as the
+        candidate set of a filtered vector search.
+        """
+        rows = [self.lookup(name) for name in researchers] + [self.paper_rows(paper_ids)]
+        return np.unique(np.concatenate(rows)).astype(np.int64)
+
+    def _rows_of(self, names):
+        if not names:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.postings[name] for name in names])).astype(np.int64)
+
+    def _prefix_matches(self, prefix):
+        # (suffix starting at a word boundary, full name), sorted for bisection
+        with self._lock:
+            if self._suffixes is None:
+                suffixes = []
+                for name in self.postings:
+                    words = name.split(' ')
+                    suffixes += [(' '.join(words[i:]), name) for i in range(len(words))]
+                suffixes.sort()
+                self._suffixes = ([suffix for suffix, _ in suffixes], [name for _, name in suffixes])
+            keys, names = self._suffixes
+
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_right(keys, prefix + '\uffff')
+        return sorted(set(names[start:end]))
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from utils.synthetic import write_synthetic_corpus, install_stubs, StubChatClient
+
+_SIZES = (10000,)
+_REPEAT = 5
+_BENCHMARK_DIR = './data/benchmark'
+_BIN_COUNTS = (10, 20, 30)
+_QUERIES = 8
+# a benchmark counts as regressed when its median is this much slower than the baseline
+_REGRESSION_THRESHOLD = 0.1
+
+
+def measure(fn, repeat=_REPEAT, warmup=1, setup=None):
+    """
+    Run fn() warmup + repeat times (setup() untimed before each) and summarise the
+    timed runs in milliseconds.
+    """
+    times = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'min_ms': float(times.min()),
+        'mean_ms': float(times.mean()),
+        'repeat': len(times),
+    }
+
+
+def _request(accept_encoding=''):
+    from starlette.requests import Request
+
+    headers = [(b'accept-encoding', accept_encoding.encode())] if accept_encoding else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/data', 'headers': headers, 'query_string': b''})
+
+
+def corpus_dir(rows, seed=0, base_dir=_BENCHMARK_DIR):
+    """
+    Directory of the synthetic corpus of the given size, generated on first use.
+    """
+    data_dir = os.path.join(base_dir, f'{rows}-{seed}')
+    if not os.path.exists(os.path.join(data_dir, 'ieee_vis_embeddings.npy')):
+        write_synthetic_corpus(rows, data_dir, seed)
+    return data_dir
+
+
+def run_suite(rows, repeat=_REPEAT, seed=0, base_dir=_BENCHMARK_DIR):
+    """
+    Time the hot paths on a synthetic corpus of `rows` papers, with the embedding
+    model and the LLM stubbed. Returns {benchmark name: timing summary}.
+    """
+    from utils.data import DataStore, data_store, data_binning
+    from utils.fusion import reciprocal_rank_fusion
+    from utils.export import export_response, _bodies
+    from utils import rag
+
+    data_dir = corpus_dir(rows, seed, base_dir)
+    results = {}
+
+    def record(name, summary):
+        results[name] = summary
+        print(f"{rows:>9} {name:<40} {summary['median_ms']:>10.2f} ms (p95 {summary['p95_ms']:.2f})")
+
+    # load_data, cold builds the vector/sentence/BM25 indexes, warm loads them
+    def clear_indexes():
+        for name in ('ieee_vis_index', 'ieee_vis_sentences', 'ieee_vis_bm25'):
+            shutil.rmtree(os.path.join(data_dir, name), ignore_errors=True)
+
+    record('load_data_cold', measure(lambda: DataStore().load_data(data_dir), repeat=1, warmup=0, setup=clear_indexes))
+    record('load_data_warm', measure(lambda: DataStore().load_data(data_dir), repeat=max(1, repeat // 2)))
+
+    data_store.load_data(data_dir)
+    snapshot = data_store.snapshot()
+    df = snapshot.df
+    rng = np.random.default_rng(seed)
+    queries = [' '.join(abstract.split()[:6]) for abstract in df['Abstract'].values[rng.choice(len(df), _QUERIES, replace=False)]]
+    authors = df['AuthorNames'].str.split(';').explode().value_counts()
+    prolific, occasional = authors.index[0], authors.index[len(authors) // 2]
+    query_index = iter(range(10 ** 9))
+
+    def next_query(prefix=''):
+        return prefix + queries[next(query_index) % len(queries)]
+
+    # retrieval() memoises results, clear the cache so every run computes
+    record('retrieval', measure(lambda: rag.retrieval(next_query()), repeat, setup=rag.retrieval_cache.clear))
+    record('retrieval_filter_prolific_author', measure(lambda: rag.retrieval(next_query(f'[[Researcher: {prolific}]] ')), repeat, setup=rag.retrieval_cache.clear))
+    record('retrieval_filter_occasional_author', measure(lambda: rag.retrieval(next_query(f'[[Researcher: {occasional}]] ')), repeat, setup=rag.retrieval_cache.clear))
+    record('retrieval_cached', measure(lambda: rag.retrieval(queries[0]), repeat))
+
+    rag.async_client = StubChatClient()
+    expansions = asyncio.run(rag.generate_queries(queries[0]))
+    record('compute_fused_results_expanded', measure(lambda: rag.compute_fused_results(queries[0], df, None, expansions, snapshot=snapshot), repeat))
+    record('compute_fused_results_dense_only', measure(lambda: rag.compute_fused_results(queries[0], df, None, None, hybrid=False, snapshot=snapshot), repeat))
+
+    ranked_lists = [rng.choice(len(df), min(100, len(df)), replace=False) for _ in range(7)]
+    record('reciprocal_rank_fusion', measure(lambda: reciprocal_rank_fusion(ranked_lists), repeat * 20))
+
+    aggregator = data_store.get_keyword_aggregator(snapshot)
+    level_df = df[['umap_x', 'umap_y', 'Abstract']].copy()
+    for bins_num in _BIN_COUNTS:
+        record(f'data_binning_{bins_num}', measure(lambda: data_binning(level_df.copy(), bins_num, aggregator), repeat))
+
+    def clear_levels():
+        data_store.levels.clear()
+        data_store.clustering.results.clear()
+
+    for bins_num in _BIN_COUNTS:
+        record(f'update_params_{bins_num}', measure(lambda: data_store.get_view(data_store.update_params(bins_num, 5)), repeat, setup=clear_levels))
+    record('update_params_cached', measure(lambda: data_store.get_view(data_store.update_params(_BIN_COUNTS[0], 5)), repeat))
+
+    # /data serialisation, with the response body cache cleared before every run
+    view = data_store.get_view()
+    view_key = data_store.snapshot().view_key()
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for name, format, encoding in (('json', 'json', ''), ('json_gzip', 'json', 'gzip'), ('columnar', 'columnar', ''), ('arrow', 'arrow', '')):
+        record(f'data_{name}', measure(lambda: export_response(_request(encoding), view, view_key, date, format=format), repeat, setup=_bodies.clear))
+    record('data_all_columns_json', measure(lambda: export_response(_request(), view, view_key, date, columns='all'), repeat, setup=_bodies.clear))
+    return results
+
+
+def compare(results, baseline, threshold=_REGRESSION_THRESHOLD):
+    """
+    Median of every benchmark relative to the baseline report, flagged as a
+    regression or improvement when it moved by more than threshold.
+    """
+    comparison = {}
+    for size, benchmarks in results.items():
+        for name, summary in benchmarks.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            ratio = summary['median_ms'] / max(previous['median_ms'], 1e-9)
+            status = 'regression' if ratio > 1 + threshold else 'improvement' if ratio < 1 - threshold else 'unchanged'
+            comparison.setdefault(size, {})[name] = {'baseline_ms': previous['median_ms'], 'median_ms': summary['median_ms'], 'ratio': ratio, 'status': status}
+    return comparison
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on synthetic corpora, offline.")
+    parser.add_argument('--rows', type=int, nargs='+', default=list(_SIZES), help="corpus sizes, e.g. 10000 100000 1000000")
+    parser.add_argument('--repeat', type=int, default=_REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=_BENCHMARK_DIR, help="where the synthetic corpora are generated and kept")
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="earlier report to compare against")
+    parser.add_argument('--threshold', type=float, default=_REGRESSION_THRESHOLD)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    # nothing leaves the machine: stub models, and a key the stubbed LLM never uses
+    os.environ.setdefault('OPENAI_API_KEY', 'offline-benchmark')
+    install_stubs()
+
+    results = {str(rows): run_suite(rows, args.repeat, args.seed, args.data_dir) for rows in args.rows}
+    report = {'environment': environment(), 'repeat': args.repeat, 'seed': args.seed, 'results': results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(results, json.load(f), args.threshold)
+        for size, benchmarks in report['comparison'].items():
+            for name, row in benchmarks.items():
+                print(f"{size:>9} {name:<40} {row['baseline_ms']:>10.2f} -> {row['median_ms']:>10.2f} ms  x{row['ratio']:.2f} {row['status']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    regressions = [name for benchmarks in report.get('comparison', {}).values() for name, row in benchmarks.items() if row['status'] == 'regression']
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
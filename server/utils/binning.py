@@ -0,0 +1,90 @@
+import copy
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from utils.index import top_k_indices
+
+_SUMMARY_RATIO = 0.1
+
+
+def text_column(df):
+    # uploaded papers carry 'content'; the IEEE VIS corpus only has 'Abstract'
+    return 'content' if 'content' in df.columns else 'Abstract'
+
+
+def group_indicator(codes, n_groups):
+    """
+    Sparse (n_groups x n_rows) matrix with a 1 where row i belongs to group codes[i].
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    return sparse.csr_matrix(
+        (np.ones(len(codes), dtype=np.float32), (codes, np.arange(len(codes)))),
+        shape=(n_groups, len(codes)),
+    )
+
+
+class KeywordAggregator:
+    """
+    One corpus-wide sparse TF-IDF matrix, fitted once. Keywords for any grouping of
+    the rows (bins, clusters, tiles) are the top terms of the group-summed TF-IDF rows.
+    """
+
+    def __init__(self, texts, stop_words='english'):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        self.vectorizer = TfidfVectorizer(stop_words=stop_words, dtype=np.float32)
+        self.matrix = self.vectorizer.fit_transform(pd.Series(texts).fillna('').astype(str)).tocsr()
+        self.feature_names = self.vectorizer.get_feature_names_out()
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def add(self, texts):
+        # new rows are scored with the existing vocabulary and idf weights
+        rows = self.vectorizer.transform(pd.Series(texts).fillna('').astype(str))
+        self.matrix = sparse.vstack([self.matrix, rows]).tocsr()
+
+    def copy(self):
+        # add() rebinds the matrix and never refits, so the copy can be extended independently
+        return copy.copy(self)
+
+    def group_scores(self, codes, n_groups, rows=None):
+        # codes label every row of the corpus, or only the given rows
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = (group_indicator(codes, n_groups) @ matrix).tocsr()
+        scores.sort_indices()
+        return scores
+
+    def top_keywords(self, codes, n_groups, top_n, rows=None):
+        scores = self.group_scores(codes, n_groups, rows)
+        keywords = []
+        for group in range(n_groups):
+            start, end = scores.indptr[group], scores.indptr[group + 1]
+            data, terms = scores.data[start:end], scores.indices[start:end]
+            best = top_k_indices(data, top_n)
+            best = best[data[best] > 0]
+            keywords.append(self.feature_names[terms[best]].tolist())
+        return keywords
+
+
+def longest_texts_summary(texts, codes, n_groups, ratio=_SUMMARY_RATIO):
+    """
+    Per group, the longest int(ratio * group size) texts (at least one), longest first,
+    joined with spaces.
+    """
+    texts = pd.Series(texts).fillna('').astype(str).values
+    codes = np.asarray(codes, dtype=np.int64)
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+
+    # stable sort by group, then by length descending (ties keep their original order)
+    order = np.lexsort((-lengths, codes))
+    sorted_codes = codes[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+
+    counts = np.bincount(codes, minlength=n_groups)
+    select = np.maximum((counts * ratio).astype(np.int64), 1)
+    keep = rank < select[sorted_codes]
+
+    summaries = pd.Series(texts[order][keep]).groupby(sorted_codes[keep], sort=True).agg(' '.join)
+    return summaries.reindex(range(n_groups), fill_value='').tolist()
@@ -1,6 +1,20 @@
 import os
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 load_dotenv()
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
\ No newline at end of file
+
+_LLM_TIMEOUT = float(os.environ.get('SCHOLET_LLM_TIMEOUT', 60))
+_LLM_MAX_CONNECTIONS = int(os.environ.get('SCHOLET_LLM_MAX_CONNECTIONS', 32))
+
+# one pooled client for all requests served on the event loop
+async_client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    timeout=_LLM_TIMEOUT,
+    max_retries=2,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=_LLM_MAX_CONNECTIONS, max_keepalive_connections=_LLM_MAX_CONNECTIONS),
+        timeout=_LLM_TIMEOUT,
+    ),
+)
@@ -0,0 +1,143 @@
+import os
+import numpy as np
+
+from utils.cache import LRUCache
+
+_CLUSTER_SPACE = os.environ.get('SCHOLET_CLUSTER_SPACE', 'embeddings')  # 'embeddings' | 'umap' | 'pca'
+_CLUSTER_CACHE_SIZE = 16
+_PCA_COMPONENTS = 32
+_PCA_FIT_SAMPLE = 50000
+_MINIBATCH_MIN_ROWS = 50000
+_MINIBATCH_SIZE = 4096
+
+
+def assign_to_centroids(features, centroids):
+    """
+    Nearest centroid (Euclidean) of every row. Returns (labels, distances).
+    """
+    features = np.asarray(features, dtype=np.float32)
+    centroids = np.asarray(centroids, dtype=np.float32)
+    squared = (features ** 2).sum(axis=1)[:, None] - 2 * features @ centroids.T + (centroids ** 2).sum(axis=1)
+    labels = np.argmin(squared, axis=1)
+    return labels, np.sqrt(np.maximum(squared[np.arange(len(features)), labels], 0))
+
+
+class ClusteringService:
+    """
+    KMeans results memoised per (space, n_clusters, data version). A new cluster count
+    is warm-started from the cached result with the closest count, and large corpora
+    switch to MiniBatchKMeans.
+    """
+
+    def __init__(self, space=_CLUSTER_SPACE, maxsize=_CLUSTER_CACHE_SIZE, minibatch_min_rows=_MINIBATCH_MIN_ROWS):
+        if space not in ('embeddings', 'umap', 'pca'):
+            raise ValueError(f"Unknown clustering space: {space}")
+        self.space = space
+        self.minibatch_min_rows = minibatch_min_rows
+        self.results = LRUCache(maxsize)
+        self._features = LRUCache(2)
+        self._pca = None
+
+    def features(self, df, embeddings, version):
+        """
+        The matrix clustered in the configured space: the raw embeddings, the 2-D UMAP
+        coordinates, or a PCA reduction of the embeddings.
+        """
+        if self.space == 'embeddings':
+            return embeddings
+
+        def compute():
+            if self.space == 'umap':
+                return np.ascontiguousarray(df[['umap_x', 'umap_y']].values, dtype=np.float32)
+            from sklearn.decomposition import PCA
+
+            sample = embeddings
+            if len(sample) > _PCA_FIT_SAMPLE:
+                sample = sample[np.sort(np.random.default_rng(0).choice(len(sample), _PCA_FIT_SAMPLE, replace=False))]
+            self._pca = PCA(n_components=min(_PCA_COMPONENTS, *sample.shape), random_state=0).fit(sample)
+            return self._pca.transform(embeddings).astype(np.float32)
+
+        return self._features.get_or_compute((self.space, version), compute)
+
+    def advance(self, version, new_version, new_df, new_embeddings):
+        """
+        Carry the cached results of `version` over to `new_version` after rows were
+        appended, assigning the new rows to the nearest existing centroid.
+        """
+        if self.space == 'embeddings':
+            new_features = np.asarray(new_embeddings, dtype=np.float32)
+        elif self.space == 'umap':
+            new_features = np.ascontiguousarray(new_df[['umap_x', 'umap_y']].values, dtype=np.float32)
+        elif self._pca is not None:
+            new_features = self._pca.transform(new_embeddings).astype(np.float32)
+        else:
+            return
+
+        features = self._features.get((self.space, version))
+        if features is not None:
+            self._features.put((self.space, new_version), np.vstack([features, new_features]))
+        elif self.space != 'embeddings':
+            return
+
+        for key in self.results.keys():
+            if key[0] == self.space and key[2] == version:
+                labels, centroids = self.results.get(key)
+                new_labels, _ = assign_to_centroids(new_features, centroids)
+                self.results.put((self.space, key[1], new_version), (np.concatenate([labels, new_labels]), centroids))
+
+    def cluster(self, df, embeddings, n_clusters, version):
+        """
+        Returns (labels, centroids) for n_clusters clusters of the current data version.
+        """
+        n_clusters = min(n_clusters, len(df))
+        key = (self.space, n_clusters, version)
+        result = self.results.get(key)
+        if result is not None:
+            return result
+
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        features = self.features(df, embeddings, version)
+        init = self._warm_start(features, n_clusters, version)
+        n_init = 1 if init is not None else 'auto'
+        init = 'k-means++' if init is None else init
+
+        if len(features) >= self.minibatch_min_rows:
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=n_init, batch_size=_MINIBATCH_SIZE, random_state=0)
+        else:
+            kmeans = KMeans(n_clusters=n_clusters, init=init, n_init=n_init, random_state=0)
+
+        labels = kmeans.fit_predict(features)
+        result = (labels, kmeans.cluster_centers_.astype(np.float32))
+        self.results.put(key, result)
+        return result
+
+    def _warm_start(self, features, n_clusters, version):
+        # nearest cached cluster count for the same space and data version
+        neighbours = [key for key in self.results.keys() if key[0] == self.space and key[2] == version]
+        if not neighbours:
+            return None
+        _, neighbour_k, _ = min(neighbours, key=lambda key: abs(key[1] - n_clusters))
+        labels, centroids = self.results.get((self.space, neighbour_k, version))
+
+        if neighbour_k >= n_clusters:
+            # keep the centroids of the largest neighbouring clusters
+            sizes = np.bincount(labels, minlength=neighbour_k)
+            return centroids[np.argsort(-sizes, kind='stable')[:n_clusters]]
+
+        # add the missing centroids with k-means++ style sampling
+        rng = np.random.default_rng(0)
+        sample = features[rng.choice(len(features), min(len(features), 10000), replace=False)]
+        sample = np.asarray(sample, dtype=np.float64)
+        sample_norms = (sample ** 2).sum(axis=1)
+        distances = (sample_norms[:, None] - 2 * sample @ centroids.T + (centroids ** 2).sum(axis=1)).min(axis=1)
+        init = list(centroids)
+        for _ in range(n_clusters - neighbour_k):
+            distances = np.maximum(distances, 0)
+            if distances.sum() == 0:
+                centroid = sample[rng.integers(len(sample))]
+            else:
+                centroid = sample[rng.choice(len(sample), p=distances / distances.sum())]
+            init.append(centroid)
+            distances = np.minimum(distances, sample_norms - 2 * sample @ centroid + centroid @ centroid)
+        return np.asarray(init, dtype=features.dtype)
@@ -0,0 +1,250 @@
+import os
+import glob
+import zlib
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+_DATA_DIR = './data'
+_CORPUS_NAME = 'ieee_vis'
+_EMBEDDING_DIM = 384
+_CHUNK_SIZE = 20000
+# appended row blocks kept apart before the small ones are merged (the base is never copied)
+_MAX_PARTS = 8
+_CHECKSUM_MODULUS = 2 ** 61 - 1
+
+
+def corpus_paths(data_dir=_DATA_DIR, name=_CORPUS_NAME):
+    return {
+        'csv': os.path.join(data_dir, f'{name}_embed.csv'),
+        'embeddings': os.path.join(data_dir, f'{name}_embeddings.npy'),
+        'metadata': os.path.join(data_dir, f'{name}_metadata.parquet'),
+        'delta': os.path.join(data_dir, f'{name}_delta'),
+    }
+
+
+class RowStack:
+    """
+    Read-only row-wise concatenation of 2-D arrays, typically a memory-mapped base
+    matrix and the blocks of rows appended since. Indexed and multiplied like a single
+    array without ever copying the base; np.asarray() materialises it.
+    """
+
+    def __init__(self, parts):
+        self.parts = tuple(parts)
+        self.offsets = np.concatenate([[0], np.cumsum([len(part) for part in self.parts])])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.parts[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self.parts[0].dtype
+
+    @property
+    def ndim(self):
+        return self.parts[0].ndim
+
+    def __array__(self, dtype=None, copy=None):
+        return np.concatenate([np.asarray(part, dtype=dtype) for part in self.parts])
+
+    def __matmul__(self, other):
+        return np.concatenate([part @ other for part in self.parts])
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            key = key + len(self) if key < 0 else key
+            part = np.searchsorted(self.offsets, key, side='right') - 1
+            return self.parts[part][key - self.offsets[part]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            pieces = []
+            for part, offset in zip(self.parts, self.offsets):
+                lo, hi = max(start - offset, 0), min(stop - offset, len(part))
+                if lo < hi:
+                    pieces.append(part[lo:hi])
+            # a range inside one part stays a view, e.g. a block of the memory-mapped base
+            if len(pieces) == 1:
+                return pieces[0]
+            return np.concatenate(pieces) if pieces else self.parts[0][:0]
+
+        rows = np.asarray(key)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + len(self), rows).astype(np.int64)
+        owners = np.searchsorted(self.offsets, rows, side='right') - 1
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        for part in np.unique(owners):
+            mask = owners == part
+            out[mask] = self.parts[part][rows[mask] - self.offsets[part]]
+        return out.reshape(rows.shape + self.shape[1:])
+
+
+def append_rows(array, rows):
+    """
+    `array` with `rows` appended, sharing (not copying) the rows of `array`.
+    """
+    if len(rows) == 0:
+        return array
+    if len(array) == 0:
+        return rows
+    parts = array.parts if isinstance(array, RowStack) else (array,)
+    parts = parts + (rows,)
+    if len(parts) > _MAX_PARTS:
+        # the appended blocks are small next to the base, merge them into one
+        parts = (parts[0], np.concatenate([np.asarray(part) for part in parts[1:]]))
+    return RowStack(parts)
+
+
+def texts_checksum(texts, start=0, checksum=0):
+    """
+    Order-sensitive checksum of the texts of papers start, start + 1, ..., added to
+    `checksum` (the checksum of papers 0..start-1), so an index can extend it as rows
+    are appended and compare it with the corpus prefix it was built from.
+    """
+    total = checksum
+    for position, text in enumerate(texts, start + 1):
+        text = text if isinstance(text, str) else ''
+        total += zlib.crc32(text.encode()) * position
+    return total % _CHECKSUM_MODULUS
+
+
+def has_compact_corpus(data_dir=_DATA_DIR, name=_CORPUS_NAME):
+    paths = corpus_paths(data_dir, name)
+    return os.path.exists(paths['embeddings']) and os.path.exists(paths['metadata'])
+
+
+def parse_embeddings(column, dim=_EMBEDDING_DIM):
+    """
+    Parse a column of "[0.1, 0.2, ...]" strings into one float32 matrix in a single pass,
+    instead of calling eval on every row.
+    """
+    if len(column) == 0:
+        return np.empty((0, dim), dtype=np.float32)
+
+    flat = np.fromstring(','.join(s.strip()[1:-1] for s in column), sep=',', dtype=np.float32)
+    if flat.size != len(column) * dim:
+        raise ValueError(f"Expected {len(column)} x {dim} embedding values, got {flat.size}")
+    return flat.reshape(len(column), dim)
+
+
+def read_csv_corpus(csv_path, dim=_EMBEDDING_DIM, chunksize=_CHUNK_SIZE):
+    """
+    Read the legacy CSV (embeddings stored as stringified lists) into a metadata
+    DataFrame and a float32 embedding matrix aligned by paper_id.
+    """
+    frames = []
+    matrices = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        matrices.append(parse_embeddings(chunk['embeddings'].values, dim))
+        frames.append(chunk.drop(columns=['embeddings']))
+
+    df = pd.concat(frames, ignore_index=True)
+    df['paper_id'] = df.index
+    embeddings = np.ascontiguousarray(np.vstack(matrices), dtype=np.float32)
+    return df, embeddings
+
+
+def write_corpus(df, embeddings, data_dir=_DATA_DIR, name=_CORPUS_NAME):
+    """
+    Write the compact corpus: a float32 .npy matrix (row i == paper_id i) and a parquet
+    file with the remaining metadata columns. Files are swapped in atomically.
+    """
+    if len(df) != len(embeddings):
+        raise ValueError(f"Metadata has {len(df)} rows but embeddings have {len(embeddings)}")
+
+    paths = corpus_paths(data_dir, name)
+    os.makedirs(data_dir, exist_ok=True)
+
+    metadata = df.drop(columns=['embeddings'], errors='ignore').reset_index(drop=True)
+    metadata['paper_id'] = metadata.index
+
+    embeddings_tmp = paths['embeddings'] + '.tmp.npy'
+    metadata_tmp = paths['metadata'] + '.tmp'
+    np.save(embeddings_tmp, np.ascontiguousarray(embeddings, dtype=np.float32))
+    metadata.to_parquet(metadata_tmp, index=False)
+    os.replace(embeddings_tmp, paths['embeddings'])
+    os.replace(metadata_tmp, paths['metadata'])
+    # the rows of the delta shards are part of the files just written
+    shutil.rmtree(paths['delta'], ignore_errors=True)
+
+    return paths
+
+
+def append_corpus(df, embeddings, start, data_dir=_DATA_DIR, name=_CORPUS_NAME):
+    """
+    Persist rows appended to the corpus (paper ids start, start + 1, ...) as one delta
+    shard next to the compact corpus, without rewriting it. load_corpus() stacks the
+    shards onto the base files, and the next write_corpus() folds them in.
+    """
+    if len(df) != len(embeddings):
+        raise ValueError(f"Metadata has {len(df)} rows but embeddings have {len(embeddings)}")
+
+    delta_dir = corpus_paths(data_dir, name)['delta']
+    os.makedirs(delta_dir, exist_ok=True)
+    shard = os.path.join(delta_dir, f'{start:010d}')
+    metadata = df.drop(columns=['embeddings'], errors='ignore').reset_index(drop=True)
+    metadata['paper_id'] = np.arange(start, start + len(df))
+
+    # metadata last: a shard only counts once its parquet file exists
+    np.save(shard + '.tmp.npy', np.ascontiguousarray(embeddings, dtype=np.float32))
+    os.replace(shard + '.tmp.npy', shard + '.npy')
+    metadata.to_parquet(shard + '.tmp', index=False)
+    os.replace(shard + '.tmp', shard + '.parquet')
+
+
+def load_corpus(data_dir=_DATA_DIR, name=_CORPUS_NAME, mmap=True):
+    """
+    Load the compact corpus. With mmap=True the embedding matrix is a read-only
+    memory map, so startup does not touch the vectors until they are used.
+    """
+    paths = corpus_paths(data_dir, name)
+    embeddings = np.load(paths['embeddings'], mmap_mode='r' if mmap else None)
+    df = pd.read_parquet(paths['metadata'])
+
+    if len(df) != len(embeddings):
+        raise ValueError(f"Corpus is out of sync: {len(df)} metadata rows, {len(embeddings)} embeddings")
+
+    # rows ingested since the corpus was last written, in paper id order
+    frames = [df]
+    for shard_path in sorted(glob.glob(os.path.join(paths['delta'], '*.parquet'))):
+        start = int(os.path.basename(shard_path).split('.')[0])
+        if start != len(embeddings):
+            raise ValueError(f"Delta shard {shard_path} does not continue the corpus at row {len(embeddings)}")
+        shard_df = pd.read_parquet(shard_path)
+        shard_embeddings = np.load(shard_path[:-len('.parquet')] + '.npy', mmap_mode='r' if mmap else None)
+        if len(shard_df) != len(shard_embeddings):
+            raise ValueError(f"Delta shard {shard_path} is out of sync")
+        frames.append(shard_df)
+        embeddings = append_rows(embeddings, shard_embeddings)
+
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else df
+    df['paper_id'] = df.index
+    return df, embeddings
+
+
+def convert_csv(csv_path=None, data_dir=_DATA_DIR, name=_CORPUS_NAME, dim=_EMBEDDING_DIM):
+    csv_path = csv_path or corpus_paths(data_dir, name)['csv']
+    df, embeddings = read_csv_corpus(csv_path, dim)
+    paths = write_corpus(df, embeddings, data_dir, name)
+    print(f"Converted {len(df)} papers from {csv_path} -> {paths['embeddings']}, {paths['metadata']}")
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the embedding CSV into the compact corpus format.")
+    parser.add_argument('--csv', default=None, help="source CSV (defaults to <data-dir>/<name>_embed.csv)")
+    parser.add_argument('--data-dir', default=_DATA_DIR)
+    parser.add_argument('--name', default=_CORPUS_NAME)
+    parser.add_argument('--dim', type=int, default=_EMBEDDING_DIM)
+    args = parser.parse_args()
+
+    convert_csv(args.csv, args.data_dir, args.name, args.dim)
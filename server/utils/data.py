@@ -1,25 +1,61 @@
 import os 
+import threading
+import joblib
+from collections import namedtuple
 import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from umap import UMAP
-from sklearn.cluster import KMeans
-from sklearn.neighbors import KernelDensity
 from heapq import nlargest
-from sklearn.feature_extraction.text import TfidfVectorizer
-tfidf = TfidfVectorizer(stop_words='english')
+from utils.corpus import has_compact_corpus, load_corpus, read_csv_corpus, corpus_paths, write_corpus, append_corpus, append_rows
+from utils.index import ExactIndex, load_or_build_index, index_path
+from utils.sentences import SentenceIndex, load_or_build_sentence_index, sentence_index_path
+from utils.binning import KeywordAggregator, longest_texts_summary, text_column, group_indicator
+from utils.cache import LRUCache
+from utils.clustering import ClusteringService, assign_to_centroids
+from utils.models import encode_texts, embedding_dim
+from utils.authors import AuthorIndex
+from utils.lexical import BM25Index, load_or_build_lexical_index, lexical_index_path, lexical_texts
+from utils.density import grid_kde, interpolate, point_log_density
+from utils.tiles import TileIndex, tile_payload
+from utils.metrics import span, register_cache
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
-_BATCH_SIZE = 128
 _BINS_NUM = 20
 _CLUSTER_NUM = 5
 _TOP_KERWORDS = 5
+_LEVEL_CACHE_SIZE = 16
+_DENSITY_CACHE_SIZE = 8
+_DENSITY_GRID = 256
+_TILE_CACHE_SIZE = 1024
+_PYRAMID_RESOLUTIONS = range(10, 40, 2)
+_UMAP_MODEL_FILE = 'ieee_vis_umap.joblib'
+_UMAP_PARAMS = {'n_components': 2, 'n_neighbors': 40, 'min_dist': 0.01}
+_PROJECTION_NEIGHBORS = 15
+# schedule a background refit once this share of the corpus was ingested incrementally,
+# or once new papers sit this much further from their centroid than the corpus average
+_REFIT_ROWS_RATIO = 0.2
+_REFIT_DISTANCE_RATIO = 1.25
+
+
+class Snapshot(namedtuple('Snapshot', [
+    'version', 'df', 'embeddings', 'index', 'sentence_index', 'author_index', 'lexical_index',
+    'bins_num', 'cluster_num',
+])):
+    """
+    One immutable version of the corpus, the indexes built over it and the current
+    /update parameters. Readers pin the snapshot they started with; writers build the
+    next one off to the side and publish it by swapping a single reference, so the
+    frame and indexes of a published snapshot are never modified.
+    """
+    __slots__ = ()
+
+    def view_key(self):
+        # identifies what DataStore.get_view(snapshot) returns; used for HTTP caching
+        return (self.version, self.bins_num, self.cluster_num)
 
 
 class DataStore:
     def __init__(self):
         # self.embeddings_dfs = {}
-        self.embeddings_df = pd.DataFrame(columns=[
+        embeddings_df = pd.DataFrame(columns=[
         'Conference', 'Year', 'Title', 'DOI', 'Link', 'FirstPage', 'LastPage',
        'PaperType', 'Abstract', 'AuthorNames-Deduped', 'AuthorNames',
        'AuthorAffiliation', 'InternalReferences', 'AuthorKeywords',
@@ -37,92 +73,502 @@ class DataStore:
        'umap_x_bin_28', 'umap_y_bin_28', 'umap_x_bin_30', 'umap_y_bin_30',
        'umap_x_bin_32', 'umap_y_bin_32', 'umap_x_bin_34', 'umap_y_bin_34',
        'umap_x_bin_36', 'umap_y_bin_36', 'umap_x_bin_38', 'umap_y_bin_38'])
+        # row i of the matrix is the embedding of paper_id i
+        embeddings = np.empty((0, embedding_dim()), dtype=np.float32)
+        # the published snapshot; replaced as a whole, never modified. Its version is
+        # bumped whenever the corpus changes and derived caches are keyed by it
+        self.current = Snapshot(
+            version=0, df=embeddings_df, embeddings=embeddings,
+            index=ExactIndex(embeddings.shape[1]), sentence_index=SentenceIndex(embeddings.shape[1]),
+            author_index=AuthorIndex(), lexical_index=BM25Index(), bins_num=None, cluster_num=None,
+        )
+        self.data_dir = './data'
+        self.keyword_aggregators = LRUCache(2)
+        self.levels = LRUCache(_LEVEL_CACHE_SIZE)
+        self.densities = LRUCache(_DENSITY_CACHE_SIZE)
+        self.tile_indexes = LRUCache(1)
+        self.tiles = LRUCache(_TILE_CACHE_SIZE)
+        self.clustering = ClusteringService()
+        self.umap_model = None
+        # incremental per-cluster statistics over the stored 'cluster' column
+        self.cluster_sums = None
+        self.cluster_counts = None
+        self.baseline_distance = None
+        self.ingested_rows = 0
+        self.ingested_distance = 0.0
+        # leading rows of the corpus that are already in the compact corpus files
+        self.persisted_rows = 0
+        # serialises writers (load, ingest, refit); readers never take it
+        self.lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self.refit_thread = None
+        self.listeners = []
+        self.loaded = False
 
-    def load_data(self):
-        csv_path = os.path.join('./data', 'ieee_vis_embed.csv')
-        df = pd.read_csv(csv_path)
-        df['paper_id'] = df.index
-        df['embeddings'] = df['embeddings'].apply(eval)
-        df['bin_id'] = df.apply(lambda x: f'{x["umap_x_bin_30"]}_{x["umap_y_bin_30"]}', axis=1)
-        
-        # get year > 2015
-        # df = df[df['Year'] > 2020]
-        
-        self.embeddings_df = df
+    @property
+    def version(self):
+        return self.current.version
+
+    @property
+    def embeddings_df(self):
+        return self.current.df
+
+    @property
+    def embeddings(self):
+        return self.current.embeddings
+
+    @property
+    def index(self):
+        return self.current.index
+
+    @property
+    def bins_num(self):
+        return self.current.bins_num
+
+    @property
+    def cluster_num(self):
+        return self.current.cluster_num
+
+    def snapshot(self):
+        return self.current
+
+    def load_data(self, data_dir='./data'):
+        with self.lock:
+            if has_compact_corpus(data_dir):
+                df, embeddings = load_corpus(data_dir)
+                self.persisted_rows = len(df)
+            else:
+                csv_path = corpus_paths(data_dir)['csv']
+                print(f"Compact corpus not found, parsing {csv_path} (run `python -m utils.corpus` once to convert)")
+                df, embeddings = read_csv_corpus(csv_path)
+                self.persisted_rows = 0
+
+            df['bin_id'] = df['umap_x_bin_30'].astype(str) + '_' + df['umap_y_bin_30'].astype(str)
+            
+            # get year > 2015
+            # df = df[df['Year'] > 2020]
+            
+            self.data_dir = data_dir
+            index = load_or_build_index(embeddings, data_dir)
+            sentence_index = load_or_build_sentence_index(df['Abstract'].values, data_dir, encode_texts, embeddings.shape[1])
+            author_index = AuthorIndex().build(df)
+            lexical_index = load_or_build_lexical_index(df, data_dir)
+            self.umap_model = None
+            self.cluster_sums = None
+            self.ingested_rows = 0
+            self.ingested_distance = 0.0
+            self._bump_version(
+                df=df, embeddings=embeddings, index=index, sentence_index=sentence_index,
+                author_index=author_index, lexical_index=lexical_index,
+            )
+            self.loaded = True
 
     def get_data(self):
-        return self.embeddings_df
+        return self.current.df
+
+    def get_view(self, snapshot=None):
+        """
+        The corpus with the clusters and bins of the snapshot's /update parameters.
+        """
+        snapshot = snapshot or self.current
+        if snapshot.bins_num is None:
+            return snapshot.df
+        return snapshot.df.assign(**self.get_level(snapshot.bins_num, snapshot.cluster_num, snapshot))
+
+    def view_key(self):
+        return self.current.view_key()
+
+    def get_embeddings(self):
+        return self.current.embeddings
+
+    def get_index(self):
+        return self.current.index
+
+    def get_sentence_index(self):
+        return self.current.sentence_index
+
+    def get_author_index(self):
+        return self.current.author_index
+
+    def get_lexical_index(self):
+        return self.current.lexical_index
+
+    def get_keyword_aggregator(self, snapshot=None):
+        # corpus-wide TF-IDF, fitted on first use and reused by every binning of a version
+        snapshot = snapshot or self.current
+        df = snapshot.df
+        return self.keyword_aggregators.get_or_compute(snapshot.version, lambda: KeywordAggregator(df[text_column(df)].values))
     
 
-    def update_data(self, row):
-        content = row['content']
-        embeddings = model.encode(content, batch_size=_BATCH_SIZE)
-        row['embeddings'] = embeddings
-        self.embeddings_df.loc[len(self.embeddings_df)] = row
-        self.embeddings_df = umap(self.embeddings_df)
-        self.embeddings_df = kmeans(self.embeddings_df)
-        self.embeddings_df = kde(self.embeddings_df)
-        self.embeddings_df = cluster_keywords_extraction(self.embeddings_df)
-        self.embeddings_df = data_binning(self.embeddings_df)
-        
-        return self.embeddings_df
+    def ingest(self, rows):
+        """
+        Append a batch of papers without refitting the corpus: one batched encode, UMAP
+        placement with the persisted model, cluster assignment with the current centroids,
+        bins at every precomputed resolution and incremental index/keyword updates. Everything is built on copies and
+        published as the next snapshot; the memory-mapped base matrices are shared, not
+        copied. Only the new rows are written to disk, as a delta shard of the corpus;
+        the persisted indexes catch up on them when they are next loaded. Returns the
+        new paper ids.
+        """
+        with self.lock:
+            base = self.current
+            new_df = pd.DataFrame(list(rows))
+            if 'Abstract' not in new_df.columns:
+                new_df['Abstract'] = new_df.get('content')
+            if 'content' in new_df.columns and 'content' not in base.df.columns:
+                new_df = new_df.drop(columns=['content'])
+            texts = new_df[text_column(base.df)].fillna('').astype(str).tolist()
+
+            start = len(base.df)
+            new_df.index = pd.RangeIndex(start, start + len(new_df))
+            new_df['paper_id'] = new_df.index
+
+            embeddings = np.asarray(encode_texts(texts), dtype=np.float32).reshape(len(new_df), -1)
+            coords = self.project(embeddings)
+            new_df['umap_x'] = coords[:, 0]
+            new_df['umap_y'] = coords[:, 1]
+
+            labels, distances = self._assign_clusters(embeddings)
+            new_df['cluster'] = labels
+            new_df = assign_cluster_keywords(new_df, base.df)
+            new_df = assign_bins(new_df, base.df)
+
+            index = base.index.copy()
+            index.add(embeddings)
+            sentence_index = base.sentence_index.copy()
+            sentence_index.add(new_df['Abstract'].values, encode_texts)
+            author_index = base.author_index.copy().add(new_df, start)
+            df = pd.concat([base.df, new_df], ignore_index=True)
+            lexical_index = base.lexical_index.copy()
+            # from the combined frame, so the texts are built from the corpus columns
+            lexical_index.add(lexical_texts(df.iloc[start:]))
+            aggregator = self.keyword_aggregators.get(base.version)
+            if aggregator is not None:
+                aggregator = aggregator.copy()
+                aggregator.add(texts)
+
+            changes = dict(
+                df=df, embeddings=append_rows(base.embeddings, embeddings), index=index,
+                sentence_index=sentence_index, author_index=author_index, lexical_index=lexical_index,
+            )
+            next_snapshot = base._replace(version=base.version + 1, **changes)
+            if 'density' in df.columns:
+                df['density'] = self.point_density(snapshot=next_snapshot)
+
+            self._bump_version(**changes)
+            if aggregator is not None:
+                self.keyword_aggregators.put(next_snapshot.version, aggregator)
+            self.clustering.advance(base.version, next_snapshot.version, new_df, embeddings)
+
+            self.ingested_rows += len(new_df)
+            self.ingested_distance += float(distances.sum())
+            if self.persisted_rows == start:
+                append_corpus(df.iloc[start:], embeddings, start, self.data_dir)
+                self.persisted_rows = len(df)
+            else:
+                # the corpus on disk is missing earlier rows (e.g. it was loaded from the CSV)
+                self.save()
+
+        if self.needs_refit():
+            self.schedule_refit()
+        return new_df['paper_id'].tolist()
+
+    def project(self, embeddings):
+        """
+        2-D coordinates for new papers: the persisted UMAP model when there is one,
+        otherwise the similarity-weighted mean position of their nearest neighbours.
+        """
+        if self.umap_model is None and os.path.exists(os.path.join(self.data_dir, _UMAP_MODEL_FILE)):
+            self.umap_model = joblib.load(os.path.join(self.data_dir, _UMAP_MODEL_FILE))
+        if self.umap_model is not None:
+            return np.asarray(self.umap_model.transform(embeddings), dtype=np.float64)
+
+        snapshot = self.current
+        positions = snapshot.df[['umap_x', 'umap_y']].values
+        coords = np.empty((len(embeddings), 2))
+        for i, embedding in enumerate(embeddings):
+            ids, similarities = snapshot.index.search(embedding, _PROJECTION_NEIGHBORS)
+            weights = np.maximum(similarities, 0) + 1e-6
+            coords[i] = weights @ positions[ids] / weights.sum()
+        return coords
+
+    def needs_refit(self):
+        if self.ingested_rows == 0:
+            return False
+        if self.ingested_rows > _REFIT_ROWS_RATIO * len(self.current.df):
+            return True
+        return self.ingested_distance / self.ingested_rows > _REFIT_DISTANCE_RATIO * self.baseline_distance
+
+    def schedule_refit(self):
+        if self.refit_thread is not None and self.refit_thread.is_alive():
+            return
+        self.refit_thread = threading.Thread(target=self.refit, daemon=True)
+        self.refit_thread.start()
+
+    def refit(self):
+        """
+        Full UMAP/KMeans/KDE/keyword/binning rebuild on a copy of the corpus, published
+        when done. Papers ingested meanwhile are re-placed with the new projection and
+        clusters before the swap.
+        """
+        base = self.current
+        df = base.df.copy()
+        embeddings = np.asarray(base.embeddings, dtype=np.float32)
+        print(f"Refitting projection and clusters over {len(df)} papers")
+
+        df, umap_model = umap(df, embeddings, return_model=True)
+        df = kmeans(df, embeddings)
+        df = cluster_keywords_extraction(df)
+        df = assign_bins(df)
+
+        with self.lock:
+            self.umap_model = umap_model
+            joblib.dump(umap_model, os.path.join(self.data_dir, _UMAP_MODEL_FILE))
+            ingested_meanwhile = self.current.df.iloc[len(df):].copy()
+            if len(ingested_meanwhile) > 0:
+                new_embeddings = np.asarray(self.current.embeddings[len(df):], dtype=np.float32)
+                ingested_meanwhile = self._place(ingested_meanwhile, new_embeddings, df, embeddings)
+            df = kde(pd.concat([df, ingested_meanwhile], ignore_index=True))
+            self.cluster_sums = None
+            self.ingested_rows = len(ingested_meanwhile)
+            self.ingested_distance = 0.0
+            # same rows and texts, so the TF-IDF matrix carries over
+            aggregator = self.keyword_aggregators.get(self.current.version)
+            snapshot = self._bump_version(df=df)
+            if aggregator is not None:
+                self.keyword_aggregators.put(snapshot.version, aggregator)
+            self.save()
+
+    def _place(self, new_df, new_embeddings, df, embeddings):
+        # coordinates, cluster, keywords and bins of new rows under the fit of (df, embeddings)
+        coords = np.asarray(self.umap_model.transform(new_embeddings), dtype=np.float64)
+        new_df['umap_x'] = coords[:, 0]
+        new_df['umap_y'] = coords[:, 1]
+        labels = df['cluster'].values.astype(np.int64)
+        counts = np.bincount(labels)
+        centroids = (group_indicator(labels, len(counts)) @ embeddings) / np.maximum(counts, 1)[:, None]
+        new_df['cluster'], _ = assign_to_centroids(new_embeddings, centroids)
+        new_df = assign_cluster_keywords(new_df, df)
+        return assign_bins(new_df, df)
+
+    def save(self):
+        snapshot = self.current
+        paths = write_corpus(snapshot.df, snapshot.embeddings, self.data_dir)
+        self.persisted_rows = len(snapshot.df)
+        snapshot.index.save(index_path(self.data_dir))
+        snapshot.sentence_index.save(sentence_index_path(self.data_dir))
+        snapshot.lexical_index.save(lexical_index_path(self.data_dir))
+        # same rows, now memory-mapped from the file just written: not a new version
+        self._publish(embeddings=np.load(paths['embeddings'], mmap_mode='r'))
+
+    def _assign_clusters(self, embeddings):
+        snapshot = self.current
+        if self.cluster_sums is None:
+            labels = snapshot.df['cluster'].values.astype(np.int64)
+            self.cluster_counts = np.bincount(labels).astype(np.float64)
+            corpus = np.asarray(snapshot.embeddings, dtype=np.float32)
+            self.cluster_sums = (group_indicator(labels, len(self.cluster_counts)) @ corpus).astype(np.float64)
+            centroids = self.cluster_sums / np.maximum(self.cluster_counts, 1)[:, None]
+            self.baseline_distance = float(np.mean(np.linalg.norm(corpus - centroids[labels], axis=1)))
+
+        centroids = self.cluster_sums / np.maximum(self.cluster_counts, 1)[:, None]
+        labels, distances = assign_to_centroids(embeddings, centroids)
+        np.add.at(self.cluster_sums, labels, embeddings)
+        self.cluster_counts += np.bincount(labels, minlength=len(self.cluster_counts))
+        return labels, distances
         
     def update_params(self, bins_num, cluster_num):
-        global _BINS_NUM
-        global _CLUSTER_NUM
-        _BINS_NUM = bins_num
-        _CLUSTER_NUM = cluster_num
-        
-        self.embeddings_df = kmeans(self.embeddings_df, cluster_num)
-        self.embeddings_df = cluster_keywords_extraction(self.embeddings_df)
-        self.embeddings_df = data_binning(self.embeddings_df, bins_num)
-        
-        return self.embeddings_df
+        """
+        Publish new /update parameters over the current corpus version and return the
+        snapshot to serve them from. The level is computed first, so parameters it
+        fails on are never published.
+        """
+        self.get_level(bins_num, cluster_num, self.current)
+        return self._publish(bins_num=bins_num, cluster_num=cluster_num)
+
+    def get_density(self, grid_size=_DENSITY_GRID, bandwidth=None, snapshot=None):
+        """
+        Grid KDE of the UMAP plane as {'density', 'extent', 'bandwidth'}, computed once
+        per (grid_size, bandwidth, version). bandwidth=None uses Scott's rule.
+        """
+        snapshot = snapshot or self.current
+        df = snapshot.df
+
+        def compute():
+            density, extent, bandwidth_ = grid_kde(df['umap_x'].values, df['umap_y'].values, bandwidth, grid_size)
+            return {'density': density.astype(np.float32), 'extent': extent, 'bandwidth': bandwidth_}
+
+        return self.densities.get_or_compute((grid_size, bandwidth, snapshot.version), compute)
+
+    def point_density(self, grid_size=_DENSITY_GRID, bandwidth=None, snapshot=None):
+        # log density at every paper, from the cached grid
+        snapshot = snapshot or self.current
+        density = self.get_density(grid_size, bandwidth, snapshot)
+        values = interpolate(density['density'], density['extent'], snapshot.df['umap_x'].values, snapshot.df['umap_y'].values)
+        return np.log(np.maximum(values, np.finfo(np.float32).tiny))
 
+    def get_tile_index(self, snapshot=None):
+        snapshot = snapshot or self.current
+        return self.tile_indexes.get_or_compute(
+            snapshot.version,
+            lambda: TileIndex(snapshot.df['umap_x'].values, snapshot.df['umap_y'].values),
+        )
 
+    def get_tile(self, z, tx, ty, snapshot=None):
+        """
+        Points or aggregated cells of one map tile, per tile and view.
+        """
+        snapshot = snapshot or self.current
+
+        def compute():
+            if snapshot.bins_num is None:
+                clusters = snapshot.df['cluster'].values
+            else:
+                clusters = self.get_level(snapshot.bins_num, snapshot.cluster_num, snapshot)['cluster']
+            return tile_payload(self.get_tile_index(snapshot), z, tx, ty, snapshot.df, clusters, self.get_keyword_aggregator(snapshot))
+
+        return self.tiles.get_or_compute((z, tx, ty) + snapshot.view_key(), compute)
+
+    def get_level(self, bins_num, cluster_num, snapshot=None):
+        """
+        Cluster and bin columns for one resolution of the bin pyramid, computed once per
+        (bins_num, cluster_num, version) and served from a bounded cache afterwards.
+        """
+        snapshot = snapshot or self.current
+        return self.levels.get_or_compute(
+            (bins_num, cluster_num, snapshot.version),
+            lambda: self._compute_level(bins_num, cluster_num, snapshot),
+        )
+
+    def warm_levels(self, resolutions=_PYRAMID_RESOLUTIONS, cluster_num=_CLUSTER_NUM):
+        snapshot = self.current
+        for bins_num in resolutions:
+            self.get_level(bins_num, cluster_num, snapshot)
+
+    def _compute_level(self, bins_num, cluster_num, snapshot):
+        # work on a narrow copy so the published frame is never mutated
+        df = snapshot.df
+        level_df = df[['umap_x', 'umap_y', text_column(df)]].copy()
+        with span('level.clustering'):
+            labels, _ = self.clustering.cluster(df, snapshot.embeddings, cluster_num, snapshot.version)
+        with span('level.cluster_keywords'):
+            aggregator = self.get_keyword_aggregator(snapshot)
+            cluster_keywords = aggregator.top_keywords(labels, labels.max() + 1, _TOP_KERWORDS)
+        level_df['cluster'] = labels
+        level_df['cluster_keywords'] = pd.Series(cluster_keywords, dtype=object).values[labels]
+        with span('data_binning'):
+            level_df = data_binning(level_df, bins_num, aggregator)
+        return {column: level_df[column].values for column in _LEVEL_COLUMNS}
+
+    def on_change(self, callback):
+        # called after every version bump, e.g. to drop caches derived from the corpus
+        self.listeners.append(callback)
+
+    def _publish(self, **changes):
+        # swap in a copy of the current snapshot with some fields replaced; readers that
+        # pinned the previous one keep using it untouched
+        with self._publish_lock:
+            self.current = self.current._replace(**changes)
+            return self.current
+
+    def _bump_version(self, **changes):
+        snapshot = self._publish(version=self.current.version + 1, **changes)
+        # entries of older versions can no longer be hit, free them early
+        self.levels.clear()
+        self.densities.clear()
+        self.tile_indexes.clear()
+        self.tiles.clear()
+        for callback in self.listeners:
+            callback()
+        return snapshot
+
+_LEVEL_COLUMNS = ['cluster', 'cluster_keywords', 'umap_x_bin', 'umap_y_bin', 'bin_id', 'bin_summary', 'bin_keywords']
+
+
+# loaded by the server lifespan hook (or explicitly by CLI entry points), not on import
 data_store = DataStore()
-data_store.load_data()
+register_cache('levels', data_store.levels)
+register_cache('densities', data_store.densities)
+register_cache('tiles', data_store.tiles)
+
 
+def umap(embeddings_df, embeddings, return_model=False):
+    from umap import UMAP
 
-def umap(embeddings_df):
     # UMAP
-    embeddings = np.array(embeddings_df['embeddings'].tolist())
-    
-    umap = UMAP(n_components=2, n_neighbors=40, min_dist=0.01)
+    umap = UMAP(**_UMAP_PARAMS)
     umap_embeddings = umap.fit_transform(embeddings)
     embeddings_df['umap_x'] = umap_embeddings[:, 0]
     embeddings_df['umap_y'] = umap_embeddings[:, 1]
     
+    return (embeddings_df, umap) if return_model else embeddings_df
+
+
+def bin_edges(values, bins_num):
+    # same edges as pd.cut(values, bins=bins_num)
+    lo, hi = float(np.nanmin(values)), float(np.nanmax(values))
+    edges = np.linspace(lo, hi, bins_num + 1)
+    edges[0] -= (hi - lo) * 0.001
+    return edges
+
+
+def assign_bins(embeddings_df, reference_df=None):
+    """
+    Fill the precomputed umap_{x,y}_bin_{10..38} columns, the stored umap_{x,y}_bin of
+    the default resolution and the default bin_id. New rows are placed with the bin
+    edges of reference_df, so existing bins keep their ids.
+    """
+    reference_df = embeddings_df if reference_df is None else reference_df
+    for bins_num in _PYRAMID_RESOLUTIONS:
+        for axis in ('x', 'y'):
+            edges = bin_edges(reference_df[f'umap_{axis}'].values, bins_num)
+            bins = np.searchsorted(edges, embeddings_df[f'umap_{axis}'].values, side='left') - 1
+            embeddings_df[f'umap_{axis}_bin_{bins_num}'] = np.clip(bins, 0, bins_num - 1)
+    embeddings_df['umap_x_bin'] = embeddings_df[f'umap_x_bin_{_BINS_NUM}']
+    embeddings_df['umap_y_bin'] = embeddings_df[f'umap_y_bin_{_BINS_NUM}']
+    embeddings_df['bin_id'] = embeddings_df['umap_x_bin_30'].astype(str) + '_' + embeddings_df['umap_y_bin_30'].astype(str)
+    return embeddings_df
+
+
+def assign_cluster_keywords(embeddings_df, reference_df):
+    """
+    Fill the cluster keyword columns of new rows with those of their cluster in
+    reference_df.
+    """
+    clusters, first = np.unique(reference_df['cluster'].values, return_index=True)
+    for column in ('cluster_keywords', 'top_keywords'):
+        if column in reference_df.columns:
+            keywords = dict(zip(clusters, reference_df[column].values[first]))
+            embeddings_df[column] = embeddings_df['cluster'].map(keywords)
     return embeddings_df
 
 
-def kmeans(embeddings_df, n_clusters=_CLUSTER_NUM):
+def kmeans(embeddings_df, embeddings, n_clusters=_CLUSTER_NUM):
+    from sklearn.cluster import KMeans
+
     # KMeans
-    embeddings = np.array(embeddings_df['embeddings'].tolist())
-    
     kmeans = KMeans(n_clusters=n_clusters)
     embeddings_df['cluster'] = kmeans.fit_predict(embeddings)
     
     return embeddings_df
 
 
-def kde(embeddings_df):
-    # KDE
-    embeddings = np.array(embeddings_df['embeddings'].tolist())
-    
-    kde = KernelDensity(bandwidth=0.5)
-    kde.fit(embeddings)
-    embeddings_df['density'] = kde.score_samples(embeddings)
+def kde(embeddings_df, embeddings=None, bandwidth=None, grid_size=_DENSITY_GRID):
+    # KDE on the UMAP plane (binned + FFT), log density per paper like score_samples
+    embeddings_df['density'] = point_log_density(embeddings_df['umap_x'].values, embeddings_df['umap_y'].values, bandwidth, grid_size)
     
     return embeddings_df
 
 
 def cluster_keywords_extraction(embeddings_df, top_n=_TOP_KERWORDS):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
     # Keyword extraction
+    tfidf = TfidfVectorizer(stop_words='english')
     cluster_keywords = {}
     for cluster in embeddings_df['cluster'].unique():
         cluster_df = embeddings_df[embeddings_df['cluster'] == cluster]
-        cluster_content = cluster_df['content']
+        cluster_content = cluster_df[text_column(cluster_df)]
         
         cluster_tfidf = tfidf.fit_transform(cluster_content)
         feature_names = tfidf.get_feature_names_out()
@@ -139,65 +585,24 @@ def cluster_keywords_extraction(embeddings_df, top_n=_TOP_KERWORDS):
     return embeddings_df
 
 
-def document_keywords_extraction(embeddings_df, top_n=_TOP_KERWORDS):
-    # Keyword extraction
-    document_keywords = {}
-    for doc_id in embeddings_df['doc_id'].unique():
-        doc_df = embeddings_df[embeddings_df['doc_id'] == doc_id]
-        doc_content = doc_df['content']
-        
-        doc_tfidf = tfidf.fit_transform(doc_content)
-        feature_names = tfidf.get_feature_names_out()
-        dense = doc_tfidf.todense()
-        episode_keywords = dense[0].tolist()[0]
-        phrase_scores = [pair for pair in zip(range(0, len(episode_keywords)), episode_keywords) if pair[1] > 0]
-        sorted_phrase_scores = sorted(phrase_scores, key=lambda t: t[1] * -1)
-        keywords = []
-        for phrase, score in [(feature_names[word_id], score) for (word_id, score) in sorted_phrase_scores][:top_n]:
-            keywords.append(phrase)
-        document_keywords[doc_id] = keywords
-        
-    embeddings_df['document_keywords'] = embeddings_df['doc_id'].map(document_keywords)
-    return embeddings_df
-
-
-def data_binning(embeddings_df, bins_num=_BINS_NUM):
+def data_binning(embeddings_df, bins_num=_BINS_NUM, aggregator=None):
     # Binning
     embeddings_df['umap_x_bin'] = pd.cut(embeddings_df['umap_x'], bins=bins_num, labels=False)
     embeddings_df['umap_y_bin'] = pd.cut(embeddings_df['umap_y'], bins=bins_num, labels=False)
+    embeddings_df['bin_id'] = embeddings_df['umap_x_bin'].astype(str) + '_' + embeddings_df['umap_y_bin'].astype(str)
     
-    unique_bins_combinations = embeddings_df[['umap_x_bin', 'umap_y_bin']].drop_duplicates()
+    codes, bin_ids = pd.factorize(embeddings_df['bin_id'])
+    texts = embeddings_df[text_column(embeddings_df)].values
     
     # generate bins summaries & keywords
-    bin_summaries = {}
-    bin_keywords = {}
-    for _, row in unique_bins_combinations.iterrows():
-        bin_df = embeddings_df[(embeddings_df['umap_x_bin'] == row['umap_x_bin']) & (embeddings_df['umap_y_bin'] == row['umap_y_bin'])]
-        bin_content = bin_df['content'].values.tolist()
-        
-        tfidf_matrix = tfidf.fit_transform(bin_content)
-        feature_names = tfidf.get_feature_names_out()
-        dense = tfidf_matrix.todense()
-        episode_keywords = dense[0].tolist()[0]
-        phrase_scores = [pair for pair in zip(range(0, len(episode_keywords)), episode_keywords) if pair[1] > 0]
-        sorted_phrase_scores = sorted(phrase_scores, key=lambda t: t[1] * -1)
-        keywords = []
-        for phrase, score in [(feature_names[word_id], score) for (word_id, score) in sorted_phrase_scores][:10]:
-            keywords.append(phrase)
-            
-        bin_keywords[(row['umap_x_bin'], row['umap_y_bin'])] = keywords
-        
-        select_length = int(len(bin_content) * 0.1)
-        if select_length == 0:
-            select_length = 1
-            
-        bin_summary = nlargest(select_length, bin_content, key=len)
-        bin_summary_str = ' '.join(bin_summary)
-        bin_summaries[(row['umap_x_bin'], row['umap_y_bin'])] = bin_summary_str
-        
+    with span('data_binning.keywords'):
+        if aggregator is None or len(aggregator) != len(embeddings_df):
+            aggregator = KeywordAggregator(texts)
+        bin_keywords = aggregator.top_keywords(codes, len(bin_ids), 10)
+    with span('data_binning.summaries'):
+        bin_summaries = longest_texts_summary(texts, codes, len(bin_ids))
     
-    embeddings_df['bin_id'] = embeddings_df.apply(lambda x: f'{x["umap_x_bin"]}_{x["umap_y_bin"]}', axis=1)
-    embeddings_df['bin_summary'] = embeddings_df.apply(lambda row: bin_summaries[(row['umap_x_bin'], row['umap_y_bin'])], axis=1)
-    embeddings_df['bin_keywords'] = embeddings_df.apply(lambda row: bin_keywords[(row['umap_x_bin'], row['umap_y_bin'])], axis=1)
+    embeddings_df['bin_summary'] = np.array(bin_summaries, dtype=object)[codes]
+    embeddings_df['bin_keywords'] = pd.Series(bin_keywords, dtype=object).values[codes]
     
-    return embeddings_df
\ No newline at end of file
+    return embeddings_df
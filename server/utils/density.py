@@ -0,0 +1,89 @@
+import numpy as np
+
+_GRID_SIZE = 256
+# the kernel is cut off this many bandwidths from its centre
+_KERNEL_RADIUS = 4
+
+
+def scott_bandwidth(x, y):
+    # Scott's rule for 2-D data, on the average standard deviation of both axes
+    n = max(len(x), 2)
+    return float(max((np.std(x) + np.std(y)) / 2, 1e-9) * n ** (-1 / 6))
+
+
+def grid_extent(x, y, pad):
+    return (float(np.min(x) - pad), float(np.max(x) + pad), float(np.min(y) - pad), float(np.max(y) + pad))
+
+
+def linear_binning(x, y, extent, grid_size):
+    """
+    Spread every point over the 4 grid nodes around it with bilinear weights.
+    Returns a (grid_size, grid_size) array of weights indexed [y, x].
+    """
+    x0, x1, y0, y1 = extent
+    gx = (np.asarray(x, dtype=np.float64) - x0) / (x1 - x0) * (grid_size - 1)
+    gy = (np.asarray(y, dtype=np.float64) - y0) / (y1 - y0) * (grid_size - 1)
+    ix = np.clip(np.floor(gx).astype(np.int64), 0, grid_size - 2)
+    iy = np.clip(np.floor(gy).astype(np.int64), 0, grid_size - 2)
+    fx, fy = gx - ix, gy - iy
+
+    counts = np.zeros(grid_size * grid_size)
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            counts += np.bincount((iy + dy) * grid_size + ix + dx, weights=wy * wx, minlength=grid_size * grid_size)
+    return counts.reshape(grid_size, grid_size)
+
+
+def fft_convolve(grid, kernel):
+    # zero-padded so the convolution does not wrap around the edges
+    shape = (grid.shape[0] + kernel.shape[0] - 1, grid.shape[1] + kernel.shape[1] - 1)
+    result = np.fft.irfft2(np.fft.rfft2(grid, shape) * np.fft.rfft2(kernel, shape), shape)
+    top, left = kernel.shape[0] // 2, kernel.shape[1] // 2
+    return result[top:top + grid.shape[0], left:left + grid.shape[1]]
+
+
+def grid_kde(x, y, bandwidth=None, grid_size=_GRID_SIZE):
+    """
+    Gaussian KDE of 2-D points evaluated on a grid_size x grid_size grid: linear
+    binning (O(N)) followed by an FFT convolution with the kernel (O(G log G)).
+    Returns (density[y, x], extent (x0, x1, y0, y1), bandwidth); the density
+    integrates to 1 over the extent.
+    """
+    bandwidth = scott_bandwidth(x, y) if bandwidth is None else float(bandwidth)
+    extent = grid_extent(x, y, 3 * bandwidth)
+    counts = linear_binning(x, y, extent, grid_size)
+
+    dx = (extent[1] - extent[0]) / (grid_size - 1)
+    dy = (extent[3] - extent[2]) / (grid_size - 1)
+    rx = min(grid_size - 1, int(np.ceil(_KERNEL_RADIUS * bandwidth / dx)))
+    ry = min(grid_size - 1, int(np.ceil(_KERNEL_RADIUS * bandwidth / dy)))
+    kx = np.exp(-0.5 * (np.arange(-rx, rx + 1) * dx / bandwidth) ** 2)
+    ky = np.exp(-0.5 * (np.arange(-ry, ry + 1) * dy / bandwidth) ** 2)
+    kernel = np.outer(ky, kx)
+    kernel /= kernel.sum()
+
+    density = np.maximum(fft_convolve(counts, kernel), 0) / (max(len(x), 1) * dx * dy)
+    return density, extent, bandwidth
+
+
+def interpolate(grid, extent, x, y):
+    """
+    Bilinear interpolation of a grid (indexed [y, x]) at the given points.
+    """
+    grid_size = grid.shape[0]
+    x0, x1, y0, y1 = extent
+    gx = np.clip((np.asarray(x, dtype=np.float64) - x0) / (x1 - x0) * (grid_size - 1), 0, grid_size - 1)
+    gy = np.clip((np.asarray(y, dtype=np.float64) - y0) / (y1 - y0) * (grid_size - 1), 0, grid_size - 1)
+    ix = np.minimum(np.floor(gx).astype(np.int64), grid_size - 2)
+    iy = np.minimum(np.floor(gy).astype(np.int64), grid_size - 2)
+    fx, fy = gx - ix, gy - iy
+    return (
+        grid[iy, ix] * (1 - fx) * (1 - fy) + grid[iy, ix + 1] * fx * (1 - fy)
+        + grid[iy + 1, ix] * (1 - fx) * fy + grid[iy + 1, ix + 1] * fx * fy
+    )
+
+
+def point_log_density(x, y, bandwidth=None, grid_size=_GRID_SIZE):
+    # log density at every point, like KernelDensity.score_samples
+    density, extent, _ = grid_kde(x, y, bandwidth, grid_size)
+    return np.log(np.maximum(interpolate(density, extent, x, y), np.finfo(np.float64).tiny))
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+
+# numpy/BLAS, sklearn and torch release the GIL, so a small thread pool keeps the
+# event loop free without copying the corpus into worker processes
+_MAX_WORKERS = int(os.environ.get('SCHOLET_CPU_WORKERS', min(8, os.cpu_count() or 1)))
+_MAX_PENDING = _MAX_WORKERS * 4
+_QUEUE_TIMEOUT = 5
+_DEFAULT_TIMEOUT = 30
+
+_executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix='scholet-cpu')
+_slots = None
+
+
+def _get_slots():
+    # created lazily so it binds to the running event loop
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(_MAX_PENDING)
+    return _slots
+
+
+async def run_blocking(fn, *args, timeout=_DEFAULT_TIMEOUT, **kwargs):
+    """
+    Run CPU-bound or blocking work on the bounded pool. Rejects with 503 when too many
+    calls are already queued, and with 504 when the call exceeds its timeout (the
+    worker thread itself cannot be interrupted and finishes in the background). A call
+    holds its slot until it has really finished, so timed-out calls still count.
+    """
+    slots = _get_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry.")
+
+    loop = asyncio.get_running_loop()
+    try:
+        # in the caller's context, so spans of the worker reach the request's trace
+        call = functools.partial(fn, *args, **kwargs)
+        future = _executor.submit(contextvars.copy_context().run, call)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: _release(loop, slots))
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Request timed out.")
+
+
+def _release(loop, slots):
+    # runs in the worker thread when the call ends (or when it is cancelled unstarted)
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # the event loop is closed, nothing waits on the slots any more
+        pass
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
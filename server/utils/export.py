@@ -0,0 +1,149 @@
+import io
+import gzip
+import json
+import hashlib
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from utils.cache import LRUCache
+from utils.metrics import span, register_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# what the map needs to draw points and bins; everything else is opt-in via ?columns=
+_MAP_COLUMNS = ['paper_id', 'umap_x', 'umap_y', 'cluster', 'bin_id', 'Title']
+_FORMATS = {
+    'json': 'application/json',
+    'columnar': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+_MIN_COMPRESS_BYTES = 1024
+_BODY_CACHE_SIZE = 16
+
+_bodies = LRUCache(_BODY_CACHE_SIZE)
+register_cache('responses', _bodies)
+
+
+def select_columns(df, columns=None):
+    """
+    Resolve the ?columns= projection: None keeps the map columns (plus every precomputed
+    umap_*_bin_* column), 'all' keeps everything, '+a,b' adds columns to the default and
+    anything else is an explicit comma-separated list.
+    """
+    if columns == 'all':
+        return list(df.columns)
+
+    bin_columns = [column for column in df.columns if column.startswith(('umap_x_bin', 'umap_y_bin'))]
+    default = [column for column in _MAP_COLUMNS if column in df.columns] + bin_columns
+    if columns is None:
+        return default
+
+    extend = columns.startswith('+')
+    requested = [column.strip() for column in columns.lstrip('+').split(',') if column.strip()]
+    unknown = [column for column in requested if column not in df.columns]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+    if extend:
+        return default + [column for column in requested if column not in default]
+    return requested
+
+
+def finite(df):
+    # inf is not valid JSON; only numeric columns can hold it
+    numeric = df.select_dtypes('number').columns
+    if len(numeric) == 0:
+        return df
+    return df.assign(**{column: df[column].replace([np.inf, -np.inf], np.nan) for column in numeric})
+
+
+def encode_frame(df, format, date):
+    if format == 'json':
+        # the original {"df": [records], "date": ...} shape
+        records = finite(df).fillna("").to_json(orient='records')
+        return f'{{"df":{records},"date":{json.dumps(date)}}}'.encode()
+
+    if format == 'columnar':
+        df = finite(df)
+        columns = ','.join(f'{json.dumps(column)}:{df[column].to_json(orient="values")}' for column in df.columns)
+        return f'{{"columns":{{{columns}}},"length":{len(df)},"date":{json.dumps(date)}}}'.encode()
+
+    if pa is None:
+        raise HTTPException(status_code=406, detail="Arrow export requires pyarrow.")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def compress(body, accept_encoding):
+    accepted = {encoding.split(';')[0].strip() for encoding in (accept_encoding or '').split(',')}
+    if len(body) < _MIN_COMPRESS_BYTES:
+        return body, None
+    if brotli is not None and 'br' in accepted:
+        return brotli.compress(body, quality=5), 'br'
+    if 'gzip' in accepted:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+
+def cached_response(request, version, params, build, media_type='application/json', headers=None):
+    """
+    Response for a body that only depends on params (which include the data version):
+    304 when the client's ETag matches, otherwise build() -> bytes, compressed and
+    kept in a small body cache.
+    """
+    params = json.dumps(params, default=str)
+    etag = f'W/"v{version}-{hashlib.md5(params.encode()).hexdigest()}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'X-Data-Version': str(version),
+        'Vary': 'Accept-Encoding',
+        **(headers or {}),
+    }
+    if etag in (request.headers.get('if-none-match') or ''):
+        return Response(status_code=304, headers=headers)
+
+    accept_encoding = request.headers.get('accept-encoding')
+    key = (params, accept_encoding)
+    cached = _bodies.get(key)
+    if cached is None:
+        with span('export.encode'):
+            body = build()
+        with span('export.compress'):
+            cached = compress(body, accept_encoding)
+        _bodies.put(key, cached)
+
+    body, encoding = cached
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def export_response(request, df, view_key, date, columns=None, format='json', offset=0, limit=None):
+    """
+    Projected, paginated and compressed export of the corpus view, with an ETag derived
+    from the data version so browsers can revalidate instead of downloading again.
+    """
+    if format not in _FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise HTTPException(status_code=400, detail="offset and limit must be non-negative.")
+
+    selected = select_columns(df, columns)
+    end = len(df) if limit is None else min(len(df), offset + limit)
+    return cached_response(
+        request, view_key[0], [view_key, selected, format, offset, end],
+        lambda: encode_frame(df.iloc[offset:end][selected], format, date),
+        media_type=_FORMATS[format], headers={'X-Total-Count': str(len(df))},
+    )
@@ -0,0 +1,35 @@
+import numpy as np
+
+from utils.index import top_k_indices
+
+_RRF_K = 60
+
+
+def reciprocal_rank_fusion(ranked_lists, weights=None, k=_RRF_K, depth=None, top_k=None):
+    """
+    Fuse any number of ranked lists of integer row ids (best first) with weighted
+    reciprocal rank fusion: score(row) = sum_i weights[i] / (rank_i(row) + k).
+
+    Each list only contributes its first `depth` entries, and only the fused
+    top_k are ranked. Returns (row ids, fused scores), best first.
+    """
+    ranked_lists = [np.asarray(ids, dtype=np.int64)[:depth] for ids in ranked_lists]
+    if weights is None:
+        weights = np.ones(len(ranked_lists))
+    if len(ranked_lists) != len(weights):
+        raise ValueError(f"Got {len(ranked_lists)} ranked lists but {len(weights)} weights")
+
+    if sum(len(ids) for ids in ranked_lists) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    ids = np.concatenate(ranked_lists)
+    contributions = np.concatenate([
+        weight / (np.arange(len(ids_)) + k) for ids_, weight in zip(ranked_lists, weights)
+    ])
+
+    # group-sum the contributions per row id
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    fused_scores = np.bincount(inverse, weights=contributions)
+
+    best = top_k_indices(fused_scores, len(unique_ids) if top_k is None else top_k)
+    return unique_ids[best], fused_scores[best]
@@ -0,0 +1,540 @@
+import os
+import copy
+import json
+import numpy as np
+
+from utils.corpus import append_rows
+
+_INDEX_DIR = 'ieee_vis_index'
+_INDEX_KIND = os.environ.get('SCHOLET_VECTOR_INDEX', 'auto')  # 'auto' | 'exact' | 'ivf' | 'sq8' | 'fp16'
+_IVF_MIN_ROWS = 50000  # below this, brute force is as fast as probing and always exact
+_IVF_TRAIN_SAMPLE = 100000
+_NPROBE = 16
+_SEARCH_BATCH = 65536
+# bound on the (queries x rows) score block of a batched search, in elements
+_GEMM_BLOCK = 2 ** 24
+# quantised indexes: re-score rerank * top_k candidates with the float32 vectors (0 = off)
+_RERANK = int(os.environ.get('SCHOLET_RERANK', 4))
+# quantised indexes: do not keep the float32 vectors at all, only the codes
+_QUANTIZED_ONLY = os.environ.get('SCHOLET_QUANTIZED_ONLY', '0') == '1'
+# rows converted to float32 at a time, small enough for the buffer to stay in cache
+_DEQUANTIZE_BLOCK = 1024
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k_indices(scores, top_k):
+    """
+    Indices of the top_k largest scores, best first, using a partial selection
+    instead of sorting the whole array.
+    """
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def top_k_per_row(scores, top_k):
+    """
+    Column indices of the top_k largest scores of every row of a 2-D array, best first.
+    """
+    top_k = min(top_k, scores.shape[1])
+    if top_k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    if top_k < scores.shape[1]:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def exact_search(vectors, query, top_k, rows=None):
+    """
+    Brute-force cosine search over pre-normalised vectors, optionally restricted to rows.
+    Returns (row ids, cosine similarities), best first.
+    """
+    rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+    candidates = vectors if rows is None else vectors[rows]
+    scores = np.asarray(candidates @ query, dtype=np.float32)
+    best = top_k_indices(scores, top_k)
+    ids = best if rows is None else rows[best]
+    return ids, scores[best]
+
+
+def blockwise_search(score_block, n_rows, n_queries, top_k, rows=None, block=None):
+    """
+    Top_k per query over n_rows (or only `rows`), scored one block of rows at a time by
+    score_block(block) -> (n_queries, len(block)) scores, where block is a slice or an
+    array of row ids. Only each query's running top_k is kept between blocks. Returns
+    (row ids, scores), both (n_queries, top_k) and best first per query.
+    """
+    rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+    n_rows = n_rows if rows is None else len(rows)
+    block = block or max(1024, _GEMM_BLOCK // max(n_queries, 1))
+
+    ids = np.empty((n_queries, 0), dtype=np.int64)
+    scores = np.empty((n_queries, 0), dtype=np.float32)
+    for start in range(0, n_rows, block):
+        end = min(n_rows, start + block)
+        block_rows = np.arange(start, end) if rows is None else rows[start:end]
+        block_scores = score_block(slice(start, end) if rows is None else block_rows)
+        ids = np.hstack([ids, np.broadcast_to(block_rows, (n_queries, len(block_rows)))])
+        scores = np.hstack([scores, np.asarray(block_scores, dtype=np.float32)])
+        if scores.shape[1] > top_k:
+            keep = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            ids, scores = np.take_along_axis(ids, keep, axis=1), np.take_along_axis(scores, keep, axis=1)
+
+    best = top_k_per_row(scores, top_k)
+    return np.take_along_axis(ids, best, axis=1), np.take_along_axis(scores, best, axis=1)
+
+
+def exact_search_many(vectors, queries, top_k, rows=None):
+    """
+    Brute-force cosine search for a batch of pre-normalised queries: one matrix-matrix
+    product per block of rows, keeping only each query's running top_k. Returns
+    (row ids, similarities), both (n_queries, top_k) and best first per query.
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    return blockwise_search(lambda block: queries @ vectors[block].T, len(vectors), len(queries), top_k, rows)
+
+
+class ExactIndex:
+    """
+    Flat index over normalised vectors. Always exact; also the fallback used by
+    the approximate indexes for small or heavily filtered candidate sets.
+    """
+    kind = 'exact'
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def build(self, embeddings):
+        self.vectors = normalize(embeddings)
+        return self
+
+    def add(self, embeddings):
+        self.vectors = append_rows(self.vectors, normalize(embeddings))
+
+    def copy(self):
+        # add() rebinds the arrays instead of writing into them, so a shallow copy can
+        # be extended while readers keep searching the original
+        return copy.copy(self)
+
+    def search(self, query, top_k, rows=None):
+        return exact_search(self.vectors, normalize(query), top_k, rows)
+
+    def search_many(self, queries, top_k, rows=None):
+        return self.scan_many(queries, top_k, rows)
+
+    def scan_many(self, queries, top_k, rows=None):
+        # flat scan of every row in one matrix product per block, whatever the index kind
+        return exact_search_many(self.vectors, normalize(queries), top_k, rows)
+
+    def reconstruct(self, rows):
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        _save_array(path, 'vectors', self.vectors)
+        _write_meta(path, {'kind': self.kind, 'dim': self.dim, 'ntotal': len(self), 'checksum': _checksum(self.vectors)})
+
+    def load(self, path):
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        return self
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted-file index: vectors are grouped by their nearest k-means centroid and
+    a query only scans the nprobe closest groups.
+    """
+    kind = 'ivf'
+
+    def __init__(self, dim, nlist=None, nprobe=_NPROBE, fallback=exact_search):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.fallback = fallback
+        self.centroids = np.empty((0, dim), dtype=np.float32)
+        self.assignments = np.empty(0, dtype=np.int32)
+        self._order = None
+        self._offsets = None
+
+    def build(self, embeddings):
+        self.vectors = normalize(embeddings)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(self.vectors))))
+        nlist = min(nlist, len(self.vectors))
+
+        rng = np.random.default_rng(0)
+        sample = self.vectors
+        if len(sample) > _IVF_TRAIN_SAMPLE:
+            sample = sample[np.sort(rng.choice(len(sample), _IVF_TRAIN_SAMPLE, replace=False))]
+        from sklearn.cluster import MiniBatchKMeans
+
+        kmeans = MiniBatchKMeans(n_clusters=nlist, batch_size=4096, n_init=1, random_state=0)
+        kmeans.fit(sample)
+
+        self.nlist = nlist
+        self.centroids = normalize(kmeans.cluster_centers_)
+        self.assignments = self._assign(self.vectors)
+        self._invalidate()
+        return self
+
+    def add(self, embeddings):
+        vectors = normalize(embeddings)
+        self.vectors = append_rows(self.vectors, vectors)
+        self.assignments = np.concatenate([self.assignments, self._assign(vectors)])
+        self._invalidate()
+
+    def search(self, query, top_k, rows=None):
+        query = normalize(query)
+        if rows is not None and len(rows) < _IVF_MIN_ROWS:
+            return self.fallback(self.vectors, query, top_k, rows)
+
+        order, offsets = self._lists()
+        probes = top_k_indices(self.centroids @ query, self.nprobe)
+        candidates = np.concatenate([order[offsets[p]:offsets[p + 1]] for p in probes])
+        if rows is not None:
+            candidates = candidates[np.isin(candidates, rows)]
+
+        if len(candidates) < top_k:
+            return self.fallback(self.vectors, query, top_k, rows)
+        return self.fallback(self.vectors, query, top_k, np.sort(candidates))
+
+    def search_many(self, queries, top_k, rows=None):
+        queries = normalize(np.atleast_2d(queries))
+        if rows is not None and len(rows) < _IVF_MIN_ROWS:
+            return exact_search_many(self.vectors, queries, top_k, rows)
+        # the probed lists differ per query, so only the centroid scoring is batched
+        results = [self.search(query, top_k, rows) for query in queries]
+        return np.vstack([ids for ids, _ in results]), np.vstack([scores for _, scores in results])
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        _save_array(path, 'vectors', self.vectors)
+        _save_array(path, 'centroids', self.centroids)
+        _save_array(path, 'assignments', self.assignments)
+        _write_meta(path, {
+            'kind': self.kind, 'dim': self.dim, 'ntotal': len(self), 'checksum': _checksum(self.vectors),
+            'nlist': self.nlist, 'nprobe': self.nprobe,
+        })
+
+    def load(self, path):
+        meta = _read_meta(path)
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.assignments = np.load(os.path.join(path, 'assignments.npy'))
+        self.nlist = meta['nlist']
+        self.nprobe = meta.get('nprobe', self.nprobe)
+        self._invalidate()
+        return self
+
+    def _assign(self, vectors):
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), _SEARCH_BATCH):
+            batch = vectors[start:start + _SEARCH_BATCH]
+            assignments[start:start + len(batch)] = np.argmax(batch @ self.centroids.T, axis=1)
+        return assignments
+
+    def _invalidate(self):
+        self._order = None
+        self._offsets = None
+
+    def _lists(self):
+        # CSR layout of the inverted lists: rows of list p are order[offsets[p]:offsets[p + 1]]
+        if self._order is None:
+            self._order = np.argsort(self.assignments, kind='stable')
+            self._offsets = np.searchsorted(self.assignments[self._order], np.arange(self.nlist + 1))
+        return self._order, self._offsets
+
+
+class QuantizedIndex(ExactIndex):
+    """
+    Flat index over scalar-quantised vectors used for a first scoring pass. The best
+    rerank * top_k candidates are re-scored exactly against the float32 vectors, which
+    stay memory-mapped on disk. With quantized_only the float32 vectors are not kept
+    at all and the quantised scores are final. This saves memory, not time: numpy has
+    no low-precision matrix product (an integer one is slower still), so the codes are
+    converted to float32 before scoring.
+    """
+    code_dtype = None
+
+    def __init__(self, dim, rerank=_RERANK, quantized_only=_QUANTIZED_ONLY):
+        super().__init__(dim)
+        self.rerank = rerank
+        self.quantized_only = quantized_only
+        self.codes = np.empty((0, dim), dtype=self.code_dtype)
+        self.offset = np.zeros(dim, dtype=np.float32)
+        self.scale = np.ones(dim, dtype=np.float32)
+        self.checksum = 0.0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def build(self, embeddings):
+        vectors = normalize(embeddings)
+        self.train(vectors)
+        self.codes = self.encode(vectors)
+        self.vectors = None if self.quantized_only else vectors
+        self.checksum = _checksum(vectors)
+        return self
+
+    def add(self, embeddings):
+        vectors = normalize(embeddings)
+        self.codes = append_rows(self.codes, self.encode(vectors))
+        if self.vectors is not None:
+            self.vectors = append_rows(self.vectors, vectors)
+
+    def train(self, vectors):
+        pass
+
+    def search(self, query, top_k, rows=None):
+        ids, scores = self.search_many(query, top_k, rows)
+        return ids[0], scores[0]
+
+    def scan_many(self, queries, top_k, rows=None):
+        queries = normalize(np.atleast_2d(queries))
+        rerank = self.rerank if self.vectors is not None and self.rerank > 1 else 1
+        buffer = np.empty((_DEQUANTIZE_BLOCK, self.dim), dtype=np.float32)
+        ids, scores = blockwise_search(
+            lambda block: self._score_codes(queries, block, buffer), len(self), len(queries), top_k * rerank, rows,
+        )
+        if rerank == 1 or ids.shape[1] == 0:
+            return ids[:, :top_k], scores[:, :top_k]
+
+        candidates = np.asarray(self.vectors[ids.ravel()], dtype=np.float32).reshape(ids.shape + (self.dim,))
+        exact = np.einsum('qkd,qd->qk', candidates, queries)
+        best = top_k_per_row(exact, top_k)
+        return np.take_along_axis(ids, best, axis=1), np.take_along_axis(exact, best, axis=1)
+
+    def _score_codes(self, queries, block, buffer):
+        # the codes are converted a few rows at a time into one float32 buffer that stays
+        # in cache, instead of materialising the whole block as float32
+        codes = self.codes[block]
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), len(buffer)):
+            chunk = codes[start:start + len(buffer)]
+            vectors = buffer[:len(chunk)]
+            vectors[...] = chunk
+            scores[:, start:start + len(chunk)] = self.score_block(queries, vectors)
+        return scores
+
+    def reconstruct(self, rows):
+        if self.vectors is not None:
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+        return normalize(self.decode(self.codes[rows]))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        _save_array(path, 'codes', self.codes)
+        _save_array(path, 'offset', self.offset)
+        _save_array(path, 'scale', self.scale)
+        if self.vectors is not None:
+            _save_array(path, 'vectors', self.vectors)
+            # only the codes stay in RAM, the re-rank reads the file as load() does
+            self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        _write_meta(path, {'kind': self.kind, 'dim': self.dim, 'ntotal': len(self), 'checksum': self.checksum})
+
+    def load(self, path):
+        meta = _read_meta(path)
+        # the codes are what is kept in RAM
+        self.codes = np.load(os.path.join(path, 'codes.npy'))
+        self.offset = np.load(os.path.join(path, 'offset.npy'))
+        self.scale = np.load(os.path.join(path, 'scale.npy'))
+        self.checksum = meta['checksum']
+        self.vectors = None
+        vectors_path = os.path.join(path, 'vectors.npy')
+        if not self.quantized_only and os.path.exists(vectors_path):
+            vectors = np.load(vectors_path, mmap_mode='r')
+            self.vectors = vectors if len(vectors) == len(self.codes) else None
+        return self
+
+
+class SQ8Index(QuantizedIndex):
+    """
+    int8 codes with a per-dimension offset and scale: 4x smaller than float32. Scores
+    are computed on the codes, v = offset + scale * (code + 128) folded into the query.
+    """
+    kind = 'sq8'
+    code_dtype = np.int8
+
+    def train(self, vectors):
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        self.offset = low.astype(np.float32)
+        self.scale = np.maximum((high - low) / 255, 1e-12).astype(np.float32)
+
+    def encode(self, vectors):
+        return (np.clip(np.round((vectors - self.offset) / self.scale), 0, 255) - 128).astype(np.int8)
+
+    def decode(self, codes):
+        return self.offset + self.scale * (codes.astype(np.float32) + 128)
+
+    def score_block(self, queries, codes):
+        # codes: rows of the codes, converted to float32
+        scaled = queries * self.scale
+        bias = queries @ self.offset + 128 * scaled.sum(axis=1)
+        return scaled @ codes.T + bias[:, None]
+
+
+class FP16Index(QuantizedIndex):
+    """
+    float16 codes: 2x smaller than float32 and nearly lossless, but numpy has no
+    half-precision BLAS and converts float16 slowly, so scoring is several times
+    slower than the exact index.
+    """
+    kind = 'fp16'
+    code_dtype = np.float16
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16)
+
+    def decode(self, codes):
+        return codes.astype(np.float32)
+
+    def score_block(self, queries, codes):
+        return queries @ codes.T
+
+
+_INDEX_TYPES = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+    'sq8': SQ8Index,
+    'fp16': FP16Index,
+}
+# memory-only options, never picked by 'auto'
+_QUANTIZED_KINDS = ('sq8', 'fp16')
+
+
+def _save_array(path, name, array):
+    # write next to the target and swap, the current file may still be memory-mapped
+    tmp_path = os.path.join(path, f'{name}.tmp.npy')
+    np.save(tmp_path, array)
+    os.replace(tmp_path, os.path.join(path, f'{name}.npy'))
+
+
+def _checksum(vectors, rows=1024):
+    return float(np.asarray(vectors[:rows], dtype=np.float64).sum())
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def _read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def index_path(data_dir):
+    return os.path.join(data_dir, _INDEX_DIR)
+
+
+def build_index(embeddings, kind=_INDEX_KIND):
+    if kind == 'auto':
+        kind = 'ivf' if len(embeddings) >= _IVF_MIN_ROWS else 'exact'
+    return _INDEX_TYPES[kind](embeddings.shape[1]).build(embeddings)
+
+
+def load_or_build_index(embeddings, data_dir, kind=_INDEX_KIND):
+    """
+    Load the persisted index next to the corpus, catching up on rows appended since
+    it was saved. Rebuild from scratch when it is missing or does not match.
+    """
+    path = index_path(data_dir)
+    try:
+        meta = _read_meta(path)
+        if meta['kind'] in _QUANTIZED_KINDS and kind in ('auto', meta['kind']):
+            _warn_quantized(meta['kind'])
+        if kind not in ('auto', meta['kind']) or meta['dim'] != embeddings.shape[1] or meta['ntotal'] > len(embeddings):
+            raise ValueError("persisted index does not match the corpus")
+        if not np.isclose(meta['checksum'], _checksum(normalize(embeddings[:min(1024, meta['ntotal'])])), rtol=1e-4):
+            raise ValueError("persisted index was built from a different corpus")
+        index = _INDEX_TYPES[meta['kind']](meta['dim']).load(path)
+        if len(index) < len(embeddings):
+            index.add(embeddings[len(index):])
+            index.save(path)
+        return index
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Building vector index ({e})")
+
+    if kind in _QUANTIZED_KINDS:
+        _warn_quantized(kind)
+    index = build_index(embeddings, kind)
+    index.save(path)
+    return index
+
+
+def _warn_quantized(kind):
+    print(f"Serving the {kind} vector index: it keeps less in RAM than the exact index but scores queries slower; "
+          f"unset SCHOLET_VECTOR_INDEX unless memory is the constraint")
+
+
+def evaluate_recall(embeddings, kinds=('exact', 'fp16', 'sq8'), n_queries=1000, top_k=10, seed=0):
+    """
+    recall@top_k of every index kind against exact search, with its search latency
+    and the bytes it keeps in RAM. Queries are corpus rows; each one's own row is
+    left out of both result lists. Quantised kinds are run with and without re-rank.
+    Run it with `python -m utils.index`.
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)
+    queries = normalize(embeddings[np.sort(sample)])
+    truth, _ = exact_search_many(normalize(embeddings), queries, top_k + 1)
+
+    report = []
+    for kind in kinds:
+        for rerank in ((_RERANK, 0) if issubclass(_INDEX_TYPES[kind], QuantizedIndex) else (None,)):
+            index = _INDEX_TYPES[kind](embeddings.shape[1])
+            if rerank is not None:
+                index.rerank = rerank
+            index.build(embeddings)
+            start = time.perf_counter()
+            ids = [index.search(query, top_k + 1)[0] for query in queries]
+            latency = (time.perf_counter() - start) / len(queries)
+
+            hits = 0
+            for own, found, expected in zip(np.sort(sample), ids, truth):
+                hits += len(set(found[found != own][:top_k]) & set(expected[expected != own][:top_k]))
+            # what a query scans; the float32 vectors of a quantised index are memory-mapped
+            # and only their rerank * top_k candidate rows are read
+            scanned = index.codes if isinstance(index, QuantizedIndex) else index.vectors
+            report.append({
+                'kind': kind,
+                'rerank': rerank,
+                f'recall@{top_k}': hits / (len(queries) * top_k),
+                'latency_ms': latency * 1000,
+                'scanned_mb': scanned.nbytes / 2 ** 20,
+            })
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    from utils.corpus import load_corpus, _DATA_DIR
+
+    parser = argparse.ArgumentParser(description="Compare the recall, latency and memory of the vector index kinds.")
+    parser.add_argument('--data-dir', default=_DATA_DIR)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    _, embeddings = load_corpus(args.data_dir)
+    for row in evaluate_recall(np.asarray(embeddings, dtype=np.float32), n_queries=args.queries, top_k=args.top_k):
+        print(json.dumps(row))
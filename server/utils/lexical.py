@@ -0,0 +1,335 @@
+import os
+import re
+import copy
+import json
+import numpy as np
+
+from utils.index import top_k_indices
+from utils.corpus import texts_checksum
+
+_LEXICAL_INDEX_DIR = 'ieee_vis_bm25'
+_LEXICAL_FIELDS = ['Title', 'AuthorKeywords', 'Abstract']
+_TOKEN = re.compile(r"\w+(?:-\w+)*")
+_K1 = 1.2
+_B = 0.75
+# merge posting lists through a dense accumulator once they cover 1/16 of the corpus
+_DENSE_MERGE_RATIO = 16
+# appended posting segments kept apart before the small ones are merged
+_MAX_SEGMENTS = 8
+
+_stop_words = None
+
+
+def stop_words():
+    global _stop_words
+    if _stop_words is None:
+        from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+        _stop_words = frozenset(ENGLISH_STOP_WORDS)
+    return _stop_words
+
+
+def tokenize(text):
+    if not isinstance(text, str):
+        return []
+    stop = stop_words()
+    return [token for token in _TOKEN.findall(text.lower()) if token not in stop]
+
+
+def lexical_texts(df):
+    """
+    The text indexed for every row: title, author keywords and abstract.
+    """
+    fields = [df[field].fillna('').astype(str) for field in _LEXICAL_FIELDS if field in df.columns]
+    if not fields:
+        return np.full(len(df), '', dtype=object)
+    texts = fields[0]
+    for field in fields[1:]:
+        texts = texts + ' ' + field
+    return texts.values
+
+
+class BM25Index:
+    """
+    In-memory BM25 over array-backed postings, kept in segments: in each segment the
+    documents containing term t are doc_ids[indptr[t]:indptr[t + 1]] (sorted) with
+    their term frequencies, and every segment holds larger doc ids than the ones
+    before it. add() indexes new documents as a new segment without touching the
+    indexed postings; impacts are computed from the term frequencies as a query reads
+    them, bounded per term for MaxScore pruning.
+    """
+
+    def __init__(self, k1=_K1, b=_B):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        # (indptr, doc_ids, tfs) per segment, indptr over the vocabulary as it was then
+        self.segments = ()
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.total_length = 0.0
+        # per term: documents containing it, its largest tf and its shortest document
+        self.document_frequency = np.empty(0, dtype=np.int64)
+        self.max_tf = np.empty(0, dtype=np.float32)
+        self.min_length = np.empty(0, dtype=np.float32)
+        # texts_checksum() of the texts indexed so far
+        self.checksum = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def build(self, texts):
+        self.__init__(self.k1, self.b)
+        self.add(texts)
+        return self
+
+    def add(self, texts):
+        """
+        Index documents appended to the corpus; they get the next row ids. Costs a sort
+        of the new postings only, the existing segments are shared.
+        """
+        start = len(self)
+        self.checksum = texts_checksum(texts, start, self.checksum)
+        if len(texts) == 0:
+            return
+        term_ids = []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for i, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[i] = len(tokens)
+            term_ids.append(np.fromiter((self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens), dtype=np.int64, count=len(tokens)))
+
+        # sorted by term, then by doc id: the postings of the new segment in order
+        counts = np.array([len(ids) for ids in term_ids], dtype=np.int64)
+        docs = np.repeat(np.arange(len(texts), dtype=np.int64), counts)
+        keys = np.concatenate(term_ids + [np.empty(0, dtype=np.int64)]) * len(texts) + docs
+        keys, tfs = np.unique(keys, return_counts=True)
+        n_terms = len(self.vocabulary)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // len(texts), minlength=n_terms))]).astype(np.int64)
+        doc_ids = (start + keys % len(texts)).astype(np.int32)
+        tfs = tfs.astype(np.float32)
+
+        self.doc_lengths = np.concatenate([self.doc_lengths, lengths])
+        self.total_length += float(lengths.sum())
+        document_frequency, max_tf, min_length = _term_statistics(indptr, doc_ids, tfs, self.doc_lengths)
+        self.document_frequency = _pad(self.document_frequency, n_terms, 0) + document_frequency
+        self.max_tf = np.maximum(_pad(self.max_tf, n_terms, 0), max_tf)
+        self.min_length = np.minimum(_pad(self.min_length, n_terms, np.inf), min_length)
+
+        segments = self.segments + ((indptr, doc_ids, tfs),) if len(doc_ids) else self.segments
+        if len(segments) > _MAX_SEGMENTS:
+            # the appended segments are small next to the first one, merge them into one
+            segments = (segments[0], _merge_segments(segments[1:], n_terms))
+        self.segments = segments
+
+    def copy(self):
+        # the arrays are rebound by add(), only the vocabulary is updated in place
+        clone = copy.copy(self)
+        clone.vocabulary = dict(self.vocabulary)
+        return clone
+
+    def _avgdl(self):
+        return max(self.total_length / max(len(self), 1), 1.0)
+
+    def _idf(self, terms):
+        document_frequency = self.document_frequency[terms]
+        return np.log1p((len(self) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def _impacts(self, term, docs, tfs):
+        # BM25 contribution of `term` to the given documents, from their term frequencies
+        norms = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self._avgdl())
+        return (self._idf(term) * tfs * (self.k1 + 1) / (tfs + norms)).astype(np.float32)
+
+    def upper_bounds(self, terms):
+        """
+        The largest impact each term can have: its largest tf in its shortest document.
+        """
+        tfs = self.max_tf[terms]
+        norms = self.k1 * (1 - self.b + self.b * self.min_length[terms] / self._avgdl())
+        return (self._idf(terms) * tfs * (self.k1 + 1) / (tfs + norms)).astype(np.float32)
+
+    def postings(self, term):
+        """
+        (doc ids, term frequencies) of the documents containing term, by doc id.
+        """
+        docs, tfs = [], []
+        for indptr, segment_docs, segment_tfs in self.segments:
+            if term < len(indptr) - 1 and indptr[term + 1] > indptr[term]:
+                docs.append(segment_docs[indptr[term]:indptr[term + 1]])
+                tfs.append(segment_tfs[indptr[term]:indptr[term + 1]])
+        if len(docs) == 1:
+            return docs[0], tfs[0]
+        if not docs:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def search(self, query, top_k, rows=None):
+        """
+        BM25 top_k for the query text, optionally restricted to rows. Returns
+        (row ids, scores), best first.
+        """
+        terms = np.unique([self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary]).astype(np.int64)
+        if len(terms) == 0 or top_k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # highest-impact terms first; remaining[i] bounds what terms i.. can still add
+        bounds = self.upper_bounds(terms)
+        order = np.argsort(-bounds, kind='stable')
+        terms = terms[order]
+        remaining = np.concatenate([np.cumsum(bounds[order][::-1])[::-1], [0]])
+
+        if rows is not None:
+            ids = np.unique(np.asarray(rows, dtype=np.int64))
+            scores = np.zeros(len(ids))
+            for term in terms:
+                scores += self._probe(term, ids)
+            keep = scores > 0
+            ids, scores = ids[keep], scores[keep]
+        else:
+            ids, scores = self._max_score(terms, remaining, top_k)
+
+        best = top_k_indices(scores, top_k)
+        return ids[best], scores[best].astype(np.float32)
+
+    def _max_score(self, terms, remaining, top_k):
+        ids = np.empty(0, dtype=np.int64)
+        scores = np.empty(0)
+        for i, term in enumerate(terms):
+            threshold = _kth_largest(scores, top_k)
+            if remaining[i] < threshold:
+                # documents not seen yet cannot reach the top k any more: the remaining
+                # (long, low-impact) lists are only probed for the surviving candidates
+                for j in range(i, len(terms)):
+                    keep = scores + remaining[j] >= threshold
+                    ids, scores = ids[keep], scores[keep]
+                    scores = scores + self._probe(terms[j], ids)
+                    threshold = max(threshold, _kth_largest(scores, top_k))
+                break
+
+            docs, tfs = self.postings(term)
+            impacts = self._impacts(term, docs, tfs)
+            if len(ids) == 0:
+                ids, scores = docs.astype(np.int64), impacts.astype(np.float64)
+            elif len(ids) + len(docs) > len(self) // _DENSE_MERGE_RATIO:
+                # long lists: scatter into a dense accumulator instead of sorting
+                accumulator = np.zeros(len(self))
+                accumulator[ids] = scores
+                accumulator[docs] += impacts
+                ids = np.flatnonzero(accumulator)
+                scores = accumulator[ids]
+            else:
+                ids, inverse = np.unique(np.concatenate([ids, docs]), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate([scores, impacts]), minlength=len(ids))
+        return ids, scores
+
+    def _probe(self, term, ids):
+        # impacts of `term` for the given (sorted) ids, 0 where the term does not occur
+        docs, tfs = self.postings(term)
+        found = np.zeros(len(ids))
+        if len(docs) == 0 or len(ids) == 0:
+            return found
+        if len(ids) > len(self) // _DENSE_MERGE_RATIO:
+            accumulator = np.zeros(len(self))
+            accumulator[docs] = self._impacts(term, docs, tfs)
+            return accumulator[ids]
+        positions = np.minimum(np.searchsorted(docs, ids), len(docs) - 1)
+        hit = docs[positions] == ids
+        found[hit] = self._impacts(term, docs[positions[hit]], tfs[positions[hit]])
+        return found
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        # one segment on disk
+        indptr, doc_ids, tfs = _merge_segments(self.segments, len(self.vocabulary))
+        postings_tmp = os.path.join(path, 'postings.tmp.npz')
+        np.savez(postings_tmp, indptr=indptr, doc_ids=doc_ids, tfs=tfs, doc_lengths=self.doc_lengths)
+        os.replace(postings_tmp, os.path.join(path, 'postings.npz'))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'documents': len(self), 'checksum': self.checksum, 'vocabulary': list(self.vocabulary)}, f)
+
+    def load(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(path, 'postings.npz'))
+        self.k1, self.b = meta['k1'], meta['b']
+        self.checksum = meta['checksum']
+        self.vocabulary = {term: i for i, term in enumerate(meta['vocabulary'])}
+        indptr, doc_ids, tfs = arrays['indptr'], arrays['doc_ids'], arrays['tfs']
+        self.doc_lengths = arrays['doc_lengths']
+        if len(self.doc_lengths) != meta['documents'] or len(indptr) != len(self.vocabulary) + 1:
+            raise ValueError("persisted BM25 index is inconsistent")
+        self.segments = ((indptr, doc_ids, tfs),)
+        self.total_length = float(self.doc_lengths.sum())
+        self.document_frequency, self.max_tf, self.min_length = _term_statistics(indptr, doc_ids, tfs, self.doc_lengths)
+        return self
+
+
+def _pad(values, n, fill):
+    return np.concatenate([values, np.full(n - len(values), fill, dtype=values.dtype)])
+
+
+def _term_statistics(indptr, doc_ids, tfs, doc_lengths):
+    # document frequency, largest tf and shortest document of every term of a segment
+    document_frequency = np.diff(indptr)
+    max_tf = np.zeros(len(document_frequency), dtype=np.float32)
+    min_length = np.full(len(document_frequency), np.inf, dtype=np.float32)
+    present = np.flatnonzero(document_frequency)
+    if len(present):
+        max_tf[present] = np.maximum.reduceat(tfs, indptr[present])
+        min_length[present] = np.minimum.reduceat(doc_lengths[doc_ids], indptr[present])
+    return document_frequency, max_tf, min_length
+
+
+def _merge_segments(segments, n_terms):
+    """
+    One segment with the postings of consecutive segments, placed term by term
+    without sorting: the postings of a term keep the segment order, i.e. doc id order.
+    """
+    if not segments:
+        return np.zeros(n_terms + 1, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    counts = [np.diff(_pad(indptr, n_terms + 1, indptr[-1])) for indptr, _, _ in segments]
+    indptr = np.concatenate([[0], np.cumsum(np.sum(counts, axis=0, dtype=np.int64))]).astype(np.int64)
+    doc_ids = np.empty(indptr[-1], dtype=np.int32)
+    tfs = np.empty(indptr[-1], dtype=np.float32)
+    offsets = indptr[:-1].copy()
+    for (segment_indptr, segment_docs, segment_tfs), segment_counts in zip(segments, counts):
+        terms = np.repeat(np.arange(n_terms), segment_counts)
+        destinations = offsets[terms] + np.arange(len(segment_docs)) - segment_indptr[terms]
+        doc_ids[destinations] = segment_docs
+        tfs[destinations] = segment_tfs
+        offsets += segment_counts
+    return indptr, doc_ids, tfs
+
+
+def _kth_largest(scores, k):
+    if len(scores) < k:
+        return 0.0
+    return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+def lexical_index_path(data_dir):
+    return os.path.join(data_dir, _LEXICAL_INDEX_DIR)
+
+
+def load_or_build_lexical_index(df, data_dir):
+    """
+    Load the persisted BM25 index, indexing only the rows appended since it was
+    saved. Rebuild when it is missing, covers more rows than the corpus or was built
+    from other texts.
+    """
+    path = lexical_index_path(data_dir)
+    try:
+        index = BM25Index().load(path)
+        if len(index) > len(df):
+            raise ValueError("persisted BM25 index does not match the corpus")
+        texts = lexical_texts(df)
+        if index.checksum != texts_checksum(texts[:len(index)]):
+            raise ValueError("persisted BM25 index was built from a different corpus")
+        if len(index) < len(df):
+            index.add(texts[len(index):])
+            index.save(path)
+        return index
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Building BM25 index ({e})")
+
+    index = BM25Index().build(lexical_texts(df))
+    index.save(path)
+    return index
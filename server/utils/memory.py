@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    _encoding = None
+
+_MAX_SESSIONS = 1000
+_SESSION_TTL = 60 * 60
+_HISTORY_TOKEN_BUDGET = 2048
+# keep this many recent messages verbatim, older ones are folded into the summary
+_RECENT_MESSAGES = 2
+_SUMMARIZE_AFTER = 4
+DEFAULT_SESSION = 'default'
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+class Session:
+    def __init__(self):
+        self.summary = ""
+        self.messages = []
+        self.summarizing = False
+        self.last_used = time.monotonic()
+
+
+class SessionMemory:
+    """
+    Conversation memory per session id: a running summary plus the recent turns,
+    bounded in number of sessions (LRU) and idle time (TTL).
+    """
+
+    def __init__(self, max_sessions=_MAX_SESSIONS, ttl=_SESSION_TTL, token_budget=_HISTORY_TOKEN_BUDGET):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        self._evict()
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = Session()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def clear(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def history(self, session_id):
+        """
+        Messages to prepend to the prompt: the summary as a system message and as many
+        of the most recent turns as fit in the token budget.
+        """
+        session = self.get(session_id)
+        budget = self.token_budget
+        summary = []
+        if session.summary:
+            summary_tokens = count_tokens(session.summary)
+            text = session.summary if summary_tokens <= budget else session.summary[-budget * 4:]
+            summary = [{"role": "system", "content": text}]
+            budget -= min(summary_tokens, budget)
+
+        recent = []
+        for message in reversed(session.messages):
+            tokens = count_tokens(message["content"])
+            if tokens > budget:
+                break
+            recent.append(message)
+            budget -= tokens
+        return summary + recent[::-1]
+
+    def append(self, session_id, prompt, answer):
+        self.get(session_id).messages += [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": answer},
+        ]
+
+    def needs_summary(self, session_id):
+        session = self.sessions.get(session_id)
+        return session is not None and not session.summarizing and len(session.messages) > _SUMMARIZE_AFTER
+
+    async def summarize(self, session_id, summarize):
+        """
+        Fold everything but the most recent turns into the running summary with
+        `summarize(summary, new_lines)`. Meant to run after the response was sent.
+        """
+        if not self.needs_summary(session_id):
+            return
+        session = self.sessions[session_id]
+        session.summarizing = True
+        folded = session.messages[:-_RECENT_MESSAGES]
+        try:
+            session.summary = await summarize(session.summary, "\n".join(m["content"] for m in folded))
+            # turns appended while summarising stay in place
+            session.messages = session.messages[len(folded):]
+            print('Generate New Summary', len(session.summary))
+        except Exception as e:
+            print(f"Failed to summarise session {session_id}: {e}")
+        finally:
+            session.summarizing = False
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_used < self.ttl:
+                break
+            self.sessions.popitem(last=False)
@@ -0,0 +1,209 @@
+import os
+import time
+import bisect
+import contextvars
+from contextlib import contextmanager
+from threading import Lock
+
+# add a Server-Timing header with the stages of every request (off: no per-request bookkeeping)
+_SERVER_TIMING = os.environ.get('SCHOLET_SERVER_TIMING', '0') == '1'
+# seconds, from sub-millisecond index lookups to minute-long refits and answers
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# (stage, seconds) of the current request, only set while its Server-Timing header is collected
+_trace = contextvars.ContextVar('scholet_trace', default=None)
+_metrics = []
+_caches = {}
+_in_flight = 0
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Histogram:
+    """
+    Latency histogram per combination of label values, rendered in the Prometheus
+    text format with cumulative buckets.
+    """
+
+    def __init__(self, name, help, labels=(), buckets=_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> counts per bucket (the last one is +Inf) and the sum
+        self._series = {}
+        self._lock = Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.label_names + ("le",), labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        lines += [f'{self.name}{_labels(self.label_names, labels)} {value}' for labels, value in values]
+        return lines
+
+
+class Gauge:
+    # read when /metrics is scraped, from collect()
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        _metrics.append(self)
+
+    def render(self):
+        try:
+            value = self.collect()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+stage_seconds = Histogram('scholet_stage_seconds', 'Duration of one stage of a request.', ('stage',))
+request_seconds = Histogram('scholet_request_seconds', 'Duration of a request, until its last byte was sent.', ('route', 'status'))
+Gauge('scholet_requests_in_flight', 'Requests being handled.', lambda: _in_flight)
+
+
+def record(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """
+    Time the block as one stage: observed in the stage histogram and, when
+    Server-Timing is on, listed in the header of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def register_cache(name, cache):
+    # anything with the stats() of LRUCache
+    _caches[name] = cache
+
+
+def _cache_lines():
+    stats = {name: cache.stats() for name, cache in sorted(_caches.items())}
+    lines = []
+    for metric, key, kind, help in (
+        ('scholet_cache_hits_total', 'hits', 'counter', 'Cache lookups that hit.'),
+        ('scholet_cache_misses_total', 'misses', 'counter', 'Cache lookups that missed.'),
+        ('scholet_cache_hit_ratio', 'hit_rate', 'gauge', 'Share of cache lookups that hit.'),
+        ('scholet_cache_entries', 'entries', 'gauge', 'Entries in the cache.'),
+        ('scholet_cache_bytes', 'bytes', 'gauge', 'Estimated size of the cache entries, where tracked.'),
+    ):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{{cache="{name}"}} {values[key]}' for name, values in stats.items() if key in values]
+    return lines
+
+
+def render_metrics():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    lines += _cache_lines()
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(trace, total):
+    # one entry per stage (repeated stages are summed), in the order they first finished
+    durations = {}
+    for stage, seconds in trace:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    entries = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in durations.items()]
+    return ', '.join(entries + [f'total;dur={total * 1000:.2f}'])
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting in-flight requests and timing each one per route and
+    status. With timing on, responses also carry a Server-Timing header with the
+    stages that finished before the response started; later stages of a stream
+    (the upstream LLM of /rag) only reach /metrics.
+    """
+
+    def __init__(self, app, timing=_SERVER_TIMING):
+        self.app = app
+        self.timing = timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        global _in_flight
+        start = time.perf_counter()
+        status = [500]
+        trace = [] if self.timing else None
+        token = _trace.set(trace) if self.timing else None
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                if trace is not None:
+                    header = server_timing(trace, time.perf_counter() - start)
+                    message = {**message, 'headers': list(message.get('headers', [])) + [(b'server-timing', header.encode())]}
+            await send(message)
+
+        _in_flight += 1
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            _in_flight -= 1
+            # the route template, not the path, so /tiles/{z}/{x}/{y} stays one series
+            route = getattr(scope.get('route'), 'path', None) or 'unmatched'
+            request_seconds.observe(time.perf_counter() - start, f"{scope['method']} {route}", status[0])
+            if token is not None:
+                _trace.reset(token)
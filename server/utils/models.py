@@ -0,0 +1,125 @@
+import os
+import time
+from threading import Lock
+
+_EMBEDDING_MODEL = os.environ.get('SCHOLET_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+_EMBEDDING_DIM = 384
+_BATCH_SIZE = 128
+_CHUNK_SIZE = 250
+# never reach out to the network for NLTK data, only check what is installed
+_OFFLINE = os.environ.get('SCHOLET_OFFLINE', '0') == '1'
+# sentence tokenizer data: nltk >= 3.8.2 reads punkt_tab, older releases punkt
+_NLTK_RESOURCES = {'punkt_tab': 'tokenizers/punkt_tab', 'punkt': 'tokenizers/punkt'}
+_WARMUP_TEXTS = [
+    "Visual analytics for exploring large document collections.",
+    "A user study of interaction techniques for scatterplots.",
+] * 4
+
+
+class ModelRegistry:
+    """
+    Process-wide, lazily loaded models and resources. Every module asks the registry
+    instead of loading its own copy; a resource is loaded once, on first use.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._resources = {}
+        self._load_seconds = {}
+        self._lock = Lock()
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+
+    def get(self, name):
+        resource = self._resources.get(name)
+        if resource is not None:
+            return resource
+        with self._lock:
+            if name not in self._resources:
+                start = time.perf_counter()
+                self._resources[name] = self._loaders[name]()
+                self._load_seconds[name] = time.perf_counter() - start
+                print(f"Loaded {name} in {self._load_seconds[name]:.2f}s")
+            return self._resources[name]
+
+    def loaded(self, name):
+        return name in self._resources
+
+    def status(self):
+        return {
+            name: {'loaded': name in self._resources, 'load_seconds': self._load_seconds.get(name)}
+            for name in self._loaders
+        }
+
+
+def _load_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(_EMBEDDING_MODEL)
+
+
+def _load_text_splitter():
+    from langchain.text_splitter import NLTKTextSplitter
+    return NLTKTextSplitter(chunk_size=_CHUNK_SIZE)
+
+
+registry = ModelRegistry()
+registry.register('embedding_model', _load_embedding_model)
+registry.register('text_splitter', _load_text_splitter)
+
+
+def get_embedding_model():
+    return registry.get('embedding_model')
+
+
+def get_text_splitter():
+    return registry.get('text_splitter')
+
+
+def embedding_dim():
+    # known without loading the model, so empty stores can be created at import time
+    if registry.loaded('embedding_model'):
+        return get_embedding_model().get_sentence_embedding_dimension()
+    return _EMBEDDING_DIM
+
+
+def encode_texts(texts, batch_size=_BATCH_SIZE):
+    return get_embedding_model().encode(texts, batch_size=batch_size)
+
+
+def encode_query(query):
+    return encode_texts([query])[0]
+
+
+def warm_up():
+    """
+    Encode one small batch so the first request does not pay for lazy initialisation
+    (weights paged in, kernels selected, tokenizer caches filled).
+    """
+    start = time.perf_counter()
+    encode_texts(_WARMUP_TEXTS)
+    get_text_splitter().split_text(_WARMUP_TEXTS[0])
+    return time.perf_counter() - start
+
+
+def ensure_nltk_data(offline=_OFFLINE):
+    """
+    Check for the sentence tokenizer data on disk and download it only when it is
+    missing and downloads are allowed. Returns {resource: available}.
+    """
+    import nltk
+
+    available = {}
+    for package, resource in _NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource)
+            available[package] = True
+            continue
+        except LookupError:
+            available[package] = False
+        if not offline:
+            try:
+                available[package] = bool(nltk.download(package, quiet=True))
+            except Exception as e:
+                print(f"Failed to download NLTK {package}: {e}")
+    return available
@@ -0,0 +1,283 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from utils.authors import normalize_name, split_authors
+from utils.binning import KeywordAggregator
+from utils.clustering import ClusteringService
+from utils.corpus import write_corpus, _DATA_DIR
+from utils.data import assign_bins, kde, _CLUSTER_NUM, _TOP_KERWORDS, _UMAP_MODEL_FILE, _UMAP_PARAMS
+from utils.index import build_index, index_path
+from utils.lexical import BM25Index, lexical_texts, lexical_index_path
+from utils.models import encode_texts, get_embedding_model, embedding_dim, _EMBEDDING_MODEL
+from utils.sentences import SentenceIndex, sentence_index_path
+
+_RAW_DIR = './raw_data'
+_RAW_CSV = 'ieee_vis.csv'
+_WORK_DIR_NAME = 'pipeline'
+_SHARD_SIZE = 20000
+_ENCODE_BATCH = 512
+_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+# UMAP is fitted on a sample of a large corpus, the other papers are transformed
+_UMAP_FIT_SAMPLE = 100000
+_UMAP_TRANSFORM_BATCH = 50000
+# lower-cased source column -> corpus column
+_PAPER_COLUMNS = {'title': 'Title', 'abstract': 'Abstract', 'doi': 'DOI', 'year': 'Year', 'authors': 'AuthorNames', 'authornames': 'AuthorNames'}
+# faculty roster columns copied onto the papers of a matching author
+_ROSTER_COLUMNS = ['faculty', 'department', 'area_of_focus']
+
+
+def digest(*parts):
+    """
+    sha256 of arrays, strings and JSON-serialisable values; the cache key of a stage.
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            sha.update(f'{part.dtype}{part.shape}'.encode())
+            sha.update(part.tobytes())
+        elif isinstance(part, (list, tuple)) and all(isinstance(item, str) for item in part):
+            sha.update('\x00'.join(part).encode())
+        else:
+            sha.update(json.dumps(part, sort_keys=True, default=str).encode())
+        sha.update(b'\x01')
+    return sha.hexdigest()
+
+
+def read_sources(csv_path, raw_dir=_RAW_DIR):
+    """
+    Papers from the raw IEEE VIS CSV and from every raw_dir/*.xlsx sheet with an
+    abstract column. Sheets with first_name/last_name columns are faculty rosters:
+    their faculty, department and area of focus are copied onto the papers of the
+    matching authors. Papers without an abstract and duplicates are dropped.
+    """
+    frames, rosters = [], []
+    if csv_path and os.path.exists(csv_path):
+        frames.append(pd.read_csv(csv_path))
+    for path in sorted(glob.glob(os.path.join(raw_dir, '*.xlsx'))):
+        for sheet, frame in pd.read_excel(path, sheet_name=None).items():
+            frame = frame.rename(columns=lambda column: _PAPER_COLUMNS.get(str(column).strip().lower(), column))
+            if 'Abstract' in frame.columns:
+                frames.append(frame)
+            elif {'first_name', 'last_name'} <= set(frame.columns):
+                rosters.append(frame)
+            else:
+                print(f"Skipping {path} [{sheet}]: neither papers nor a faculty roster")
+    if not frames:
+        raise FileNotFoundError(f"No papers found in {csv_path} or {raw_dir}/*.xlsx")
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df[df['Abstract'].fillna('').astype(str).str.strip() != '']
+    df = df.drop_duplicates(subset=['DOI'] if 'DOI' in df.columns and df['DOI'].notna().all() else ['Title', 'Abstract'])
+    df = df.reset_index(drop=True)
+    for roster in rosters:
+        df = attach_roster(df, roster)
+    print(f"Read {len(df)} papers from {len(frames)} sources and {len(rosters)} rosters")
+    return df
+
+
+def attach_roster(df, roster):
+    names = (roster['first_name'].fillna('').astype(str) + ' ' + roster['last_name'].fillna('').astype(str)).map(normalize_name)
+    columns = [column for column in _ROSTER_COLUMNS if column in roster.columns]
+    members = {name: row for name, row in zip(names, roster[columns].to_dict('records')) if name}
+
+    matches = []
+    for value in df['AuthorNames'].values if 'AuthorNames' in df.columns else []:
+        matches.append(next((members[name] for name in split_authors(value) if name in members), {}))
+    for column in columns:
+        values = [match.get(column) for match in matches] if matches else None
+        df[column] = df[column].where(df[column].notna(), values) if column in df.columns else values
+    return df
+
+
+def _init_worker(threads):
+    # each worker loads the model once and keeps to its share of the cores
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    get_embedding_model()
+
+
+def _encode_shard(texts, path, batch_size):
+    embeddings = np.asarray(encode_texts(texts, batch_size=batch_size), dtype=np.float32).reshape(len(texts), -1)
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, embeddings)
+    os.replace(tmp_path, path)
+    return path
+
+
+def encode_corpus(texts, shard_dir, shard_size=_SHARD_SIZE, workers=_WORKERS, batch_size=_ENCODE_BATCH):
+    """
+    Encode the texts in shards spread over worker processes. Every finished shard is
+    checkpointed under a name derived from its texts and the model, so an interrupted
+    or repeated build only encodes the shards that are missing or changed.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    texts = [str(text) for text in texts]
+    paths, pending = [], []
+    for i, start in enumerate(range(0, len(texts), shard_size)):
+        shard = texts[start:start + shard_size]
+        path = os.path.join(shard_dir, f'{i:05d}-{digest(_EMBEDDING_MODEL, shard)[:16]}.npy')
+        paths.append(path)
+        if not os.path.exists(path):
+            pending.append((shard, path))
+    print(f"Encoding {len(pending)} of {len(paths)} shards ({len(paths) - len(pending)} checkpointed)")
+
+    if workers > 1 and len(pending) > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(threads,)) as pool:
+            futures = [pool.submit(_encode_shard, shard, path, batch_size) for shard, path in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                print(f"Encoded shard {done}/{len(pending)}: {os.path.basename(future.result())}")
+    else:
+        for done, (shard, path) in enumerate(pending, 1):
+            _encode_shard(shard, path, batch_size)
+            print(f"Encoded shard {done}/{len(pending)}: {os.path.basename(path)}")
+
+    if not paths:
+        return np.empty((0, embedding_dim()), dtype=np.float32)
+    return np.vstack([np.load(path) for path in paths])
+
+
+def cached_step(step_dir, name, key, compute):
+    """
+    Result of compute(), persisted under the hash of its inputs: rerunning a build
+    with unchanged inputs loads it instead of computing it again.
+    """
+    os.makedirs(step_dir, exist_ok=True)
+    path = os.path.join(step_dir, f'{name}-{key[:16]}.joblib')
+    if os.path.exists(path):
+        print(f"{name}: cached ({os.path.basename(path)})")
+        return joblib.load(path)
+
+    start = time.perf_counter()
+    result = compute()
+    tmp_path = path + '.tmp'
+    joblib.dump(result, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"{name}: {time.perf_counter() - start:.1f}s")
+    return result
+
+
+def project(embeddings, fit_sample=_UMAP_FIT_SAMPLE, seed=0):
+    # (coordinates, fitted UMAP model); the model places papers ingested later
+    from umap import UMAP
+
+    model = UMAP(**_UMAP_PARAMS)
+    if len(embeddings) <= fit_sample:
+        return np.asarray(model.fit_transform(embeddings), dtype=np.float64), model
+
+    sample = np.sort(np.random.default_rng(seed).choice(len(embeddings), fit_sample, replace=False))
+    model.fit(embeddings[sample])
+    coords = np.vstack([
+        model.transform(embeddings[start:start + _UMAP_TRANSFORM_BATCH])
+        for start in range(0, len(embeddings), _UMAP_TRANSFORM_BATCH)
+    ])
+    return np.asarray(coords, dtype=np.float64), model
+
+
+def build(csv_path=None, raw_dir=_RAW_DIR, data_dir=_DATA_DIR, work_dir=None, shard_size=_SHARD_SIZE,
+          workers=_WORKERS, batch_size=_ENCODE_BATCH, n_clusters=_CLUSTER_NUM, umap_sample=_UMAP_FIT_SAMPLE,
+          sentences=False):
+    """
+    Raw sources -> the compact corpus, UMAP model and indexes the server loads.
+    Encoding is sharded and checkpointed, projection, clustering and keywords are
+    cached by the hash of their inputs, so a rerun only redoes what changed.
+    """
+    csv_path = csv_path or os.path.join(raw_dir, _RAW_CSV)
+    work_dir = work_dir or os.path.join(data_dir, _WORK_DIR_NAME)
+    step_dir = os.path.join(work_dir, 'steps')
+    seconds = {}
+
+    start = time.perf_counter()
+    df = read_sources(csv_path, raw_dir)
+    texts = df['Abstract'].fillna('').astype(str).tolist()
+    seconds['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings = encode_corpus(texts, os.path.join(work_dir, 'shards'), shard_size, workers, batch_size)
+    seconds['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings_key = digest(embeddings)
+    coords, umap_model = cached_step(step_dir, 'umap', digest(embeddings_key, _UMAP_PARAMS, umap_sample), lambda: project(embeddings, umap_sample))
+    df['umap_x'] = coords[:, 0]
+    df['umap_y'] = coords[:, 1]
+    seconds['umap'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labels = cached_step(
+        step_dir, 'kmeans', digest(embeddings_key, n_clusters),
+        lambda: ClusteringService('embeddings').cluster(df, embeddings, n_clusters, embeddings_key)[0],
+    )
+    df['cluster'] = labels
+    keywords = cached_step(
+        step_dir, 'keywords', digest(texts, labels, _TOP_KERWORDS),
+        lambda: KeywordAggregator(texts).top_keywords(labels, int(labels.max()) + 1, _TOP_KERWORDS),
+    )
+    df['cluster_keywords'] = pd.Series(keywords, dtype=object).values[labels]
+    df['top_keywords'] = df['cluster_keywords']
+    seconds['cluster'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df = kde(df)
+    df = assign_bins(df)
+    df['paper_id'] = df.index
+    paths = write_corpus(df, embeddings, data_dir)
+    joblib.dump(umap_model, os.path.join(data_dir, _UMAP_MODEL_FILE))
+    build_index(embeddings).save(index_path(data_dir))
+    BM25Index().build(lexical_texts(df)).save(lexical_index_path(data_dir))
+    if sentences:
+        encode = lambda sentence_texts: encode_corpus(sentence_texts, os.path.join(work_dir, 'sentence_shards'), shard_size, workers, batch_size)
+        SentenceIndex(embeddings.shape[1]).build(df['Abstract'].values, encode).save(sentence_index_path(data_dir))
+    else:
+        # the old index describes the previous corpus, the server rebuilds it at startup
+        shutil.rmtree(sentence_index_path(data_dir), ignore_errors=True)
+    seconds['write'] = time.perf_counter() - start
+
+    manifest = {
+        'papers': len(df),
+        'embeddings': embeddings_key,
+        'model': _EMBEDDING_MODEL,
+        'clusters': n_clusters,
+        'seconds': seconds,
+        'artifacts': paths,
+    }
+    with open(os.path.join(work_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Built {len(df)} papers into {data_dir} in {sum(seconds.values()):.1f}s")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the corpus the server loads from the raw sources.")
+    parser.add_argument('--csv', default=None, help=f"raw IEEE VIS CSV (defaults to <raw-dir>/{_RAW_CSV})")
+    parser.add_argument('--raw-dir', default=_RAW_DIR, help="also reads every *.xlsx in it")
+    parser.add_argument('--data-dir', default=_DATA_DIR)
+    parser.add_argument('--work-dir', default=None, help=f"checkpoints and cached steps (defaults to <data-dir>/{_WORK_DIR_NAME})")
+    parser.add_argument('--shard-size', type=int, default=_SHARD_SIZE)
+    parser.add_argument('--workers', type=int, default=_WORKERS, help="encoding processes")
+    parser.add_argument('--batch-size', type=int, default=_ENCODE_BATCH)
+    parser.add_argument('--clusters', type=int, default=_CLUSTER_NUM)
+    parser.add_argument('--umap-sample', type=int, default=_UMAP_FIT_SAMPLE, help="fit UMAP on at most this many papers")
+    parser.add_argument('--sentences', action='store_true', help="also build the sentence index (otherwise built at first server start)")
+    args = parser.parse_args()
+
+    build(
+        args.csv, args.raw_dir, args.data_dir, args.work_dir, args.shard_size, args.workers,
+        args.batch_size, args.clusters, args.umap_sample, args.sentences,
+    )
@@ -1,31 +1,38 @@
+import os
+import asyncio
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from fastapi import HTTPException
 import re
 import json
-from typing import Annotated, List
 
-from utils.client_setup import client
+from utils.client_setup import async_client
 from utils.data import data_store
-
-from langchain.text_splitter import NLTKTextSplitter
-text_splitter = NLTKTextSplitter(chunk_size=250)
-
-model = SentenceTransformer('all-MiniLM-L6-v2')
-
-_rag_query_text = """
-You are a large language AI assistant. You are given a user question, and please write clean, concise and accurate answer to the question. You will be given a set of related contexts to the question, each starting with a reference number like [[citation:x]], where x is a number. Please use the context and cite the context at the end of each sentence if applicable.
-
-Your answer must be correct, accurate and written by an expert using an unbiased and professional tone. Please limit to 1024 tokens. Do not give any information that is not related to the question, and do not repeat. Say "information is missing on" followed by the related topic, if the given context do not provide sufficient information.
-
-Please cite the contexts with the reference numbers, in the format [citation:x]. If a sentence comes from multiple contexts, please list all applicable citations, like [citation:3][citation:5]. Other than code and specific names and citations, your answer must be written in the same language as the question.
-
-Here are the set of contexts:
-
-{context}
-
-Remember, don't blindly repeat the contexts verbatim. And here is the user question:
-"""
+from utils.fusion import reciprocal_rank_fusion
+from utils.index import top_k_indices, normalize
+from utils.models import encode_texts
+from utils.cache import LRUCache
+from utils.authors import normalize_name
+from utils.metrics import span, register_cache
+
+_CANDIDATES_NUM = 100
+# the fused results among which the cut-off gap is looked for
+_FUSED_CANDIDATES = 25
+# fuse BM25 over title/keywords/abstract with the dense results
+_HYBRID = os.environ.get('SCHOLET_HYBRID', '1') == '1'
+_EXPANSION_TIMEOUT = float(os.environ.get('SCHOLET_EXPANSION_TIMEOUT', 5))
+_MAX_EXPANSIONS = 6
+_BATCH_TOP_K = 10
+_RETRIEVAL_CACHE_SIZE = 1024
+_RETRIEVAL_CACHE_TTL = 60 * 60
+_RETRIEVAL_CACHE_BYTES = 64 * 1024 * 1024
+
+# retrieval() results per normalised query, filters and data version
+retrieval_cache = LRUCache(
+    _RETRIEVAL_CACHE_SIZE, ttl=_RETRIEVAL_CACHE_TTL, max_bytes=_RETRIEVAL_CACHE_BYTES,
+    sizeof=lambda results: len(json.dumps(results, default=str)),
+)
+data_store.on_change(retrieval_cache.clear)
+register_cache('retrieval', retrieval_cache)
 
 _generate_more_queries_prompt = """
 You are a helpful assistant that helps the user to generate 4~6 search queries based on a single input query, based on user's original question and your own knowledge. Please identify worthwhile topics that can be follow-ups, and write questions no longer than 20 words each. 
@@ -35,214 +42,262 @@ And here is the user query, generate 4 to 6 related queries based on this query:
 """
 
 
-def generate_queries_chatgpt(original_query):
+_ask_related_questions_tool = {
+    "name": "ask_related_questions",
+    "description": "Ask related questions based on the original question and the context.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "queries": {
+                "type": "array",
+                "items": {"type": "string", "description": "related query to the original query and context."},
+            },
+        },
+        "required": ["queries"],
+    },
+}
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": _generate_more_queries_prompt},
-            {"role": "user", "content": f"{original_query}"},
-        ]
-    )
 
-    generated_queries = response.choices[0].message.content
-    return generated_queries
+def query_text(query):
+    # the question without the [[Researcher: ...]] / [[P:id]] filters
+    return re.sub(r"\[\[.*?\]\]", "", query).strip()
 
 
-def generate_queries(original_query):
+async def generate_queries(original_query, timeout=_EXPANSION_TIMEOUT):
     """
-    Generate related questions based on the original question and the context.
+    Generate related questions based on the original question, without blocking the
+    event loop. Falls back to no expansion on timeout or any error.
     """
-    
-    def ask_related_questions(
-        queries: Annotated[
-            List[str],
-            [(
-                "query",
-                Annotated[
-                    str, "related query to the original query and context."
-                ],
-            )],
-        ]
-    ):
-        """
-        Ask related questions based on the original question and the context.
-        """
-        
-        pass
+    # the [[Researcher: ...]] / [[P:id]] filters are not part of the question
+    question = query_text(original_query)
+    if not question:
+        return []
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": _generate_more_queries_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"{original_query}",
-                },
-            ],
-            tools=[{
-                "type": "function",
-                "function": tool.get_tools_spec(ask_related_questions),
-            }],
-            max_tokens=512,
-        )
+        with span('retrieval.expansion'):
+            response = await asyncio.wait_for(async_client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": _generate_more_queries_prompt
+                    },
+                    {
+                        "role": "user",
+                        "content": f"{question}",
+                    },
+                ],
+                tools=[{"type": "function", "function": _ask_related_questions_tool}],
+                tool_choice={"type": "function", "function": {"name": _ask_related_questions_tool["name"]}},
+                max_tokens=512,
+            ), timeout=timeout)
         
-        print(f"Generated related questions: {response.choices[0].message.tool_calls[0].function.arguments}")
         related = response.choices[0].message.tool_calls[0].function.arguments
         if isinstance(related, str):
             related = json.loads(related)
         
-        return related["queries"][:]
+        queries = [query['query'] if isinstance(query, dict) else query for query in related["queries"]]
+        return [query for query in queries if isinstance(query, str) and query.strip()][:_MAX_EXPANSIONS]
     
+    except asyncio.TimeoutError:
+        print(f"generating related questions timed out after {timeout}s")
+        return []
     except Exception as e:
         # For any exceptions, we will just return an empty list.
         print(f"encountered error while generating related questions:\n{e}")
         return []
 
 
+def hydrate_results(df, ids, scores):
+    """
+    Build the response records for the final ranked rows only.
+    """
+    abstracts = df['Abstract'].values[ids]
+    titles = df['Title'].values[ids]
+    authors = df['AuthorNames'].values[ids]
+    return [
+        {'Abstract': abstract, 'score': score, 'paper_id': paper_id, 'Title': title, 'name': author.split(';')[0] if isinstance(author, str) else ''}
+        for paper_id, score, abstract, title, author in zip(df['paper_id'].values[ids], scores, abstracts, titles, authors)
+    ]
 
-def reciprocal_rank_fusion(search_results_dict, df, k=60):
-    index_fused_scores = {}
-    
-    for query, index_doc_scores in search_results_dict.items():
-        for rank, (index, (doc, score)) in enumerate(sorted(index_doc_scores.items(), key=lambda x: x[1][1], reverse=True)):
-            if index not in index_fused_scores:
-                paper_id = df.loc[df['Abstract'] == doc]['paper_id'].values[0]
-                index_fused_scores[index] = {'Abstract': doc, 'score': 0, 'paper_id': paper_id, 'Title': df.loc[paper_id]['Title'], 'name': (df.loc[paper_id]['AuthorNames']).split(';')[0]}
-            previous_score = index_fused_scores[index]['score']
-            # Update the score based on the reciprocal rank fusion algorithm
-            index_fused_scores[index]['score'] += 1 / (rank + k)
-            # print(f"Updating score for index {index}, doc {doc} from {previous_score} to {index_fused_scores[index]['score']} based on rank {rank} in query '{query}'")
-
-    # Sort the results by the fused score and then by the index
-    reranked_results = {index: index_fused_scores[index] for index in sorted(index_fused_scores, key=lambda x: (index_fused_scores[x]['score'], x), reverse=False)}
-    # print("Final reranked results:", reranked_results)
-    return reranked_results
-
-
-def compute_fused_results(original_query, matrix, df, generate_queries=False):
-    search_results_dict = {}
-    queries = []
-    
-    # 1. Generate Multiple Queries using ChatGPT
-    if generate_queries:
-        queries = generate_queries(original_query)
-        # 2. Embed and Perform Vector Similarity Search
-        for query in queries:
-            query = query['query']
-            
-            query_embedding = model.encode(query, convert_to_tensor=True)
-            query_embedding = query_embedding.cpu().detach().numpy()
-
-            distances = np.linalg.norm(matrix - query_embedding, axis=1)
-            search_results_dict[query] = dict(zip(df.index, zip(df['content'], distances)))
-
-        # 3. Reciprocal Rank Fusion
-        reranked_results = reciprocal_rank_fusion(search_results_dict, df)
-        
-    else:
-        query_embedding = model.encode(original_query, convert_to_tensor=True)
-        query_embedding = query_embedding.cpu().detach().numpy()
 
-        distances = np.linalg.norm(matrix - query_embedding, axis=1)
-        search_results_dict[original_query] = dict(zip(df.index, zip(df['Abstract'], distances)))
-        reranked_results = reciprocal_rank_fusion(search_results_dict, df)
-        queries = [original_query]
-        
-    
-    top_k = determine_top_k([result['score'] for result in reranked_results.values()])
-    top_results = list(reranked_results.values())[:top_k]
-    print(f"Top K: {top_k}")
-    
-    top_results_sentences_scores = []
+def vector_search(query_embedding, rows=None, top_k=_CANDIDATES_NUM, snapshot=None):
+    """
+    Row ids of the nearest neighbours of the query from the vector index, best first.
+    """
+    ids, _ = (snapshot or data_store.snapshot()).index.search(query_embedding, top_k, rows)
+    return ids
 
-    for result in top_results:
-        paper_id = result['paper_id']
-        row = df.loc[paper_id]
-        sentences = text_splitter.split_text(row['Abstract'])
 
-        for i, sentence in enumerate(sentences):
-            sentence_embedding = model.encode(sentence, convert_to_tensor=True)
-            sentence_embedding = sentence_embedding.cpu().detach().numpy()
-            # Calculate the cosine similarity between the query and the sentence
-            similarity = np.dot(query_embedding, sentence_embedding.T) / (np.linalg.norm(query_embedding) * np.linalg.norm(sentence_embedding))
-            top_results_sentences_scores.append((paper_id, i, sentence, similarity))
-            
-    top_results_sentences_scores = sorted(top_results_sentences_scores, key=lambda x: x[3], reverse=True)
+def vector_search_many(query_embeddings, rows=None, top_k=_CANDIDATES_NUM, snapshot=None):
+    """
+    Nearest neighbours of several queries in one batched search, best first per query.
+    """
+    ids, _ = (snapshot or data_store.snapshot()).index.search_many(query_embeddings, top_k, rows)
+    return list(ids)
+
+
+def batch_retrieval(queries=None, paper_ids=None, top_k=_BATCH_TOP_K, snapshot=None):
+    """
+    Nearest papers for many query texts, or for many papers using their stored
+    embeddings as queries (the paper itself is left out). All queries are scored
+    with one flat scan of the index (a matrix product per block) and a per-row top-k.
+    Returns one record per query, in order. Pass the same snapshot to every chunk of
+    one request, so all of its results come from one corpus version.
+    """
+    snapshot = snapshot or data_store.snapshot()
+    df, index = snapshot.df, snapshot.index
+
+    if paper_ids is None:
+        records = [{'query': query} for query in queries]
+        texts = [re.sub(r"\[/?INST\]", "", query) for query in queries]
+        query_vectors = normalize(np.asarray(encode_texts(texts), dtype=np.float32).reshape(len(texts), -1))
+        own_rows = np.full(len(records), -1)
+    else:
+        id_rows = snapshot.author_index.id_rows
+        records = [{'paper_id': paper_id} for paper_id in paper_ids]
+        own_rows = np.array([id_rows.get(paper_id, -1) for paper_id in paper_ids], dtype=np.int64)
+        found = own_rows >= 0
+        query_vectors = np.zeros((len(records), index.dim), dtype=np.float32)
+        query_vectors[found] = index.reconstruct(own_rows[found])
+
+    # one spare result in case the paper itself comes back first
+    ids, scores = index.scan_many(query_vectors, top_k + 1)
+    paper_id_values, titles = df['paper_id'].values, df['Title'].values
+    for record, row_ids, row_scores, own_row in zip(records, ids, scores, own_rows):
+        if paper_ids is not None and own_row < 0:
+            record['error'] = "Unknown paper id."
+            continue
+        keep = row_ids != own_row
+        row_ids, row_scores = row_ids[keep][:top_k], row_scores[keep][:top_k]
+        record['results'] = [
+            {'paper_id': int(paper_id), 'Title': title, 'score': float(score)}
+            for paper_id, title, score in zip(paper_id_values[row_ids], titles[row_ids], row_scores)
+        ]
+    return records
 
-    top_results_sentences_scores = top_results_sentences_scores[:5]
-    top_results_sentences_scores = sorted(top_results_sentences_scores, key=lambda x: x[3], reverse=True)
+
+def lexical_search(query, rows=None, top_k=_CANDIDATES_NUM, snapshot=None):
+    """
+    Row ids of the best BM25 matches of the query text, best first.
+    """
+    ids, _ = (snapshot or data_store.snapshot()).lexical_index.search(query, top_k, rows)
+    return ids
+
+
+def compute_fused_results(original_query, df, rows=None, expansions=None, hybrid=_HYBRID, snapshot=None):
+    # every index is read from one snapshot, the one df belongs to
+    snapshot = snapshot or data_store.snapshot()
+
+    # 1. The question plus the related queries generated by generate_queries(); the
+    # filter markup only restricts the rows and is never searched for
+    question = query_text(original_query)
+    queries = [question] + [query for query in (expansions or []) if query != question]
+
+    # 2. Embed all queries in one batch and search them with one matrix product;
+    # each query keeps only its own top candidates for the fusion
+    with span('retrieval.embed'):
+        query_embeddings = np.asarray(encode_texts(queries), dtype=np.float32).reshape(len(queries), -1)
+    query_embedding = query_embeddings[0]
+    with span('retrieval.vector_search'):
+        ranked_lists = vector_search_many(query_embeddings, rows, snapshot=snapshot)
+
+    # exact terms, acronyms and author keywords the embedding can miss
+    if hybrid and question:
+        with span('retrieval.lexical_search'):
+            ranked_lists.append(lexical_search(question, rows, snapshot=snapshot))
+        
+    # 3. Reciprocal Rank Fusion
+    with span('retrieval.fusion'):
+        fused_ids, fused_scores = reciprocal_rank_fusion(ranked_lists, top_k=_FUSED_CANDIDATES)
+        top_k = determine_top_k(fused_scores.tolist())
+        top_results = hydrate_results(df, fused_ids[:top_k], fused_scores[:top_k])
+    
+    # 4. Highlight the evidence sentences from the precomputed sentence index
+    with span('retrieval.sentences'):
+        paper_ids, sentence_idx, sentences, similarities = snapshot.sentence_index.score(fused_ids[:top_k], query_embedding)
+        best = top_k_indices(similarities, 5)
 
     for i, result in enumerate(top_results):
-        paper_id = result['paper_id']
-        top_results[i]['sentences'] = [x[2] for x in top_results_sentences_scores if x[0] == paper_id]
+        top_results[i]['sentences'] = [sentences[j] for j in best if paper_ids[j] == fused_ids[i]]
         
     
     return top_results
 
 
 def determine_top_k(scores):
+    """
+    How many of the best-first scores to keep: up to the first gap between consecutive
+    scores larger than 0.8 standard deviations of the gaps, between 5 and 12.
+    """
     # Calculate the differences between consecutive scores
     differences = [scores[i] - scores[i+1] for i in range(len(scores) - 1)]
     differences = [abs(diff) for diff in differences]
     threshold = np.std(differences) * 0.8
 
 
-    k = next((i for i, diff in enumerate(differences) if diff > threshold), len(scores))
+    # a gap after score i keeps scores 0..i
+    k = next((i + 1 for i, diff in enumerate(differences) if diff > threshold), len(scores))
     k = np.clip(k, 5, 12)
     return k
 
 
 
-def retrieval(query):
+def retrieval_key(query, expand=False, version=None):
+    """
+    Cache key of a retrieval: the query text lower-cased with collapsed whitespace,
+    the (order-independent) researcher and paper filters, whether it was expanded
+    with related queries and the data version (the current one by default). The
+    generated queries vary between calls, so they are not part of the key.
+    """
+    query = re.sub(r"\[/?INST\]", "", query)
+    researchers = sorted({normalize_name(name) for name in re.findall(r'\[\[Researcher: (.*?)\]\]', query)})
+    paper_ids = sorted({paper_id.strip() for paper_id in re.findall(r'\[\[P:(.*?)\]\]', query)})
+    text = ' '.join(re.sub(r"\[\[.*?\]\]", " ", query).lower().split())
+    return (text, tuple(researchers), tuple(paper_ids), bool(expand), _HYBRID, data_store.version if version is None else version)
+
+
+def cached_retrieval(query, expand=False, snapshot=None):
+    """
+    The cached results of the query, or None. Checked before generating the related
+    queries of an expanded retrieval, so a hit costs no LLM call.
+    """
+    key = retrieval_key(query, expand, (snapshot or data_store.snapshot()).version)
+    # a plain miss is counted by the retrieval() that follows
+    return retrieval_cache.get(key) if key in retrieval_cache else None
+
+
+def retrieval(query, expansions=None, snapshot=None):
+    # pinned for the whole retrieval, so a concurrent ingest cannot mix versions
+    snapshot = snapshot or data_store.snapshot()
+    expand = expansions is not None
+    with span('retrieval'):
+        key = retrieval_key(query, expand, snapshot.version)
+        results = retrieval_cache.get(key)
+        if results is None:
+            results = _retrieval(query, expansions, snapshot)
+            # without related queries (the LLM failed) this is not an expanded result
+            if not expand or expansions:
+                retrieval_cache.put(key, results)
+        return results
+
+
+def _retrieval(query, expansions, snapshot):
     query = re.sub(r"\[/?INST\]", "", query)
-    embeddings_df = data_store.get_data()
+    embeddings_df = snapshot.df
     
-    researchers = [name.lower() for name in re.findall(r'\[\[Researcher: (.*?)\]\]', query)]
+    researchers = re.findall(r'\[\[Researcher: (.*?)\]\]', query)
     paper_ids = [id for id in re.findall(r'\[\[P:(.*?)\]\]', query)]
     paper_ids = [int(id) for id in paper_ids]
 
-    # embeddings_df['researcher'] = embeddings_df['first_name'].str.cat(embeddings_df['last_name'], sep=' ')
-    # embeddings_df['researcher'] = embeddings_df['researcher'].str.lower()
-    embeddings_df['researcher'] = embeddings_df['AuthorNames'].str.lower()
-
-    filtered_df = embeddings_df[
-        embeddings_df['researcher'].apply(lambda x: any(name in x for name in researchers)) |
-        embeddings_df['paper_id'].isin(paper_ids)
-    ] if len(researchers) > 0 or len(paper_ids) > 0 else embeddings_df
-    
-    if len(filtered_df) == 0:
-        raise HTTPException(status_code=404, detail="No results found for the given query.")
+    # the matching rows pre-filter the vector search, no filtered frame is built
+    rows = None
+    if len(researchers) > 0 or len(paper_ids) > 0:
+        with span('retrieval.filter'):
+            rows = snapshot.author_index.filter_rows(researchers, paper_ids)
+        if len(rows) == 0:
+            raise HTTPException(status_code=404, detail="No results found for the given query.")
 
-    matrix = np.array(filtered_df['embeddings'].tolist())
-    top_results = compute_fused_results(query, matrix, filtered_df, generate_queries=False)
+    top_results = compute_fused_results(query, embeddings_df, rows, expansions, snapshot=snapshot)
     
     return top_results
-    
-    
-async def RAG(prompt, context):
-    system_prompt = _rag_query_text.format(
-        context="\n\n".join(
-            [f"[[citation:{c['id']}]] {c['text']}" for i, c in enumerate(context)]
-        )
-    )
-    
-    llm_response = await client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt},
-        ],
-        max_tokens=2048,
-        # stop=stop_words,
-        # stream=True,
-        temperature=0.9,
-    )
-    # list all the citations
-    citations_objects = [{'id': c['id'], 'content': c['text']} for c in context]
-    
-    return {"response": llm_response.choices[0].message.content, "citations": citations_objects}
@@ -0,0 +1,99 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from utils.index import normalize
+
+_SIMILARITY_THRESHOLD = float(os.environ.get('SCHOLET_SEMANTIC_CACHE_THRESHOLD', 0.95))
+_MAX_ENTRIES = 512
+_TTL = 24 * 60 * 60
+_MAX_BYTES = 32 * 1024 * 1024
+
+
+def context_key(context_ids):
+    return tuple(sorted(str(context_id) for context_id in context_ids))
+
+
+class SemanticCache:
+    """
+    Values keyed by a set of context ids and a query embedding. A lookup returns the
+    value stored for the same context ids whose query embedding is the most similar
+    one, if its cosine similarity reaches the threshold. LRU, TTL and memory bounded.
+    """
+
+    def __init__(self, threshold=_SIMILARITY_THRESHOLD, maxsize=_MAX_ENTRIES, ttl=_TTL, max_bytes=_MAX_BYTES):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        # entry id -> (context key, embedding, value, expires_at, size)
+        self._entries = OrderedDict()
+        self._by_context = {}
+        self._next_id = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, embedding, context_ids):
+        embedding = normalize(embedding)
+        key = context_key(context_ids)
+        with self._lock:
+            now = time.monotonic()
+            for entry_id in [entry_id for entry_id in self._by_context.get(key, ()) if self._entries[entry_id][3] < now]:
+                self._pop(entry_id)
+
+            entry_ids = list(self._by_context.get(key, ()))
+            if entry_ids:
+                similarities = np.stack([self._entries[entry_id][1] for entry_id in entry_ids]) @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    self._entries.move_to_end(entry_ids[best])
+                    return self._entries[entry_ids[best]][2]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, context_ids, value):
+        embedding = normalize(embedding)
+        size = embedding.nbytes + len(value.encode()) if isinstance(value, str) else embedding.nbytes
+        if size > self.max_bytes:
+            return
+        key = context_key(context_ids)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, embedding, value, time.monotonic() + self.ttl, size)
+            self._by_context.setdefault(key, set()).add(entry_id)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _pop(self, entry_id):
+        key, _, _, _, size = self._entries.pop(entry_id)
+        self._by_context[key].discard(entry_id)
+        if not self._by_context[key]:
+            del self._by_context[key]
+        self.nbytes -= size
@@ -0,0 +1,151 @@
+import os
+import copy
+import json
+import numpy as np
+import pandas as pd
+
+from utils.index import normalize
+from utils.corpus import append_rows, texts_checksum
+from utils.models import get_text_splitter
+
+_SENTENCE_INDEX_DIR = 'ieee_vis_sentences'
+
+
+def split_abstracts(abstracts):
+    text_splitter = get_text_splitter()
+    return [text_splitter.split_text(abstract) if isinstance(abstract, str) and abstract else [] for abstract in abstracts]
+
+
+class SentenceIndex:
+    """
+    Pre-split, pre-encoded abstract sentences. All sentence vectors live in one
+    normalised float32 matrix; the sentences of paper p are rows offsets[p]:offsets[p + 1].
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.sentences = np.empty(0, dtype=object)
+        # texts_checksum() of the abstracts indexed so far
+        self.checksum = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def build(self, abstracts, encode):
+        self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.sentences = np.empty(0, dtype=object)
+        self.checksum = 0
+        self.add(abstracts, encode)
+        return self
+
+    def add(self, abstracts, encode):
+        """
+        Split and encode the abstracts of papers appended to the corpus, in one batch.
+        """
+        self.checksum = texts_checksum(abstracts, len(self), self.checksum)
+        split = split_abstracts(abstracts)
+        sentences = [sentence for paper_sentences in split for sentence in paper_sentences]
+        counts = np.array([len(paper_sentences) for paper_sentences in split], dtype=np.int64)
+
+        vectors = normalize(encode(sentences)) if sentences else np.empty((0, self.dim), dtype=np.float32)
+        self.vectors = append_rows(self.vectors, vectors.reshape(-1, self.dim))
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(counts)])
+        self.sentences = np.concatenate([self.sentences, np.array(sentences, dtype=object)])
+
+    def copy(self):
+        # add() rebinds the arrays, so the copy can be extended independently
+        return copy.copy(self)
+
+    def score(self, paper_ids, query_embedding):
+        """
+        Cosine similarity between the query and every sentence of the given papers.
+        Returns (paper_ids, sentence_idx, sentences, similarities) aligned per sentence.
+        """
+        paper_ids = np.asarray(paper_ids, dtype=np.int64)
+        starts = self.offsets[paper_ids]
+        counts = self.offsets[paper_ids + 1] - starts
+        if counts.sum() == 0:
+            return paper_ids[:0], np.empty(0, dtype=np.int64), self.sentences[:0], np.empty(0, dtype=np.float32)
+
+        owners = np.repeat(paper_ids, counts)
+        sentence_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(starts, counts) + sentence_idx
+
+        similarities = self.vectors[rows] @ normalize(query_embedding)
+        return owners, sentence_idx, self.sentences[rows], similarities
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        vectors_tmp = os.path.join(path, 'vectors.tmp.npy')
+        table_tmp = os.path.join(path, 'sentences.tmp.parquet')
+        np.save(vectors_tmp, self.vectors)
+        pd.DataFrame({
+            'paper_id': np.repeat(np.arange(len(self)), np.diff(self.offsets)),
+            'sentence_idx': np.arange(len(self.sentences)) - np.repeat(self.offsets[:-1], np.diff(self.offsets)),
+            'sentence': self.sentences,
+        }).to_parquet(table_tmp, index=False)
+        os.replace(vectors_tmp, os.path.join(path, 'vectors.npy'))
+        os.replace(table_tmp, os.path.join(path, 'sentences.parquet'))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'papers': len(self), 'sentences': len(self.sentences), 'checksum': self.checksum}, f)
+
+    def load(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        table = pd.read_parquet(os.path.join(path, 'sentences.parquet'))
+        self.dim = meta['dim']
+        self.checksum = meta['checksum']
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.sentences = table['sentence'].values.astype(object)
+        counts = np.bincount(table['paper_id'].values, minlength=meta['papers'])
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return self
+
+
+def sentence_index_path(data_dir):
+    return os.path.join(data_dir, _SENTENCE_INDEX_DIR)
+
+
+def load_or_build_sentence_index(abstracts, data_dir, encode, dim):
+    """
+    Load the persisted sentence index, encoding only the papers appended since it
+    was saved. Rebuild when it is missing, covers more papers than the corpus or was
+    built from other abstracts.
+    """
+    path = sentence_index_path(data_dir)
+    try:
+        index = SentenceIndex(dim).load(path)
+        if index.dim != dim or len(index) > len(abstracts):
+            raise ValueError("persisted sentence index does not match the corpus")
+        if index.checksum != texts_checksum(abstracts[:len(index)]):
+            raise ValueError("persisted sentence index was built from a different corpus")
+        if len(index) < len(abstracts):
+            index.add(abstracts[len(index):], encode)
+            index.save(path)
+        return index
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Building sentence index ({e})")
+
+    index = SentenceIndex(dim).build(abstracts, encode)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split and encode every abstract into the sentence index.")
+    parser.add_argument('--rebuild', action='store_true', help="re-encode every paper instead of only new ones")
+    args = parser.parse_args()
+
+    # loading the store builds or catches up the persisted sentence index
+    from utils.data import data_store, encode_texts
+    data_store.load_data()
+    index = data_store.get_sentence_index()
+    if args.rebuild:
+        index.build(data_store.get_data()['Abstract'].values, encode_texts)
+        index.save(sentence_index_path(data_store.data_dir))
+    print(f"Indexed {len(index.sentences)} sentences from {len(index)} papers")
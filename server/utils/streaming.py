@@ -0,0 +1,94 @@
+import json
+import time
+import asyncio
+
+# a delta is held back at most this long, or until this many characters are buffered
+_COALESCE_SECONDS = 0.05
+_COALESCE_CHARS = 64
+# upstream chunks read ahead of a slow client before reading pauses
+_READ_AHEAD = 256
+_DONE = object()
+
+
+def sse_event(event, data):
+    # one Server-Sent Event; data is JSON so newlines in the answer need no escaping
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def coalesce(deltas, max_delay=_COALESCE_SECONDS, max_chars=_COALESCE_CHARS, read_ahead=_READ_AHEAD):
+    """
+    Merge a stream of small text deltas into larger ones: the first delta is sent
+    right away, later ones once max_chars are buffered or the oldest buffered delta
+    has waited max_delay. Upstream is read by a task through a bounded queue, so a
+    slow client slows the reading down, and closing this generator cancels the task.
+    """
+    queue = asyncio.Queue(maxsize=read_ahead)
+
+    async def pump():
+        try:
+            async for delta in deltas:
+                await queue.put(delta)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(e)
+
+    reader = asyncio.create_task(pump())
+    buffer, deadline, first = [], None, True
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield ''.join(buffer)
+                buffer, deadline = [], None
+                continue
+
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                continue
+            buffer.append(item)
+            if first or sum(len(delta) for delta in buffer) >= max_chars:
+                yield ''.join(buffer)
+                buffer, deadline, first = [], None, False
+            elif deadline is None:
+                deadline = time.monotonic() + max_delay
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        reader.cancel()
+
+
+class StreamTimer:
+    """
+    Time to first token and generation speed of one streamed answer. Tokens are
+    counted as upstream deltas, which the chat completions API sends one per token.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.end = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += 1
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    def stats(self):
+        end = self.end or time.perf_counter()
+        ttft = None if self.first_token is None else self.first_token - self.start
+        generation = None if self.first_token is None else end - self.first_token
+        return {
+            'ttft_ms': None if ttft is None else round(ttft * 1000, 1),
+            'tokens': self.tokens,
+            'tokens_per_second': round(self.tokens / generation, 1) if generation else None,
+            'total_ms': round((end - self.start) * 1000, 1),
+        }
@@ -0,0 +1,192 @@
+import re
+import json
+import types
+import zlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from utils.corpus import write_corpus, _EMBEDDING_DIM
+from utils.data import assign_bins, _CLUSTER_NUM
+from utils.models import registry
+
+_TOPICS = 40
+_VOCABULARY = 5000
+_TOPIC_WORDS = 200
+# share of the words of an abstract drawn from its topic, the rest from the whole vocabulary
+_TOPIC_SHARE = 0.6
+_SENTENCE_WORDS = 14
+_MAX_SENTENCES = 3
+_PAPERS_PER_AUTHOR = 20
+_FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dan', 'Eve', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter', 'Yuki']
+_SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'ze', 'an', 'berg', 'son', 'ova', 'ez', 'ski']
+
+
+def _words(rng, count):
+    # pronounceable fake words, unique
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(_SYLLABLES, rng.integers(2, 5))))
+    return np.array(sorted(words))
+
+
+def synthetic_corpus(n, dim=_EMBEDDING_DIM, seed=0, topics=_TOPICS):
+    """
+    A corpus of n papers with the DataStore schema: abstracts, titles, authors and
+    keywords drawn from per-topic vocabularies, embeddings scattered around a random
+    centre per topic and UMAP coordinates scattered around a 2-D centre per topic.
+    Returns (df, float32 embeddings).
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = _words(rng, _VOCABULARY)
+    topic_words = np.stack([rng.choice(len(vocabulary), _TOPIC_WORDS, replace=False) for _ in range(topics)])
+    topic = rng.integers(0, topics, n)
+
+    sentences = rng.integers(1, _MAX_SENTENCES + 1, n)
+    n_words = sentences * _SENTENCE_WORDS
+    offsets = np.concatenate([[0], np.cumsum(n_words)])
+    from_topic = rng.random(offsets[-1]) < _TOPIC_SHARE
+    paper_of_word = np.repeat(np.arange(n), n_words)
+    word_ids = np.where(
+        from_topic,
+        topic_words[topic[paper_of_word], rng.integers(0, _TOPIC_WORDS, offsets[-1])],
+        rng.integers(0, len(vocabulary), offsets[-1]),
+    )
+    words = vocabulary[word_ids]
+    abstracts = []
+    for i in range(n):
+        paper_words = words[offsets[i]:offsets[i + 1]]
+        abstracts.append('. '.join(' '.join(paper_words[start:start + _SENTENCE_WORDS]) for start in range(0, len(paper_words), _SENTENCE_WORDS)) + '.')
+
+    titles = [' '.join(vocabulary[ids]) for ids in topic_words[topic[:, None], rng.integers(0, _TOPIC_WORDS, (n, 5))]]
+    keywords = [', '.join(vocabulary[ids]) for ids in topic_words[topic[:, None], rng.integers(0, _TOPIC_WORDS, (n, 3))]]
+
+    # Zipf-distributed authorship: a few prolific authors and a long tail
+    n_authors = max(8, n // _PAPERS_PER_AUTHOR)
+    surnames = _words(rng, n_authors)
+    author_names = np.array([f'{rng.choice(_FIRST_NAMES)} {surname.capitalize()}' for surname in surnames])
+    popularity = 1 / np.arange(1, n_authors + 1)
+    author_ids = rng.choice(n_authors, (n, 4), p=popularity / popularity.sum())
+    authors = [';'.join(dict.fromkeys(author_names[ids[:count]])) for ids, count in zip(author_ids, rng.integers(1, 5, n))]
+
+    centres = rng.standard_normal((topics, dim)).astype(np.float32)
+    embeddings = centres[topic] + rng.standard_normal((n, dim), dtype=np.float32) * 0.8
+    layout = rng.uniform(-15, 15, (topics, 2))
+    coords = layout[topic] + rng.standard_normal((n, 2)) * 1.5
+
+    df = pd.DataFrame({
+        'Conference': rng.choice(['Vis', 'InfoVis', 'VAST', 'SciVis'], n),
+        'Year': rng.integers(1990, 2025, n),
+        'Title': titles,
+        'DOI': [f'10.0000/synthetic.{i}' for i in range(n)],
+        'Link': '',
+        'FirstPage': 1,
+        'LastPage': 10,
+        'PaperType': rng.choice(['J', 'C'], n),
+        'Abstract': abstracts,
+        'AuthorNames-Deduped': authors,
+        'AuthorNames': authors,
+        'AuthorAffiliation': '',
+        'InternalReferences': '',
+        'AuthorKeywords': keywords,
+        'AminerCitationCount': rng.poisson(20, n),
+        'CitationCount_CrossRef': rng.poisson(15, n),
+        'PubsCited_CrossRef': rng.poisson(40, n),
+        'Downloads_Xplore': rng.poisson(500, n),
+        'Award': None,
+        'GraphicsReplicabilityStamp': None,
+        'umap_x': coords[:, 0],
+        'umap_y': coords[:, 1],
+        'cluster': topic % _CLUSTER_NUM,
+        'top_keywords': [keywords[i] for i in range(n)],
+    })
+    df = assign_bins(df)
+    df['paper_id'] = df.index
+    return df, embeddings
+
+
+def write_synthetic_corpus(n, data_dir, seed=0):
+    df, embeddings = synthetic_corpus(n, seed=seed)
+    paths = write_corpus(df, embeddings, data_dir)
+    print(f"Wrote {n} synthetic papers to {data_dir}")
+    return paths
+
+
+class StubEncoder:
+    """
+    Offline stand-in for the sentence transformer: a fixed random unit vector per
+    text, derived from its crc32, at a tiny and predictable cost.
+    """
+
+    def __init__(self, dim=_EMBEDDING_DIM):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i] = np.random.default_rng(zlib.crc32(str(text).encode())).standard_normal(self.dim, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors[0] if single else vectors
+
+
+class StubSplitter:
+    # sentence splitting on end punctuation, instead of the NLTK tokenizer
+    def split_text(self, text):
+        return [sentence.strip() for sentence in re.split(r'(?<=[.!?])\s+', text) if sentence.strip()]
+
+
+class StubChatClient:
+    """
+    Offline stand-in for the async OpenAI client: chat completions answer instantly,
+    with related questions made of the words of the question. With stream=True the
+    answer (the question's words) comes back one word per chunk.
+    """
+
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, messages, stream=False, **kwargs):
+        words = messages[-1]['content'].split()
+        if stream:
+            return StubStream(words)
+        related = {'queries': [' '.join(words[i:] + words[:i]) for i in range(1, min(len(words), 5))]}
+        call = types.SimpleNamespace(function=types.SimpleNamespace(arguments=json.dumps(related)))
+        message = types.SimpleNamespace(content=' '.join(words), tool_calls=[call])
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason='stop')])
+
+
+class StubStream:
+    # the chunks of a streamed completion, as the OpenAI client yields them
+    def __init__(self, words):
+        self.words = words
+        self.closed = False
+
+    async def __aiter__(self):
+        for i, word in enumerate(self.words):
+            finish_reason = 'stop' if i == len(self.words) - 1 else None
+            delta = types.SimpleNamespace(content=word + ' ')
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+    async def close(self):
+        self.closed = True
+
+
+def install_stubs():
+    # must run before the models are first used
+    registry.register('embedding_model', StubEncoder)
+    registry.register('text_splitter', StubSplitter)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic corpus in the compact format the server loads.")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_synthetic_corpus(args.rows, args.data_dir, args.seed)
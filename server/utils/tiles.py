@@ -0,0 +1,139 @@
+import numpy as np
+
+_MAX_ZOOM = 16
+# a tile with at most this many papers is sent as raw points, otherwise as cells
+_MAX_POINTS = 1000
+_CELLS = 16
+_CELL_KEYWORDS = 3
+# keywords of a large tile are computed from an evenly spaced sample of its papers
+_KEYWORD_SAMPLE = 20000
+
+
+def _spread_bits(values):
+    # 16-bit integers -> the same bits at the even positions of a 32-bit integer
+    values = np.asarray(values, dtype=np.int64) & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+
+def morton_codes(tx, ty):
+    return _spread_bits(tx) | (_spread_bits(ty) << 1)
+
+
+class TileIndex:
+    """
+    Spatial index over the map: papers sorted by the Z-order (Morton) code of their
+    cell at max_zoom. The papers of any tile (z, x, y) are then one contiguous slice,
+    found with two binary searches. Tile (0, 0, 0) is the whole map; y grows with umap_y.
+    """
+
+    def __init__(self, x, y, max_zoom=_MAX_ZOOM):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.max_zoom = max_zoom
+        pad_x = max(float(np.ptp(x)) * 1e-6, 1e-9) if len(x) else 1.0
+        pad_y = max(float(np.ptp(y)) * 1e-6, 1e-9) if len(y) else 1.0
+        self.extent = (
+            float(x.min()) - pad_x if len(x) else 0.0, float(x.max()) + pad_x if len(x) else 1.0,
+            float(y.min()) - pad_y if len(y) else 0.0, float(y.max()) + pad_y if len(y) else 1.0,
+        )
+        self.x = x
+        self.y = y
+        qx, qy = self.cell_of(x, y, max_zoom)
+        codes = morton_codes(qx, qy)
+        self.order = np.argsort(codes, kind='stable')
+        self.codes = codes[self.order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def cell_of(self, x, y, zoom):
+        x0, x1, y0, y1 = self.extent
+        n = 2 ** zoom
+        qx = np.clip(((np.asarray(x) - x0) / (x1 - x0) * n).astype(np.int64), 0, n - 1)
+        qy = np.clip(((np.asarray(y) - y0) / (y1 - y0) * n).astype(np.int64), 0, n - 1)
+        return qx, qy
+
+    def bounds(self, z, tx, ty):
+        x0, x1, y0, y1 = self.extent
+        width, height = (x1 - x0) / 2 ** z, (y1 - y0) / 2 ** z
+        return (x0 + tx * width, x0 + (tx + 1) * width, y0 + ty * height, y0 + (ty + 1) * height)
+
+    def rows(self, z, tx, ty):
+        """
+        Row ids of the papers in tile (z, tx, ty), in Z-order.
+        """
+        shift = 2 * (self.max_zoom - z)
+        prefix = int(morton_codes(tx, ty))
+        start = np.searchsorted(self.codes, prefix << shift, side='left')
+        end = np.searchsorted(self.codes, (prefix + 1) << shift, side='left')
+        return self.order[start:end]
+
+    def covering(self, bbox, z):
+        """
+        (tx, ty) of the tiles at zoom z overlapping bbox = (x0, x1, y0, y1).
+        """
+        (tx0, tx1), (ty0, ty1) = self.cell_of(bbox[:2], bbox[2:], z)
+        return [(tx, ty) for ty in range(int(ty0), int(ty1) + 1) for tx in range(int(tx0), int(tx1) + 1)]
+
+    def zoom_for(self, bbox, max_tiles_per_axis=4):
+        # deepest zoom at which bbox is covered by at most max_tiles_per_axis tiles per axis
+        x0, x1, y0, y1 = self.extent
+        span = max((bbox[1] - bbox[0]) / (x1 - x0), (bbox[3] - bbox[2]) / (y1 - y0), 1e-12)
+        zoom = int(np.floor(np.log2((max_tiles_per_axis - 1) / span)))
+        return int(np.clip(zoom, 0, self.max_zoom))
+
+
+def tile_payload(index, z, tx, ty, df, clusters, aggregator, max_points=_MAX_POINTS, cells=_CELLS):
+    """
+    Constant-size content of a tile: its papers as columnar points when there are at
+    most max_points, otherwise a cells x cells aggregation with the count, mean
+    position, dominant cluster and top keywords of every non-empty cell.
+    """
+    rows = index.rows(z, tx, ty)
+    bounds = index.bounds(z, tx, ty)
+    payload = {'z': z, 'x': tx, 'y': ty, 'bounds': bounds, 'count': int(len(rows))}
+
+    if len(rows) <= max_points:
+        rows = np.sort(rows)
+        payload['points'] = {
+            'paper_id': df['paper_id'].values[rows].tolist(),
+            'x': index.x[rows].tolist(),
+            'y': index.y[rows].tolist(),
+            'cluster': np.asarray(clusters)[rows].tolist(),
+            'Title': df['Title'].fillna('').values[rows].tolist() if 'Title' in df.columns else [],
+        }
+        return payload
+
+    # cells of this tile are its descendants `cell_zoom` levels down
+    cell_zoom = int(np.log2(cells))
+    qx, qy = index.cell_of(index.x[rows], index.y[rows], z + cell_zoom)
+    codes = (qy - ty * cells) * cells + (qx - tx * cells)
+    codes = np.clip(codes, 0, cells * cells - 1)
+    counts = np.bincount(codes, minlength=cells * cells)
+    occupied = np.flatnonzero(counts)
+
+    labels = np.asarray(clusters, dtype=np.int64)[rows]
+    n_clusters = int(labels.max()) + 1
+    dominant = np.bincount(codes * n_clusters + labels, minlength=cells * cells * n_clusters).reshape(cells * cells, n_clusters).argmax(axis=1)
+
+    sample = np.arange(len(rows))
+    if len(rows) > _KEYWORD_SAMPLE:
+        sample = np.linspace(0, len(rows) - 1, _KEYWORD_SAMPLE).astype(np.int64)
+    sample_rows = rows[sample]
+    order = np.argsort(sample_rows)
+    keywords = aggregator.top_keywords(codes[sample][order], cells * cells, _CELL_KEYWORDS, rows=sample_rows[order])
+
+    payload['cells'] = {
+        'cx': (occupied % cells).tolist(),
+        'cy': (occupied // cells).tolist(),
+        'count': counts[occupied].tolist(),
+        'x': (np.bincount(codes, weights=index.x[rows], minlength=cells * cells)[occupied] / counts[occupied]).tolist(),
+        'y': (np.bincount(codes, weights=index.y[rows], minlength=cells * cells)[occupied] / counts[occupied]).tolist(),
+        'cluster': dominant[occupied].tolist(),
+        'keywords': [keywords[cell] for cell in occupied],
+    }
+    return payload
@@ -0,0 +1,9 @@
+// one id per browser, sent as X-Session-Id so the server keeps a separate chat memory per user
+export function getSessionId(): string {
+  let sessionId = localStorage.getItem("userId");
+  if (!sessionId) {
+    sessionId = crypto.randomUUID();
+    localStorage.setItem("userId", sessionId);
+  }
+  return sessionId;
+}
@@ -0,0 +1,25 @@
+export type ServerSentEvent = { event: string; data: any };
+
+// parses a fetch() response body of Server-Sent Events as they arrive
+export async function* readEvents(res: Response): AsyncGenerator<ServerSentEvent> {
+  // @ts-ignore
+  const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = "";
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += value;
+    let end;
+    while ((end = buffer.indexOf("\n\n")) !== -1) {
+      const block = buffer.slice(0, end);
+      buffer = buffer.slice(end + 2);
+      let event = "message";
+      const data: string[] = [];
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data.push(line.slice(5).trimStart());
+      }
+      if (data.length > 0) yield { event, data: JSON.parse(data.join("\n")) };
+    }
+  }
+}